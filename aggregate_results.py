@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+from scenario_outputs import SCENARIO_COLUMN, iter_report_files
+
+# Streams the per-simulation reports downloaded by run_scenarios.py one at a time and aggregates HIV prevalence,
+# incidence and mortality across all parameterizations and replicates of each scenario. Memory use depends on the
+# number of (scenario, year, age, gender) strata, not on the number of simulations.
+#
+# python aggregate_results.py -i sim_output -o sim_output_summary.csv
+
+DEFAULT_OUTPUT_FILENAME = 'scenario_summary.csv'
+DEFAULT_RESERVOIR_SIZE = 200
+DEFAULT_CREDIBLE_INTERVAL = 0.95
+DEFAULT_MIN_AGE = 15
+DEFAULT_MAX_AGE = 49
+
+GROUP_COLUMNS = ['Year', 'Age', 'Gender']
+SUM_COLUMNS = ['Population', 'Infected', 'Newly Infected', 'Died_from_HIV']
+METRICS = ['Prevalence', 'Incidence', 'Mortality']
+
+
+def compute_metrics(report, min_age, max_age):
+    # sum the report over nodes (and any other strata) and compute the per-simulation metrics for each group
+    report = report[(report['Age'] >= min_age) & (report['Age'] <= max_age)]
+    sums = report.groupby(GROUP_COLUMNS, observed=True)[SUM_COLUMNS].sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = pd.DataFrame({
+            'Prevalence': sums['Infected'] / sums['Population'],
+            'Incidence': sums['Newly Infected'] / (sums['Population'] - sums['Infected']),
+            'Mortality': sums['Died_from_HIV'] / sums['Population']
+        }, index=sums.index)
+    return metrics
+
+
+class StreamingAccumulator(object):
+    """
+    Running per-stratum statistics of each metric over simulations: Welford mean/variance plus a fixed-size reservoir
+    sample for the median and credible interval (exact while the number of simulations is <= reservoir_size).
+    """
+    def __init__(self, metrics, reservoir_size=DEFAULT_RESERVOIR_SIZE, seed=None):
+        self.metrics = metrics
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+        self.keys = {}  # stratum key -> row
+        # the arrays below are allocated with spare rows (and reservoir slots) and grown geometrically, so adding
+        # strata or simulations copies them O(log n) times; only the first len(self.keys) rows and self.depth slots
+        # are in use
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros((0, len(metrics)))
+        self.m2 = np.zeros((0, len(metrics)))
+        self.reservoir = np.full((0, len(metrics), 0), np.nan, dtype=np.float32)
+        self.depth = 0  # reservoir slots in use: the most simulations of any stratum, up to reservoir_size
+
+    @staticmethod
+    def _grown(array, shape, fill_value):
+        grown = np.full(shape, fill_value, dtype=array.dtype)
+        grown[tuple(slice(0, size) for size in array.shape)] = array
+        return grown
+
+    def _reserve(self, n_rows, depth):
+        if n_rows > len(self.count):
+            capacity = max(n_rows, 2 * len(self.count))
+            self.count = self._grown(self.count, (capacity,), 0)
+            self.mean = self._grown(self.mean, (capacity, len(self.metrics)), 0.0)
+            self.m2 = self._grown(self.m2, (capacity, len(self.metrics)), 0.0)
+            self.reservoir = self._grown(self.reservoir, (capacity,) + self.reservoir.shape[1:], np.nan)
+        if depth > self.reservoir.shape[2]:
+            slots = min(max(depth, 2 * self.reservoir.shape[2]), self.reservoir_size)
+            self.reservoir = self._grown(self.reservoir, self.reservoir.shape[:2] + (slots,), np.nan)
+        self.depth = max(self.depth, depth)
+
+    def _rows_for(self, keys):
+        rows = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            row = self.keys.get(key)
+            if row is None:
+                row = self.keys[key] = len(self.keys)
+            rows[i] = row
+        self._reserve(len(self.keys), self.depth)
+        return rows
+
+    def add(self, keys, values):
+        # keys: list of stratum keys (one per row of values), values: (n_rows, n_metrics) array of one simulation
+        rows = self._rows_for(keys)
+        self.count[rows] += 1
+        n = self.count[rows]
+        delta = values - self.mean[rows]
+        self.mean[rows] += delta / n[:, None]
+        self.m2[rows] += delta * (values - self.mean[rows])
+
+        # reservoir sampling: keep the first reservoir_size values, then replace with probability size/n
+        if len(n):
+            self._reserve(len(self.keys), min(int(n.max()), self.reservoir_size))
+        slots = np.where(n <= self.reservoir_size, n - 1, self.rng.integers(0, n))
+        keep = slots < self.reservoir_size
+        self.reservoir[rows[keep], :, slots[keep]] = values[keep]
+
+    def summary(self, credible_interval=DEFAULT_CREDIBLE_INTERVAL):
+        lower_q = (1 - credible_interval) / 2
+        n_rows = len(self.keys)
+        count, mean, m2 = self.count[:n_rows], self.mean[:n_rows], self.m2[:n_rows]
+        with np.errstate(invalid='ignore'):
+            variance = np.where(count[:, None] > 1, m2 / np.maximum(count[:, None] - 1, 1), np.nan)
+            if self.depth:
+                quantiles = np.nanquantile(self.reservoir[:n_rows, :, :self.depth], [lower_q, 0.5, 1 - lower_q],
+                                           axis=2)
+            else:  # nothing added yet
+                quantiles = np.full((3, n_rows, len(self.metrics)), np.nan)
+        columns = {'n_sims': count}
+        for i, metric in enumerate(self.metrics):
+            columns['%s_mean' % metric] = mean[:, i]
+            columns['%s_std' % metric] = np.sqrt(variance[:, i])
+            columns['%s_median' % metric] = quantiles[1][:, i]
+            columns['%s_lower' % metric] = quantiles[0][:, i]
+            columns['%s_upper' % metric] = quantiles[2][:, i]
+        index = pd.MultiIndex.from_tuples(list(self.keys), names=[SCENARIO_COLUMN] + GROUP_COLUMNS)
+        return pd.DataFrame(columns, index=index).sort_index().reset_index()
+
+
+def aggregate_results(output_path, min_age=DEFAULT_MIN_AGE, max_age=DEFAULT_MAX_AGE,
+                      reservoir_size=DEFAULT_RESERVOIR_SIZE, credible_interval=DEFAULT_CREDIBLE_INTERVAL, seed=None):
+    accumulator = StreamingAccumulator(metrics=METRICS, reservoir_size=reservoir_size, seed=seed)
+    n_reports = 0
+    for scenario, parameterization_id, run_number, filename in iter_report_files(output_path):
+        report = pd.read_csv(filename, usecols=GROUP_COLUMNS + SUM_COLUMNS)
+        metrics = compute_metrics(report, min_age=min_age, max_age=max_age)
+        keys = [(scenario,) + key for key in metrics.index]
+        accumulator.add(keys, metrics[METRICS].to_numpy(dtype=np.float64))
+        n_reports += 1
+        if n_reports % 100 == 0:
+            print('Aggregated %d reports...' % n_reports)
+    print('Aggregated %d reports in total.' % n_reports)
+    return accumulator.summary(credible_interval=credible_interval)
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input-dir', dest='output_path', type=str, required=True,
+                        help='Directory of downloaded scenario output files, i.e. run_scenarios.py --output-dir '
+                             '(Required).')
+    parser.add_argument('-o', '--output', dest='output_filename', type=str, default=DEFAULT_OUTPUT_FILENAME,
+                        help='csv file to write the aggregated results to (Default: %s).' % DEFAULT_OUTPUT_FILENAME)
+    parser.add_argument('--min-age', dest='min_age', type=float, default=DEFAULT_MIN_AGE,
+                        help='Youngest age (inclusive) to aggregate (Default: %s).' % DEFAULT_MIN_AGE)
+    parser.add_argument('--max-age', dest='max_age', type=float, default=DEFAULT_MAX_AGE,
+                        help='Oldest age (inclusive) to aggregate (Default: %s).' % DEFAULT_MAX_AGE)
+    parser.add_argument('--ci', dest='credible_interval', type=float, default=DEFAULT_CREDIBLE_INTERVAL,
+                        help='Width of the credible interval to report (Default: %s).' % DEFAULT_CREDIBLE_INTERVAL)
+    parser.add_argument('--reservoir-size', dest='reservoir_size', type=int, default=DEFAULT_RESERVOIR_SIZE,
+                        help='Number of simulations per stratum kept for medians/intervals. Exact up to this many '
+                             'simulations per scenario (Default: %d).' % DEFAULT_RESERVOIR_SIZE)
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Random seed for the reservoir sampling (Default: unseeded).')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    script_args = parse_args()
+    summary = aggregate_results(output_path=script_args.output_path, min_age=script_args.min_age,
+                                max_age=script_args.max_age, reservoir_size=script_args.reservoir_size,
+                                credible_interval=script_args.credible_interval, seed=script_args.seed)
+    summary.to_csv(script_args.output_filename, index=False)
+    print('Wrote %s' % script_args.output_filename)
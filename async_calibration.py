@@ -0,0 +1,215 @@
+import heapq
+import math
+
+import numpy as np
+import pandas as pd
+
+# Replicate-aware asynchronous calibration loop. A regular CalibManager iteration is a hard barrier: the next point is
+# only proposed after every replicate of every sample has been run and analyzed. Here replicates are scored as they
+# arrive, and once a quorum of the iteration's samples have all of their replicates scored, the next-point algorithm
+# (e.g. OptimTool) is given the iteration's results and the next iteration's simulations are started while the
+# stragglers are still running.
+#
+# Stragglers must not bias OptimTool's regression when the results are handed over: a straggler with some replicates
+# scored gets the mean of those, and one without any gets the value of a linear fit of the complete samples' scores
+# on the parameters (points on the fitted plane leave a least-squares fit of the complete samples unchanged; with
+# fewer complete samples than parameters the fit is a ridge fit). Their real scores are still recorded in the history
+# when they arrive.
+#
+# The loop talks to the next-point algorithm through the calibtool NextPointAlgorithm methods
+# get_samples_for_iteration(iteration) / set_results_for_iteration(iteration, results) and to the simulations through
+# a runner with submit(key, sample) and wait_for_results() -> [(key, likelihood), ...]. The synthetic runner and
+# next-point algorithm below allow measuring the loop without running any simulations:
+#
+# python async_calibration.py --quorum 0.8
+#
+# Scope: this is the loop and its harness only. CalibManager has no hook for replacing its iteration barrier, so
+# optim_script.py still calibrates through CalibManager; using the loop for real calibrations needs a runner that
+# creates, runs and analyzes the simulations (e.g. through the LOCAL_POOL backend and likelihood_scoring.py), which is
+# not part of this module.
+
+RESULTS_COLUMN = 'total'
+
+
+class AsyncCalibration(object):
+    def __init__(self, next_point, runner, n_replicates, quorum=0.8, max_iterations=10):
+        if not 0 < quorum <= 1:
+            raise ValueError('quorum must be in (0, 1], got %s' % quorum)
+        self.next_point = next_point
+        self.runner = runner
+        self.n_replicates = n_replicates
+        self.quorum = quorum
+        self.max_iterations = max_iterations
+        self.history = []  # one dict per scored replicate
+        self.pending = {}  # iteration -> {sample_index: [scores]} for iterations not yet handed to next_point
+        self.samples = {}  # iteration -> samples DataFrame
+
+    def start_iteration(self, iteration):
+        samples = self.next_point.get_samples_for_iteration(iteration)
+        self.samples[iteration] = samples
+        self.pending[iteration] = {sample_index: [] for sample_index in range(len(samples))}
+        for sample_index, sample in enumerate(samples.to_dict(orient='records')):
+            for replicate in range(self.n_replicates):
+                self.runner.submit((iteration, sample_index, replicate), sample)
+
+    def record(self, key, likelihood):
+        iteration, sample_index, replicate = key
+        self.history.append({'iteration': iteration, 'sample': sample_index, 'replicate': replicate,
+                             'likelihood': likelihood, 'straggler': iteration not in self.pending})
+        if iteration in self.pending:
+            self.pending[iteration][sample_index].append(likelihood)
+
+    def quorum_reached(self, iteration):
+        n_complete = sum(len(scores) == self.n_replicates for scores in self.pending[iteration].values())
+        return n_complete >= math.ceil(self.quorum * len(self.samples[iteration]))
+
+    def finish_iteration(self, iteration):
+        # mean score over the replicates scored so far, stragglers without any get the linear fit's value
+        scores = self.pending.pop(iteration)
+        samples = self.samples[iteration]
+        means = {sample_index: np.mean(values) for sample_index, values in scores.items() if values}
+        complete = [sample_index for sample_index, values in scores.items() if len(values) == self.n_replicates]
+        unscored = [sample_index for sample_index in range(len(samples)) if sample_index not in means]
+        if unscored:
+            predicted = linear_fit_prediction(samples, complete, [means[i] for i in complete], unscored)
+            means.update(zip(unscored, predicted))
+        results = pd.DataFrame({RESULTS_COLUMN: [means[sample_index] for sample_index in range(len(samples))]})
+        self.next_point.set_results_for_iteration(iteration, results)
+        return results
+
+    def run(self):
+        iteration = 0
+        self.start_iteration(iteration)
+        while True:
+            for key, likelihood in self.runner.wait_for_results():
+                self.record(key, likelihood)
+            if self.quorum_reached(iteration):
+                self.finish_iteration(iteration)
+                iteration += 1
+                if iteration >= self.max_iterations:
+                    break
+                self.start_iteration(iteration)
+        return pd.DataFrame(self.history)
+
+
+def linear_fit_prediction(samples, known, scores, unknown, ridge_penalty=1.0):
+    """
+    Linear fit of scores (of the samples at positions known) on the numeric sample parameters, evaluated at the
+    samples at positions unknown. With more known samples than parameters this is the least-squares fit; with fewer
+    (e.g. 20 samples of 65 parameters) the least-squares fit is not unique, and a ridge fit on the standardized
+    parameters is used instead.
+    """
+    parameters = samples.select_dtypes(include='number').to_numpy(dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(known) > parameters.shape[1]:
+        design = np.column_stack([np.ones(len(known)), parameters[known]])
+        coefficients = np.linalg.lstsq(design, scores, rcond=None)[0]
+        return list(np.column_stack([np.ones(len(unknown)), parameters[unknown]]) @ coefficients)
+
+    center = parameters[known].mean(axis=0)
+    scale = parameters[known].std(axis=0)
+    scale[scale == 0] = 1.0
+    known_parameters = (parameters[known] - center) / scale
+    # dual form of the ridge solution, an n x n system for n known samples
+    gram = known_parameters @ known_parameters.T + ridge_penalty * np.eye(len(known))
+    coefficients = known_parameters.T @ np.linalg.solve(gram, scores - scores.mean())
+    return list(scores.mean() + ((parameters[unknown] - center) / scale) @ coefficients)
+
+
+class SyntheticRunner(object):
+    """
+    Simulation-free runner on a virtual clock: a fixed pool of n_slots nodes, each 'simulation' taking a lognormal
+    (heavy-tailed) duration in hours and returning likelihood_fn(sample) plus replicate noise.
+    """
+    def __init__(self, likelihood_fn, n_slots=60, median_hours=1.0, duration_sigma=0.5, noise=1.0, seed=None):
+        self.likelihood_fn = likelihood_fn
+        self.n_slots = n_slots
+        self.median_hours = median_hours
+        self.duration_sigma = duration_sigma
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.clock = 0.0
+        self.queue = []  # submitted jobs waiting for a free slot
+        self.running = []  # heap of (finish time, sequence, key, sample)
+        self.sequence = 0
+
+    def submit(self, key, sample):
+        self.queue.append((key, sample))
+
+    def _start_queued(self):
+        while self.queue and len(self.running) < self.n_slots:
+            key, sample = self.queue.pop(0)
+            duration = self.median_hours * math.exp(self.duration_sigma * self.rng.standard_normal())
+            heapq.heappush(self.running, (self.clock + duration, self.sequence, key, sample))
+            self.sequence += 1
+
+    def wait_for_results(self):
+        # advances the clock to the next finishing simulation and returns everything finished at that time
+        self._start_queued()
+        finish_time, _, key, sample = heapq.heappop(self.running)
+        self.clock = finish_time
+        finished = [(key, sample)]
+        while self.running and self.running[0][0] <= self.clock:
+            _, _, key, sample = heapq.heappop(self.running)
+            finished.append((key, sample))
+        self._start_queued()
+        return [(key, self.likelihood_fn(sample) + self.noise * self.rng.standard_normal())
+                for key, sample in finished]
+
+
+class SyntheticNextPoint(object):
+    # a minimal NextPointAlgorithm: samples around the best point found so far, shrinking the step each iteration
+    def __init__(self, n_params=10, samples_per_iteration=20, step=0.2, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.names = ['p%d' % i for i in range(n_params)]
+        self.samples_per_iteration = samples_per_iteration
+        self.step = step
+        self.center = np.full(n_params, 0.5)
+        self.samples = {}
+        self.best = []  # best result per iteration
+
+    def get_samples_for_iteration(self, iteration):
+        points = self.center + self.step * self.rng.standard_normal((self.samples_per_iteration, len(self.names)))
+        self.samples[iteration] = pd.DataFrame(np.clip(points, 0, 1), columns=self.names)
+        return self.samples[iteration]
+
+    def set_results_for_iteration(self, iteration, results):
+        best_index = int(np.argmax(results[RESULTS_COLUMN].values))
+        self.center = self.samples[iteration].iloc[best_index].values
+        self.step *= 0.9
+        self.best.append(results[RESULTS_COLUMN].iloc[best_index])
+
+
+def synthetic_likelihood(optimum=0.3, scale=100.0):
+    # a smooth log-likelihood surface with its maximum (0) at every parameter == optimum
+    def likelihood(sample):
+        x = np.array(list(sample.values()))
+        return -scale * np.sum((x - optimum) ** 2)
+    return likelihood
+
+
+def measure_iterations_per_hour(quorum, n_iterations=20, n_replicates=3, n_slots=60, seed=0):
+    runner = SyntheticRunner(synthetic_likelihood(), n_slots=n_slots, seed=seed)
+    next_point = SyntheticNextPoint(seed=seed)
+    calibration = AsyncCalibration(next_point, runner, n_replicates=n_replicates, quorum=quorum,
+                                   max_iterations=n_iterations)
+    calibration.run()
+    return n_iterations / runner.clock, next_point.best[-1]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quorum', dest='quorum', type=float, default=0.8,
+                        help='Fraction of samples that must be complete before the next iteration starts '
+                             '(Default: 0.8).')
+    parser.add_argument('--iterations', dest='n_iterations', type=int, default=20,
+                        help='Number of synthetic iterations to run (Default: 20).')
+    parser.add_argument('--slots', dest='n_slots', type=int, default=60,
+                        help='Number of simulations that can run at once (Default: 60).')
+    script_args = parser.parse_args()
+
+    for label, quorum in [('synchronous', 1.0), ('asynchronous', script_args.quorum)]:
+        rate, best = measure_iterations_per_hour(quorum, n_iterations=script_args.n_iterations,
+                                                 n_slots=script_args.n_slots)
+        print('%s (quorum %.2f): %.2f iterations/hour, final best log-likelihood %.2f' % (label, quorum, rate, best))
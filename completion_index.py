@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from scenario_outputs import REP_TAG, TPI_TAG, download_destination
+
+# Local index of the simulations run by run_scenarios.py --incremental. Every (scenario, parameterization, replicate)
+# combination is identified by a fingerprint of everything that determines its results: the template set name, the
+# contents of every template of its resolved template set (config, campaign, demographics and overlays) and its
+# complete mapped parameter row (which includes the scenario parameters, the parameterization_id and the Run_Number).
+# Editing any template file therefore makes every combination that uses it new. Combinations whose fingerprint is
+# marked completed, and whose output files are still present, are not run again.
+
+INDEX_FILENAME = 'completed_simulations.json'
+STATE_SUBMITTED = 'submitted'
+STATE_COMPLETED = 'completed'
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return repr(value)
+
+
+def template_sha256(template):
+    # the contents a template starts every simulation from
+    lazy_document = getattr(template, 'lazy_document', None)
+    if lazy_document is not None:
+        return hashlib.sha256(lazy_document.data).hexdigest()  # lazily loaded: the file's bytes, nothing is parsed
+    contents = getattr(template, 'pristine_contents', None)  # indexed templates
+    if contents is None:
+        contents = template.contents
+    canonical = json.dumps(contents, sort_keys=True, default=_json_default)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def template_set_sha256(resolved_template_set):
+    # resolved_template_set is {template type: [template, ...]} as returned by resolve_scenario_template_set
+    digests = {template_type: [template_sha256(template) for template in templates]
+               for template_type, templates in resolved_template_set.items()}
+    return hashlib.sha256(json.dumps(digests, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def fingerprint_combination(template_set_name, templates_sha256, row):
+    # row is the {header: value} dict of one simulation, without the (unserializable) ACTIVE_TEMPLATES entry
+    canonical = json.dumps({'template_set': template_set_name, 'templates': templates_sha256, 'row': row},
+                           sort_keys=True, default=_json_default)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CompletionIndex(object):
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.filename = os.path.join(output_path, INDEX_FILENAME)
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        os.makedirs(self.output_path, exist_ok=True)
+        partial = self.filename + '.part'
+        with open(partial, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(partial, self.filename)
+
+    def files_present(self, entry):
+        return all(os.path.exists(os.path.join(self.output_path, filename)) for filename in entry['files'])
+
+    def is_completed(self, fingerprint):
+        entry = self.entries.get(fingerprint)
+        return entry is not None and entry['state'] == STATE_COMPLETED and self.files_present(entry)
+
+    def mark_submitted(self, fingerprint, scenario_name, parameterization_id, run_number, files):
+        # files are the expected downloaded output files, relative to output_path
+        self.entries[fingerprint] = {'state': STATE_SUBMITTED, 'scenario': scenario_name,
+                                     'parameterization_id': parameterization_id, 'run_number': run_number,
+                                     'files': files}
+
+    def update_completed(self):
+        # marks submitted combinations whose outputs have all been downloaded as completed
+        n_completed = 0
+        for entry in self.entries.values():
+            if entry['state'] == STATE_SUBMITTED and self.files_present(entry):
+                entry['state'] = STATE_COMPLETED
+                n_completed += 1
+        self.save()
+        return n_completed
+
+
+def filter_completed_rows(rows, completion_index, resolved_template_set, template_set_name, scenario_name,
+                          download_filenames):
+    # drops the rows (simulations) whose results are already in the completion index and records the others
+    templates_sha256 = template_set_sha256(resolved_template_set)
+    n_rows = n_remaining = 0
+    for row_dict in rows:
+        n_rows += 1
+        fingerprint = fingerprint_combination(template_set_name, templates_sha256, row_dict)
+        if completion_index.is_completed(fingerprint):
+            continue
+        parameterization_id = row_dict['TAGS'][TPI_TAG]
+        run_number = row_dict[REP_TAG]
+        files = [download_destination(scenario_name, parameterization_id, run_number, filename)
+                 for filename in download_filenames]
+        completion_index.mark_submitted(fingerprint, scenario_name=scenario_name,
+                                        parameterization_id=int(parameterization_id), run_number=int(run_number),
+                                        files=files)
+        n_remaining += 1
+        yield row_dict
+    print('Scenario: %s %d of %d simulation(s) already have results, %d to run' %
+          (scenario_name, n_rows - n_remaining, n_rows, n_remaining))
@@ -0,0 +1,73 @@
+import sys
+import time
+
+# Waiting for the simulations of a suite to finish, used by run_scenarios.analyze_experiments to download results as
+# they arrive. Kept free of simtools imports: regular experiment managers, slurm_bundles.BundledExperimentManager and
+# test fakes can all be watched.
+
+
+class CompletionWatcher(object):
+    """
+    Polls experiment managers and yields batches of simulations as soon as they finish, so downloading can start with
+    the first finished simulation instead of the slowest one. The poll interval starts at min_interval, grows by
+    backoff_factor (up to max_interval) while nothing finishes and drops back to min_interval whenever something does.
+    Only the experiment managers' finished(), refresh_experiment() and experiment.simulations (with .id and .status)
+    are used, so any object providing those can be watched.
+    """
+    SUCCEEDED_STATE = 'Succeeded'
+    FINAL_STATES = (SUCCEEDED_STATE, 'Failed', 'Canceled')
+
+    def __init__(self, experiment_managers, min_interval=5, max_interval=60, backoff_factor=2, sleep=time.sleep):
+        self.experiment_managers = experiment_managers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.sleep = sleep
+        self.seen_simulation_ids = set()
+        self.n_failed = 0
+
+    @staticmethod
+    def state_name(status):
+        return getattr(status, 'name', status)
+
+    def collect_newly_finished(self):
+        newly_finished = []
+        for em in self.experiment_managers:
+            for simulation in em.experiment.simulations:
+                if simulation.id in self.seen_simulation_ids:
+                    continue
+                state = self.state_name(simulation.status)
+                if state not in self.FINAL_STATES:
+                    continue
+                self.seen_simulation_ids.add(simulation.id)
+                if state == self.SUCCEEDED_STATE:
+                    newly_finished.append(simulation)
+                else:
+                    self.n_failed += 1
+                    print('Simulation %s finished with state: %s (will not be downloaded)' % (simulation.id, state))
+        return newly_finished
+
+    def watch(self):
+        interval = self.min_interval
+        while True:
+            newly_finished = self.collect_newly_finished()
+            if newly_finished:
+                interval = self.min_interval
+                yield newly_finished
+
+            unfinished = [em for em in self.experiment_managers if not em.finished()]
+            if not unfinished:
+                # catch anything that finished between the last collection and the experiments reporting finished
+                remaining = self.collect_newly_finished()
+                if remaining:
+                    yield remaining
+                break
+
+            n_total = sum(len(em.experiment.simulations) for em in self.experiment_managers)
+            print('Waiting %d seconds for simulations to complete (%d/%d finished)...' %
+                  (interval, len(self.seen_simulation_ids), n_total))
+            sys.stdout.flush()
+            self.sleep(interval)
+            interval = min(interval * self.backoff_factor, self.max_interval)
+            for em in unfinished:
+                em.refresh_experiment()
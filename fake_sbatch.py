@@ -0,0 +1,35 @@
+import os
+import re
+import subprocess
+import sys
+
+# Stand-in for sbatch, for trying out and testing bundled submission (slurm_bundles.py) without a Slurm cluster: set
+# sbatch_command = python /path/to/fake_sbatch.py in the simtools.ini block. Like sbatch, it returns right away; every
+# array task of the submitted script runs as a background subprocess with SLURM_ARRAY_TASK_ID set and its output
+# written to the script's --output file.
+#
+# python fake_sbatch.py <array script>
+
+FAKE_JOB_ID = '1'
+ARRAY_REGEX = re.compile(r'^#SBATCH --array=(?P<first>\d+)-(?P<last>\d+)$', re.MULTILINE)
+OUTPUT_REGEX = re.compile(r'^#SBATCH --output=(?P<output>.+)$', re.MULTILINE)
+
+
+def submit(script_filename):
+    with open(script_filename) as f:
+        script = f.read()
+    array = ARRAY_REGEX.search(script)
+    task_ids = range(int(array.group('first')), int(array.group('last')) + 1) if array else [0]
+    output = OUTPUT_REGEX.search(script)
+    output_pattern = output.group('output') if output else os.path.join(os.getcwd(), 'slurm-%A_%a.out')
+
+    for task_id in task_ids:
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task_id), SLURM_ARRAY_JOB_ID=FAKE_JOB_ID)
+        with open(output_pattern.replace('%A', FAKE_JOB_ID).replace('%a', str(task_id)), 'w') as log:
+            subprocess.Popen(['bash', script_filename], env=env, stdout=log, stderr=subprocess.STDOUT,
+                             start_new_session=True)
+    return 'Submitted batch job %s' % FAKE_JOB_ID
+
+
+if __name__ == '__main__':
+    print(submit(sys.argv[-1]))
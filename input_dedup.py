@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+
+# Content-addressed storage of generated simulation input files (config, campaign, demographics overlays). Files are
+# deduplicated as they are written, before anything is submitted: the content is hashed in memory, stored once per
+# experiment as <experiment dir>/input_assets/<sha256><ext>, and the simulation directory gets a relative symbolic
+# link ../input_assets/<sha256><ext> to it. A suite of thousands of simulations that mostly use the same campaign and
+# demographics writes each distinct file once.
+#
+# The links are relative and the assets sit next to the simulation directories, so they resolve wherever the
+# experiment directory is mounted (e.g. singularity -B <experiment dir>:/data). Assets are read-only: writing a
+# simulation's input in place fails instead of changing every simulation that shares it; replace the link instead.
+#
+# The manifest written next to the assets records the hash of every simulation's files as generated, so that
+# python input_dedup.py verify <manifest> can check that every simulation still resolves to exactly those inputs.
+
+ASSET_DIRNAME = 'input_assets'
+MANIFEST_FILENAME = 'manifest_%s.json'
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def asset_dir_for(sim_dir):
+    # assets are shared by the simulations of one experiment directory
+    return os.path.join(os.path.dirname(os.path.abspath(sim_dir)), ASSET_DIRNAME)
+
+
+def write_deduplicated(sim_dir, filename, content):
+    """
+    Writes content (str) as sim_dir/filename: a link to the experiment's shared copy, which is only written if no
+    simulation has written the same content before. Returns the content's sha256.
+    """
+    data = content.encode('utf-8')
+    sha256 = hashlib.sha256(data).hexdigest()
+    asset_name = sha256 + os.path.splitext(filename)[1]
+    asset_dir = asset_dir_for(sim_dir)
+    asset = os.path.join(asset_dir, asset_name)
+    if not os.path.exists(asset):
+        os.makedirs(asset_dir, exist_ok=True)
+        # several processes/threads may create the same asset, each writes its own part file
+        partial = '%s.%d.%d.part' % (asset, os.getpid(), threading.get_ident())
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.chmod(partial, 0o444)
+        os.replace(partial, asset)
+    link_name = os.path.join(sim_dir, filename)
+    temporary = link_name + '.dedup'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.symlink(os.path.join(os.pardir, ASSET_DIRNAME, asset_name), temporary)
+    os.replace(temporary, link_name)
+    return sha256
+
+
+def linked_asset_sha256(path):
+    # the sha256 of the asset path links to, or None if it is not a link into an asset directory
+    if not os.path.islink(path):
+        return None
+    target = os.readlink(path)
+    if os.path.basename(os.path.dirname(target)) != ASSET_DIRNAME:
+        return None
+    return os.path.splitext(os.path.basename(target))[0]
+
+
+def write_manifest(sim_dirs, manifest_name):
+    """
+    Records the asset every deduplicated input of sim_dirs links to (read from the links, the files are not read).
+    The manifest is written to the asset directory of the first simulation. Returns the manifest filename.
+    """
+    manifest = {}
+    for sim_dir in sim_dirs:
+        sim_manifest = {}
+        for filename in sorted(os.listdir(sim_dir)):
+            sha256 = linked_asset_sha256(os.path.join(sim_dir, filename))
+            if sha256 is not None:
+                sim_manifest[filename] = sha256
+        manifest[os.path.abspath(sim_dir)] = sim_manifest
+    if not manifest:
+        return None
+
+    asset_dir = asset_dir_for(sim_dirs[0])
+    os.makedirs(asset_dir, exist_ok=True)
+    manifest_filename = os.path.join(asset_dir, MANIFEST_FILENAME % manifest_name)
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    n_files = sum(len(sim_manifest) for sim_manifest in manifest.values())
+    n_unique = len(set(sha256 for sim_manifest in manifest.values() for sha256 in sim_manifest.values()))
+    print('%d input file(s) of %d simulation(s) are stored as %d shared file(s) in %s' %
+          (n_files, len(manifest), n_unique, asset_dir))
+    return manifest_filename
+
+
+def verify_manifest(manifest_filename):
+    # returns a list of (sim_dir, filename, problem) for every input that no longer matches the manifest
+    with open(manifest_filename) as f:
+        manifest = json.load(f)
+    problems = []
+    for sim_dir, sim_manifest in manifest.items():
+        for filename, sha256 in sim_manifest.items():
+            path = os.path.join(sim_dir, filename)
+            if not os.path.exists(path):
+                problems.append((sim_dir, filename, 'missing'))
+            elif file_sha256(path) != sha256:
+                problems.append((sim_dir, filename, 'content does not match manifest'))
+    return problems
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['verify'], help='Action to perform.')
+    parser.add_argument('manifest', type=str, help='Manifest json written during deduplication.')
+    script_args = parser.parse_args()
+
+    found_problems = verify_manifest(script_args.manifest)
+    for sim_dir, filename, problem in found_problems:
+        print('%s: %s: %s' % (sim_dir, filename, problem))
+    print('%d problem(s) found.' % len(found_problems))
+    sys.exit(1 if found_problems else 0)
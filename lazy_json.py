@@ -0,0 +1,284 @@
+import copy
+import json
+import mmap
+import re
+import time
+import tracemalloc
+
+import numpy as np
+
+from template_index import DEFAULT_TAG, TemplatePathIndex, copy_on_write_set
+
+# Memory-mapped, lazily parsed template json (e.g. large demographics files). On first load the file is scanned (with
+# numpy, not the json parser) for the tag's marker keys, e.g. "Initial_Distribution__KP_Risk_Homa_Bay": "<-- MARKER",
+# and the byte range of the json object containing each marker is recorded. Loading the file and setting parameters
+# only ever parses those objects; everything else stays in the memory map.
+#
+# Per simulation, reset() and set_param() work like IndexedTemplateMixin (copy-on-write over pristine parsed
+# objects). document() returns the Python objects dtk's config builder serializes, which is how simulation inputs are
+# written: the whole file is parsed once, when the first simulation is written, kept, and shared by all simulations
+# (and all copies of the document). Writing is therefore no cheaper than with an eager template, and from then on the
+# parsed document is resident; the savings are in loading and in runs that write no simulation (e.g. everything
+# already done with --incremental). close() releases the memory map and the parsed objects once no more simulations
+# are written.
+#
+# Compare parse time and memory with json.load, e.g.
+# python lazy_json.py InputFiles/Static/Demographics.json
+
+BLOCK_SIZE = 1 << 20  # bytes scanned at a time
+
+
+def structure_outside_strings(data, block_size=BLOCK_SIZE):
+    """
+    Returns the positions of the {, }, [ and ] characters of data (bytes-like) that are not inside json strings, and
+    the nesting depth after each of them. data is scanned block by block, so memory use does not grow with its size.
+    """
+    array = np.frombuffer(data, dtype=np.uint8)  # a view, nothing is copied
+    brace_blocks = []
+    step_blocks = []
+    n_quotes = 0  # unescaped quotes before the current block
+    for start in range(0, len(array), block_size):
+        block = array[start:start + block_size]
+        quotes = np.flatnonzero(block == ord('"')) + start
+        # a quote preceded by an odd number of backslashes is escaped (rare, checked one by one)
+        escaped = np.zeros(len(quotes), dtype=bool)
+        for i in np.flatnonzero(array[np.maximum(quotes - 1, 0)] == ord('\\')):
+            n_backslashes = 0
+            position = quotes[i] - 1
+            while position >= 0 and array[position] == ord('\\'):
+                n_backslashes += 1
+                position -= 1
+            escaped[i] = n_backslashes % 2 == 1
+        quotes = quotes[~escaped]
+
+        opening = (block == ord('{')) | (block == ord('['))
+        closing = (block == ord('}')) | (block == ord(']'))
+        braces = np.flatnonzero(opening | closing)
+        steps = np.where(opening[braces], 1, -1).astype(np.int8)
+        braces += start
+        # a brace is inside a string if an odd number of (unescaped) quotes precede it
+        outside = (n_quotes + np.searchsorted(quotes, braces)) % 2 == 0
+        brace_blocks.append(braces[outside])
+        step_blocks.append(steps[outside])
+        n_quotes += len(quotes)
+    return np.concatenate(brace_blocks), np.cumsum(np.concatenate(step_blocks), dtype=np.int64)
+
+
+class LazyJsonDocument(object):
+    def __init__(self, filename, tag=DEFAULT_TAG):
+        self.filename = filename
+        self.tag = tag
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.spans = self._find_tagged_spans()  # [(start, end)] byte ranges of the objects containing markers
+        self._parsed = {}  # span -> (pristine object, TemplatePathIndex)
+        # the whole document and the paths of the spans in it, parsed when first needed by document(). Like _parsed,
+        # shared with the copies made by __deepcopy__, so the file is parsed once however often it is copied.
+        self._whole = {'document': None, 'span_paths': None}
+        self.reset()
+
+    def _find_tagged_spans(self):
+        marker_regex = re.compile(rb'"[^"\\]*' + re.escape(self.tag.encode()) + rb'[^"\\]*"\s*:')
+        markers = [match.start() for match in marker_regex.finditer(self.data)]
+        if not markers:
+            return []
+        braces, depths = structure_outside_strings(self.data)
+        spans = []
+        for marker in markers:
+            k = np.searchsorted(braces, marker) - 1  # last brace before the marker, the marker is at depth depths[k]
+            depth = depths[k]
+            while not (depths[k] == depth and self.data[braces[k]] == ord('{')):  # back to its opening brace
+                k -= 1
+            start = int(braces[k])
+            # the matching closing brace is the first one after the marker that returns to depth - 1
+            after = np.flatnonzero((braces > marker) & (depths == depth - 1))
+            spans.append((start, int(braces[after[0]]) + 1))
+        # keep only the outermost of nested spans
+        outermost = []
+        for start, end in sorted(set(spans)):
+            if outermost and start < outermost[-1][1]:
+                continue
+            outermost.append((start, end))
+        return outermost
+
+    def _span(self, span):
+        if span not in self._parsed:
+            start, end = span
+            value = json.loads(self.data[start:end])
+            self._parsed[span] = (value, TemplatePathIndex(value, tag=self.tag))
+        return self._parsed[span]
+
+    def parse_tagged_objects(self):
+        for span in self.spans:
+            self._span(span)
+
+    def __deepcopy__(self, memo):
+        # copies share the memory map and the (never modified) pristine tagged objects
+        clone = copy.copy(self)
+        clone.reset()
+        return clone
+
+    def reset(self):
+        self.current = {}  # span -> this simulation's copy of the tagged object
+        self._copied = set()
+
+    def _expand(self, param):
+        # [(span, path)] of a tagged parameter; only tagged parameters can be set, the rest of the document is not indexed
+        if self.tag not in param.split('.')[0]:
+            return []
+        return [(span, path) for span in self.spans for path in self._span(span)[1].expand(param)]
+
+    def has_param(self, param):
+        return len(self._expand(param)) > 0
+
+    def set_param(self, param, value):
+        # returns the number of locations set, 0 if param is not a tagged parameter of this document
+        locations = self._expand(param)
+        for span, path in locations:
+            if span not in self.current:
+                self.current[span] = self._span(span)[0].copy()
+                self._copied.add(id(self.current[span]))
+            copy_on_write_set(self.current[span], path, value, self._copied)
+        return len(locations)
+
+    def _find_span_paths(self, document):
+        # the path of each tagged span in the parsed document: the outermost objects that directly hold a marker, in
+        # document order (the order of self.spans)
+        paths = []
+
+        def walk(node, path):
+            if isinstance(node, dict):
+                if any(self.tag in key for key in node):
+                    paths.append(path)
+                    return
+                for key, value in node.items():
+                    walk(value, path + (key,))
+            elif isinstance(node, list):
+                for i, value in enumerate(node):
+                    walk(value, path + (i,))
+        walk(document, ())
+        if len(paths) != len(self.spans):
+            raise ValueError('Found %d tagged objects in %s when parsed, %d when scanned' %
+                             (len(paths), self.filename, len(self.spans)))
+        return paths
+
+    def document(self):
+        """
+        This simulation's document as Python objects (what dtk's config builder serializes). The untouched parts are
+        parsed once and shared between simulations; only the containers on the way to changed tagged objects are
+        copied.
+        """
+        if self._whole['document'] is None:
+            document = json.loads(self.data[:])
+            self._whole.update(document=document, span_paths=self._find_span_paths(document))
+        if not self.current:
+            return self._whole['document']
+        document = self._whole['document'].copy()
+        copied = {id(document)}
+        for span, path in zip(self.spans, self._whole['span_paths']):
+            if span not in self.current:
+                continue
+            if not path:  # the whole document is the tagged object
+                return self.current[span]
+            copy_on_write_set(document, path, self.current[span], copied)
+        return document
+
+    def close(self):
+        # for this document and all its copies
+        self._parsed.clear()
+        self._whole.update(document=None, span_paths=None)
+        self.data.close()
+
+
+class LazyTemplateMixin(object):
+    """
+    Mixed in before a dtk template class (see lazy_template). Tagged parameters are set in the LazyJsonDocument and
+    get_contents()/contents return the simulation's document as Python objects, like the eager template does.
+    """
+    def reset(self):
+        self.lazy_document.reset()
+
+    def close(self):
+        self.lazy_document.close()
+
+    def has_param(self, param):
+        return self.lazy_document.has_param(param)
+
+    def set_param(self, param, value, *args, **kwargs):
+        if self.lazy_document.set_param(param, value) == 0:
+            raise KeyError('%s is not a tagged parameter of %s' % (param, self.filename))
+        return [param]
+
+    def get_contents(self):
+        return self.lazy_document.document()
+
+    @property
+    def contents(self):
+        if 'lazy_document' not in self.__dict__:  # while the template class's __init__ runs
+            return self.__dict__.get('_initial_contents')
+        return self.lazy_document.document()
+
+    @contents.setter
+    def contents(self, value):
+        if 'lazy_document' in self.__dict__:
+            raise AttributeError('The contents of lazily loaded template %s can only be changed with set_param' %
+                                 self.filename)
+        self.__dict__['_initial_contents'] = value
+
+
+_lazy_classes = {}
+
+
+def lazy_template(template_cls, filename, tag=DEFAULT_TAG):
+    """
+    Loads filename as a template of class template_cls (e.g. DemographicsTemplate) without parsing the whole file.
+    The class's __init__(filename, contents) runs with empty contents, so the attributes it sets exist.
+    """
+    if template_cls not in _lazy_classes:
+        _lazy_classes[template_cls] = type('Lazy' + template_cls.__name__, (LazyTemplateMixin, template_cls), {})
+    lazy_cls = _lazy_classes[template_cls]
+    template = lazy_cls.__new__(lazy_cls)
+    template_cls.__init__(template, filename, {})
+    template.filename = filename
+    template.lazy_document = LazyJsonDocument(filename, tag=tag)
+    return template
+
+
+def close_lazy_templates(scenario_template_sets):
+    # once no more simulations are written: releases the lazily loaded templates of all template sets
+    for template_set in scenario_template_sets.values():
+        for templates in template_set.values():
+            for template in templates.values() if isinstance(templates, dict) else templates:
+                if isinstance(template, LazyTemplateMixin):
+                    template.close()
+
+
+def measure_load(filename, tag=DEFAULT_TAG):
+    # (seconds, peak traced bytes) to load filename with json.load and as a LazyJsonDocument
+    results = []
+    def load_lazy():
+        document = LazyJsonDocument(filename, tag=tag)
+        document.parse_tagged_objects()
+        return document
+
+    for load in [lambda: json.load(open(filename)), load_lazy]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        document = load()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append((elapsed, peak))
+        del document
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, help='Template json file.')
+    script_args = parser.parse_args()
+
+    (json_time, json_peak), (lazy_time, lazy_peak) = measure_load(script_args.filename)
+    print('json.load: %.1f ms, %.1f MB peak; lazy: %.1f ms, %.1f MB peak' %
+          (json_time * 1000, json_peak / 1e6, lazy_time * 1000, lazy_peak / 1e6))
@@ -0,0 +1,352 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from output_reduction import AGE_BIN_COLUMN, PROVINCE_COLUMN, find_reduced_basenames
+from scenario_outputs import DEFAULT_REPORT_BASENAME, REP_TAG, SCENARIO_COLUMN, TPI_TAG, iter_report_files
+
+# Batch likelihood scoring of scenario simulations against the ingest form's reference data (reference_info in the
+# calibration script), one score per analyzer of the form's Analyzers sheet. The reports of a batch of simulations are
+# loaded into one array (simulations x fine strata x report columns), the fine strata (year, province, gender, age)
+# are mapped onto the reference rows of every analyzer with one sparse membership matrix, and the log-likelihood of
+# every reference row is computed for all simulations of the batch at once:
+# - Beta analyzers (ratio channels, e.g. Prevalence): beta-binomial likelihood of the observed proportion in
+#   effective_count samples, given the simulated numerator/denominator.
+# - Gaussian analyzers (count channels, e.g. Population, OnART): normal likelihood of the observed count with a standard
+#   deviation of two_sigma / 2, given the simulated count divided by the population scale factor of the simulations.
+# Each row's log-likelihood is multiplied by its weight (blank weights are 1). Every analyzer gets a column with the sum
+# over its rows, and the total is the sum of the analyzer columns times the analyzers' weights.
+#
+# Within a year, stock columns (people alive, infected, on ART) are averaged over the report's time steps and flow
+# columns (new infections) are summed; reference years like 2004.5 match the report year 2004. Provincial analyzers use
+# the reference rows of single provinces, non-provincial ones the rows with Province 'All'. Rows with Gender 'Both'
+# cover both genders.
+#
+# python likelihood_scoring.py -c optim_script.py -i Calibrated_RSA_Scenarios -o scenario_likelihoods.csv
+
+DEFAULT_OUTPUT_FILENAME = 'scenario_likelihoods.csv'
+DEFAULT_BATCH_SIZE = 500
+TOTAL_COLUMN = 'total'
+
+ALL_PROVINCES = 'All'
+BOTH_GENDERS = 'Both'
+GENDER_NAMES = {0: 'Male', 1: 'Female'}
+
+BETA = 'beta'
+GAUSSIAN = 'gaussian'
+PROVINCIAL = 'provincial'
+NON_PROVINCIAL = 'nonprovincial'
+ALL_MATCHING_AGE_BINS = 'allmatching'
+
+# ratio channel -> (numerator, denominator) report columns; Susceptible is Population - Infected
+CHANNEL_RATIOS = {
+    'Prevalence': ('Infected', 'Population'),
+    'ARTCoverage': ('On_ART', 'Infected'),
+    'Incidence': ('Newly Infected', 'Susceptible')
+}
+# count channel -> report column, scaled by the population scale factor
+CHANNEL_COUNTS = {
+    'Population': 'Population',
+    'OnART': 'On_ART'
+}
+STOCK_COLUMNS = ['Population', 'Infected', 'On_ART']
+FLOW_COLUMNS = ['Newly Infected']
+STRATUM_COLUMNS = ['Year', PROVINCE_COLUMN, 'Gender', 'AgeLow', 'AgeHigh']
+AGE_BIN_REGEX = re.compile(r'^\[(?P<low>[\d.]+):(?P<high>[\d.]+)\)$')
+
+
+def normalized(value):
+    # 'Non-provincial' -> 'nonprovincial', 'Age bins' -> 'agebins'
+    return re.sub(r'[^a-z0-9]', '', str(value).lower())
+
+
+def parse_age_bin(label):
+    match = AGE_BIN_REGEX.match(str(label))
+    if match is None:
+        raise ValueError('Unrecognized age bin: %s (expected e.g. [15:50) )' % label)
+    return float(match.group('low')), float(match.group('high'))
+
+
+def reference_frame(reference):
+    # the reference data as a DataFrame, from a PopulationObs object or anything DataFrame-like
+    if isinstance(reference, pd.DataFrame):
+        return reference.reset_index()
+    if hasattr(reference, '_dataframe'):
+        return reference._dataframe.reset_index()
+    return pd.DataFrame(reference).reset_index()
+
+
+def reference_column(reference, channel, name):
+    # one of the Obs sheet's additional columns (weight, effective_count, two_sigma) for a channel, or None
+    for column in ['%s--%s' % (channel, name), '%s_%s' % (channel, name), name]:
+        if column in reference.columns:
+            return reference[column]
+    return None
+
+
+def beta_binomial_log_likelihood(observed, effective_count, numerator, denominator):
+    """
+    Log-likelihood of observing proportion observed in effective_count samples, given the simulated counts
+    numerator/denominator (beta posterior with a uniform prior). Arrays broadcast: reference rows against
+    (simulations x reference rows).
+    """
+    from scipy.special import gammaln
+
+    k = observed * effective_count
+    n = effective_count
+    alpha = numerator + 1.0
+    beta = np.maximum(denominator - numerator, 0) + 1.0
+    return (gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1) +
+            gammaln(k + alpha) + gammaln(n - k + beta) - gammaln(n + alpha + beta) +
+            gammaln(alpha + beta) - gammaln(alpha) - gammaln(beta))
+
+
+def gaussian_log_likelihood(observed, sigma, simulated):
+    # normal log-density of observed around simulated; broadcasts like beta_binomial_log_likelihood
+    return -0.5 * ((observed - simulated) / sigma) ** 2 - np.log(sigma * np.sqrt(2 * np.pi))
+
+
+def fine_strata_frame(report, node_map):
+    """
+    One row per (year, province, gender, age interval) of a ReportHIVByAgeAndGender(_reduced) report with the yearly
+    stock averages and flow sums. Full reports give points (AgeLow == AgeHigh), reduced ones their age bins.
+    """
+    report = report.copy()
+    if PROVINCE_COLUMN not in report.columns:
+        report[PROVINCE_COLUMN] = report['NodeId'].map(node_map)
+    if AGE_BIN_COLUMN in report.columns:
+        bins = report[AGE_BIN_COLUMN].map(parse_age_bin)
+        report['AgeLow'] = [low for low, _ in bins]
+        report['AgeHigh'] = [high for _, high in bins]
+    else:
+        report['AgeLow'] = report['AgeHigh'] = report['Age'].astype(float)
+    report['Gender'] = report['Gender'].map(lambda g: GENDER_NAMES.get(g, g))
+
+    time_steps = report.groupby(np.floor(report['Year']))['Year'].nunique()
+    report['Year'] = np.floor(report['Year']).astype(int)
+    columns = [c for c in STOCK_COLUMNS + FLOW_COLUMNS if c in report.columns]
+    fine = report.groupby(STRATUM_COLUMNS, observed=True)[columns].sum()
+    stocks = [c for c in STOCK_COLUMNS if c in columns]
+    fine[stocks] = fine[stocks].div(time_steps.reindex(fine.index.get_level_values('Year')).to_numpy(), axis=0)
+    if 'Population' in fine.columns and 'Infected' in fine.columns:
+        fine['Susceptible'] = fine['Population'] - fine['Infected']
+    return fine
+
+
+class ReferenceAnalyzer(object):
+    """
+    One analyzer of the ingest form (a dict of analyzer arguments: channel, distribution, provinciality, age bins,
+    weight; keys are matched ignoring case, spaces and underscores) and the reference rows it scores.
+    """
+
+    def __init__(self, arguments, reference):
+        values = {normalized(key): value for key, value in arguments.items()}
+        self.channel = values['channel']
+        if self.channel not in CHANNEL_RATIOS and self.channel not in CHANNEL_COUNTS:
+            raise ValueError('No report columns are known for channel %s (known channels: %s)' %
+                             (self.channel, ', '.join(sorted(list(CHANNEL_RATIOS) + list(CHANNEL_COUNTS)))))
+        self.distribution = normalized(values.get('distribution', BETA))
+        if self.distribution not in (BETA, GAUSSIAN):
+            raise ValueError('Unknown distribution %s for channel %s' % (values['distribution'], self.channel))
+        if self.distribution == BETA and self.channel not in CHANNEL_RATIOS:
+            raise ValueError('Channel %s is a count, it cannot be scored with a Beta distribution' % self.channel)
+        provinciality = values.get('provinciality', values.get('provincial', PROVINCIAL))
+        self.provincial = (provinciality if isinstance(provinciality, bool)
+                           else normalized(provinciality) == PROVINCIAL)
+        age_bins = values.get('agebins', ALL_MATCHING_AGE_BINS)
+        if isinstance(age_bins, str) and normalized(age_bins) == 'custom':
+            age_bins = values.get('customagebins')
+        if isinstance(age_bins, str):
+            age_bins = (None if normalized(age_bins) == ALL_MATCHING_AGE_BINS
+                        else re.findall(r'\[[\d.]+:[\d.]+\)', age_bins))
+        self.age_bins = None if age_bins is None else list(age_bins)
+        self.weight = float(values.get('weight', 1.0))
+        self.name = '%s_%s' % (self.channel, PROVINCIAL if self.provincial else NON_PROVINCIAL)
+
+        rows = reference[reference[self.channel].notna()] if self.channel in reference.columns else reference[:0]
+        if PROVINCE_COLUMN in rows.columns:
+            all_provinces = rows[PROVINCE_COLUMN] == ALL_PROVINCES
+            rows = rows[~all_provinces if self.provincial else all_provinces]
+        if self.age_bins is not None:
+            rows = rows[rows[AGE_BIN_COLUMN].isin(self.age_bins)]
+        if rows.empty:
+            print('Analyzer %s has no reference rows' % self.name)
+        self.rows = rows
+        self.observed = rows[self.channel].to_numpy(dtype=np.float64)
+
+        row_weights = reference_column(rows, self.channel, 'weight')
+        self.row_weights = (np.ones(len(rows)) if row_weights is None
+                            else row_weights.fillna(1.0).to_numpy(dtype=np.float64))
+        parameter_name = 'effective_count' if self.distribution == BETA else 'two_sigma'
+        parameter = reference_column(rows, self.channel, parameter_name)
+        if parameter is None or parameter.isna().any():
+            raise ValueError('Analyzer %s needs a %s for every reference row' % (self.name, parameter_name))
+        # effective counts for Beta, standard deviations for Gaussian
+        self.parameter = parameter.to_numpy(dtype=np.float64) / (1.0 if self.distribution == BETA else 2.0)
+
+
+class LikelihoodScorer(object):
+    def __init__(self, reference, analyzers, node_map, scale_factor=1.0):
+        # scale_factor is the simulations' Base_Population_Scale_Factor: simulated counts are divided by it
+        self.reference = reference_frame(reference)
+        self.analyzers = [ReferenceAnalyzer(arguments, self.reference) for arguments in analyzers]
+        names = [analyzer.name for analyzer in self.analyzers]
+        for i, analyzer in enumerate(self.analyzers):
+            if names.count(analyzer.name) > 1:
+                analyzer.name += '_%d' % (names[:i].count(analyzer.name) + 1)
+        self.node_map = {int(node_id): name for node_id, name in node_map.items()}
+        self.scale_factor = float(scale_factor)
+        self.strata = None  # fine strata index, from the first report
+        self.membership = None
+
+        # the reference rows of all analyzers side by side, analyzer i scores the columns slices[i]
+        self.slices = []
+        start = 0
+        for analyzer in self.analyzers:
+            self.slices.append(slice(start, start + len(analyzer.rows)))
+            start += len(analyzer.rows)
+        self.n_rows = start
+
+    def _build_membership(self, strata):
+        # sparse (fine strata x reference rows) 0/1 matrix
+        from scipy.sparse import csr_matrix
+
+        years = strata.get_level_values('Year').to_numpy()
+        provinces = strata.get_level_values(PROVINCE_COLUMN).to_numpy()
+        genders = strata.get_level_values('Gender').to_numpy()
+        age_low = strata.get_level_values('AgeLow').to_numpy()
+        age_high = strata.get_level_values('AgeHigh').to_numpy()
+        stratum_indices, row_indices = [], []
+        j = 0
+        for analyzer in self.analyzers:
+            for _, row in analyzer.rows.iterrows():
+                member = years == int(np.floor(float(row['Year'])))
+                if PROVINCE_COLUMN in row.index and row[PROVINCE_COLUMN] != ALL_PROVINCES:
+                    member &= provinces == row[PROVINCE_COLUMN]
+                if 'Gender' in row.index and row['Gender'] != BOTH_GENDERS:
+                    member &= genders == row['Gender']
+                if AGE_BIN_COLUMN in row.index:
+                    low, high = parse_age_bin(row[AGE_BIN_COLUMN])
+                    member &= (age_low >= low) & (age_high <= high) & (age_low < high)
+                members = np.flatnonzero(member)
+                if len(members) == 0:
+                    raise ValueError('The reports have no strata within the %s reference row %s (reduced reports '
+                                     'need age bins that nest in the reference age bins)' %
+                                     (analyzer.name, ', '.join(str(row[c]) for c in row.index if c in
+                                                               ['Year', PROVINCE_COLUMN, 'Gender', AGE_BIN_COLUMN])))
+                stratum_indices.extend(members)
+                row_indices.extend([j] * len(members))
+                j += 1
+        return csr_matrix((np.ones(len(stratum_indices)), (stratum_indices, row_indices)),
+                          shape=(len(strata), self.n_rows))
+
+    def load_batch(self, filenames):
+        # (simulations x fine strata x columns) array of the reports, aligned on the first report's strata
+        frames = [fine_strata_frame(pd.read_csv(filename), self.node_map) for filename in filenames]
+        if self.strata is None:
+            self.strata = frames[0].index
+            self.columns = list(frames[0].columns)
+            self.membership = self._build_membership(self.strata)
+        return np.stack([frame.reindex(index=self.strata, columns=self.columns, fill_value=0).to_numpy()
+                         for frame in frames])
+
+    def score(self, values):
+        # (simulations x reference rows) weighted log-likelihoods of a loaded batch
+        sums = {}
+
+        def simulated(column, rows):
+            # (simulations x rows) sums of a report column over each reference row's strata
+            if column not in sums:
+                sums[column] = (self.membership.T @ values[:, :, self.columns.index(column)].T).T
+            return sums[column][:, rows]
+
+        log_likelihoods = np.zeros((values.shape[0], self.n_rows))
+        for analyzer, rows in zip(self.analyzers, self.slices):
+            if analyzer.channel in CHANNEL_RATIOS:
+                numerator_column, denominator_column = CHANNEL_RATIOS[analyzer.channel]
+                numerator, denominator = simulated(numerator_column, rows), simulated(denominator_column, rows)
+                if analyzer.distribution == BETA:
+                    log_likelihood = beta_binomial_log_likelihood(analyzer.observed, analyzer.parameter,
+                                                                  numerator, denominator)
+                else:
+                    ratio = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+                    log_likelihood = gaussian_log_likelihood(analyzer.observed, analyzer.parameter, ratio)
+            else:
+                count = simulated(CHANNEL_COUNTS[analyzer.channel], rows) / self.scale_factor
+                log_likelihood = gaussian_log_likelihood(analyzer.observed, analyzer.parameter, count)
+            log_likelihoods[:, rows] = log_likelihood * analyzer.row_weights
+        return log_likelihoods
+
+    def score_files(self, keys, filenames, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Returns a DataFrame with one row per simulation: its keys (dicts) plus the log-likelihood of each analyzer and
+        their weighted total.
+        """
+        tables = []
+        for start in range(0, len(filenames), batch_size):
+            log_likelihoods = self.score(self.load_batch(filenames[start:start + batch_size]))
+            table = pd.DataFrame(keys[start:start + batch_size])
+            table[TOTAL_COLUMN] = 0.0
+            for analyzer, rows in zip(self.analyzers, self.slices):
+                table[analyzer.name] = log_likelihoods[:, rows].sum(axis=1)
+                table[TOTAL_COLUMN] += analyzer.weight * table[analyzer.name]
+            tables.append(table[[c for c in table.columns if c != TOTAL_COLUMN] + [TOTAL_COLUMN]])
+        return pd.concat(tables, ignore_index=True)
+
+
+def score_output_directory(scorer, output_path, report_basename=DEFAULT_REPORT_BASENAME,
+                           batch_size=DEFAULT_BATCH_SIZE):
+    keys, filenames = [], []
+    for scenario, parameterization_id, run_number, filename in iter_report_files(output_path, report_basename):
+        keys.append({SCENARIO_COLUMN: scenario, TPI_TAG: parameterization_id, REP_TAG: run_number})
+        filenames.append(filename)
+    if not filenames:
+        raise FileNotFoundError('No %s reports found in %s' % (report_basename, output_path))
+    return scorer.score_files(keys, filenames, batch_size=batch_size)
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--calib-script', dest='calibration_script', type=str, required=True,
+                        help='Calibration script providing the reference data (reference_info) (Required).')
+    parser.add_argument('-i', '--input-dir', dest='output_path', type=str, required=True,
+                        help='Directory of downloaded scenario reports, as written by run_scenarios.py (Required).')
+    parser.add_argument('-o', '--output', dest='output_filename', type=str, default=DEFAULT_OUTPUT_FILENAME,
+                        help='csv file to write the likelihood table to (Default: %s).' % DEFAULT_OUTPUT_FILENAME)
+    parser.add_argument('--reduced', dest='reduced', action='store_true',
+                        help='Score the reports reduced by run_scenarios.py --reduce (Default: full reports).')
+    parser.add_argument('--scale-factor', dest='scale_factor', type=float, default=None,
+                        help='Base_Population_Scale_Factor of the simulations, simulated counts are divided by it '
+                             '(Default: the calibration script\'s BASE_POPULATION_SCALE_FACTOR).')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Simulations scored per vectorized batch (Default: %d).' % DEFAULT_BATCH_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import time
+    from simtools.Utilities.Initialization import load_config_module
+
+    script_args = parse_args()
+    calibration_module = load_config_module(script_args.calibration_script)
+    reference_info = calibration_module.run_calib_args['reference_info']
+    scale_factor = script_args.scale_factor
+    if scale_factor is None:
+        scale_factor = getattr(calibration_module, 'BASE_POPULATION_SCALE_FACTOR', 1.0)
+    likelihood_scorer = LikelihoodScorer(reference_info['reference'], analyzers=reference_info['analyzers'],
+                                         node_map=reference_info['site_info']['node_map'], scale_factor=scale_factor)
+    report_basename = DEFAULT_REPORT_BASENAME
+    if script_args.reduced:
+        reduced_basenames = find_reduced_basenames(script_args.output_path)
+        if len(reduced_basenames) != 1:
+            raise ValueError('Expected the reports of one reduction in %s, found: %s' %
+                             (script_args.output_path, ', '.join(reduced_basenames) or 'none'))
+        report_basename = reduced_basenames[0]
+    start_time = time.time()
+    likelihoods = score_output_directory(likelihood_scorer, script_args.output_path, report_basename=report_basename,
+                                         batch_size=script_args.batch_size)
+    likelihoods.to_csv(script_args.output_filename, index=False)
+    print('Scored %d simulation(s) in %.1f s, likelihoods written to %s' %
+          (len(likelihoods), time.time() - start_time, script_args.output_filename))
@@ -0,0 +1,168 @@
+import atexit
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from slurm_bundles import (DEFAULT_BUNDLE_COMMAND, FINAL_STATES, STATE_FAILED, STATE_QUEUED, BundledExperimentManager,
+                           absolute_paths, current_owner, owner_is_alive, read_status, run_simulation,
+                           stop_running_simulations, write_status)
+
+# Runs the generated simulation directories of a suite on the local machine instead of submitting them to Slurm: a
+# bounded pool runs at most max_workers simulations (processes) at once, each with an optional timeout and a number of
+# retries. Simulation progress goes through the same status files as Slurm bundles, so the returned
+# BundledExperimentManager wrappers work with run_scenarios.analyze_experiments and the downloads of -id SUITE_ID.
+#
+# Enabled by execution_backend = local_pool in the simtools.ini block (see [LOCAL_POOL]). The command run in each
+# simulation directory is pool_command, so a stub executable can stand in for Eradication, e.g.
+# exe_path = python /path/to/tutorial/stub_eradication.py
+#
+# The simulations run in their own process groups. When this process exits or is interrupted, the running ones are
+# killed and put back in the queued state; the status files record which process owns a simulation, so resuming the
+# suite with -id runs the queued ones again but leaves those of a process that is still running alone.
+
+LOCAL_POOL_BACKEND = 'local_pool'
+
+
+def default_pool_size():
+    return os.cpu_count() or 1
+
+
+_exit_hook_registered = False
+
+
+def stop_simulations_at_exit():
+    # Thread pool workers are joined before atexit handlers run, so the hook goes with them where possible; otherwise
+    # exiting would wait for every running simulation.
+    global _exit_hook_registered
+    if not _exit_hook_registered:
+        getattr(threading, '_register_atexit', atexit.register)(stop_running_simulations)
+        _exit_hook_registered = True
+
+
+class ProgressCounter(object):
+    # thread-safe count of finished simulations, printed on one updating line (one line per update when not a tty)
+    def __init__(self, total, stream=None):
+        self.total = total
+        self.stream = stream or sys.stdout
+        self.n_running = 0
+        self.n_succeeded = 0
+        self.n_failed = 0
+        self.lock = threading.Lock()
+
+    def started(self):
+        with self.lock:
+            self.n_running += 1
+            self.show()
+
+    def finished(self, state):
+        with self.lock:
+            self.n_running -= 1
+            if state == STATE_FAILED:
+                self.n_failed += 1
+            else:
+                self.n_succeeded += 1
+            self.show()
+
+    def show(self):
+        n_done = self.n_succeeded + self.n_failed
+        line = 'Local pool: %d/%d done (%d failed), %d running' % (n_done, self.total, self.n_failed, self.n_running)
+        if self.stream.isatty():
+            self.stream.write('\r' + line + ('\n' if n_done == self.total else ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+class LocalPool(object):
+    def __init__(self, command, max_workers=None, timeout=None, retries=0):
+        # command is formatted with {sim_dir} and {sim_name} for each simulation
+        self.command = command
+        self.max_workers = max_workers or default_pool_size()
+        self.timeout = timeout
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)  # each worker waits on one simulation process
+        self.futures = []
+        self.progress = None
+        self.owner = current_owner()
+
+    def _run(self, sim_dir):
+        self.progress.started()
+        try:
+            state = run_simulation(sim_dir, self.command, timeout=self.timeout, retries=self.retries, owner=self.owner)
+        except Exception as e:
+            print('Could not run the simulation in %s: %s' % (sim_dir, e))
+            state = STATE_FAILED
+            write_status(sim_dir, state)
+        if state != STATE_QUEUED:  # not stopped
+            self.progress.finished(state)
+        return state
+
+    def submit(self, sim_dirs):
+        # queues the simulations and returns immediately, they run in the background
+        stop_simulations_at_exit()
+        for sim_dir in sim_dirs:
+            write_status(sim_dir, STATE_QUEUED, owner=self.owner)
+        self.progress = ProgressCounter(total=len(sim_dirs))
+        print('Running %d simulation(s) locally, %d at a time' % (len(sim_dirs), self.max_workers))
+        self.futures = [self.executor.submit(self._run, sim_dir) for sim_dir in sim_dirs]
+
+    def wait(self):
+        # returns the number of failed simulations
+        try:
+            states = [future.result() for future in self.futures]
+        except KeyboardInterrupt:
+            stop_running_simulations()
+            raise
+        self.executor.shutdown()
+        return states.count(STATE_FAILED)
+
+
+def run_on_local_pool(experiment_managers, command, max_workers=None, timeout=None, retries=0, rerun_finished=True):
+    """
+    Runs the (already created, not yet commissioned) simulations of the given experiment managers on a LocalPool.
+    With rerun_finished=False (e.g. resuming a suite with -id after the submitting process was stopped), simulations
+    whose status file already records a final state are skipped, and so are those still owned by a live process.
+    Returns the LocalPool and BundledExperimentManager wrappers for tracking the simulations.
+    """
+    sim_dirs = [simulation.get_path() for em in experiment_managers for simulation in em.experiment.simulations]
+    if not rerun_finished:
+        unfinished = [sim_dir for sim_dir in sim_dirs if read_status(sim_dir) not in FINAL_STATES]
+        sim_dirs = [sim_dir for sim_dir in unfinished if not owner_is_alive(sim_dir)]
+        if len(sim_dirs) < len(unfinished):
+            print('%d unfinished simulation(s) belong to a process that is still running, only tracking them' %
+                  (len(unfinished) - len(sim_dirs)))
+    pool = LocalPool(command, max_workers=max_workers, timeout=timeout, retries=retries)
+    pool.submit(sim_dirs)
+    return pool, [BundledExperimentManager(em) for em in experiment_managers]
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sim_dirs', type=str, nargs='+', help='Simulation directories to run.')
+    parser.add_argument('--command', dest='command', type=str, default=DEFAULT_BUNDLE_COMMAND,
+                        help='Command run in each simulation directory, formatted with {exe_path}, {input_root} and '
+                             '{sim_dir} (Default: %s).' % DEFAULT_BUNDLE_COMMAND)
+    parser.add_argument('--exe-path', dest='exe_path', type=str, required=True, help='Model executable (Required).')
+    parser.add_argument('--input-root', dest='input_root', type=str, default='.',
+                        help='Directory of the model input files (Default: .).')
+    parser.add_argument('--workers', dest='max_workers', type=int, default=None,
+                        help='Simulations run at once (Default: number of cores).')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=None,
+                        help='Seconds after which a simulation is stopped and counted as failed (Default: none).')
+    parser.add_argument('--retries', dest='retries', type=int, default=0,
+                        help='Times a failed simulation is run again (Default: 0).')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # runs simulation directories directly, e.g. to check a build or stub executable on a few generated simulations
+    script_args = parse_args()
+    local_pool = LocalPool(script_args.command.format(exe_path=absolute_paths(script_args.exe_path),
+                                                      input_root=absolute_paths(script_args.input_root),
+                                                      sim_dir='{sim_dir}', sim_name='{sim_name}'),
+                           max_workers=script_args.max_workers, timeout=script_args.timeout,
+                           retries=script_args.retries)
+    local_pool.submit([os.path.abspath(sim_dir) for sim_dir in script_args.sim_dirs])
+    sys.exit(1 if local_pool.wait() else 0)
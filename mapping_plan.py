@@ -0,0 +1,264 @@
+import json
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+# Declarative mapping of user (calibration) parameters to model (template) parameters. A plan is a list of
+# transforms, each a plain dict:
+#
+#   {'kind': <one of TRANSFORM_KINDS>, 'inputs': [user parameter, ...], 'outputs': [template path, ...]}
+#
+# with an optional 'shared': True. Transforms are applied in plan order. A transform applies when all of its inputs
+# are in the sample and none of them has been used by an earlier transform, unless it is shared (a shared input, e.g.
+# one value written for every province, may be used by several transforms in a row). Plans hold no code, so they can
+# be pickled to worker processes or saved as json.
+#
+# 'copy_unless_nan' leaves its outputs out of a sample's table when the input is NaN. In a batch table the outputs of
+# those rows hold MISSING, and table_records drops them again, so batch rows match single-sample tables key for key.
+#
+# compile_mapping_plan compiles the calibration script's plan. Time its single-sample and batch application with, e.g.
+# python mapping_plan.py resampled_parameter_sets_short.csv
+
+PLAN_VERSION = 1
+MISSING = object()  # placeholder in batch tables for outputs a sample does not have, see table_records
+NON_PARAMETER_COLUMNS = ['parameterization_id', 'iteration_number', 'sim_id', 'likelihood', 'run_number']
+
+
+def _copy(value):
+    return [value]
+
+
+def _ordered_pair(low, high):
+    return [low, high] if high > low else [high, low]
+
+
+def _young_old_multipliers(young, old):
+    return [[young, young, old]]
+
+
+def _risk_split(value):
+    return [[value, 1 - value, 0]]
+
+
+def _assortivity_matrix(v):
+    return [[[v, 1 - v, 0],
+             [1 - v, v, v],
+             [0, v, 1 - v]]]
+
+
+def _batch_ordered_pair(low, high):
+    swap = ~(high > low)
+    return [np.where(swap, high, low), np.where(swap, low, high)]
+
+
+def _batch_young_old_multipliers(young, old):
+    return [[[y, y, o] for y, o in zip(young, old)]]
+
+
+def _batch_risk_split(values):
+    return [[[v, 1 - v, 0] for v in values]]
+
+
+def _batch_assortivity_matrix(values):
+    return [[_assortivity_matrix(v)[0] for v in values]]
+
+
+# kind -> (single sample function, batch function). Each takes one value (or column) per input and returns one value
+# (or column) per output; 'copy' writes its input to every output.
+TRANSFORM_KINDS = {
+    'copy': (_copy, _copy),
+    'copy_unless_nan': (_copy, _copy),
+    'ordered_pair': (_ordered_pair, _batch_ordered_pair),
+    'young_old_multipliers': (_young_old_multipliers, _batch_young_old_multipliers),
+    'risk_split': (_risk_split, _batch_risk_split),
+    'assortivity_matrix': (_assortivity_matrix, _batch_assortivity_matrix)
+}
+
+
+def _is_nan(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+class MappingPlan(object):
+    def __init__(self, transforms):
+        for transform in transforms:
+            if transform['kind'] not in TRANSFORM_KINDS:
+                raise ValueError('Unknown mapping transform kind: %s' % transform['kind'])
+        self.transforms = transforms
+
+    def applicable_transforms(self, available):
+        # (transform, consumed inputs) pairs for the user parameters in available, in plan order
+        consumed = set()
+        applicable = []
+        for transform in self.transforms:
+            inputs = transform['inputs']
+            if not all(name in available for name in inputs):
+                continue
+            if not transform.get('shared', False) and any(name in consumed for name in inputs):
+                continue
+            consumed.update(inputs)
+            applicable.append(transform)
+        return applicable, [name for name in available if name not in consumed]
+
+    def apply(self, sample, table):
+        """
+        Writes the model parameters of one sample (a {user parameter: value} dict) into table. Returns the names of
+        the sample's parameters that no transform used.
+        """
+        transforms, unused = self.applicable_transforms(sample)
+        for transform in transforms:
+            values = [sample[name] for name in transform['inputs']]
+            if transform['kind'] == 'copy_unless_nan' and _is_nan(values[0]):
+                continue
+            results = TRANSFORM_KINDS[transform['kind']][0](*values)
+            self._write(table, transform, results)
+        return unused
+
+    def apply_batch(self, samples, table):
+        """
+        Batch version of apply: samples is a DataFrame with one column per user parameter and table a
+        {model parameter: column} dict. Returns the names of the columns that no transform used.
+        """
+        transforms, unused = self.applicable_transforms(list(samples.columns))
+        for transform in transforms:
+            columns = [samples[name].to_numpy() for name in transform['inputs']]
+            if transform['kind'] == 'copy_unless_nan':
+                missing = pd.isna(columns[0])
+                if missing.all():
+                    continue
+                if missing.any():
+                    column = columns[0].astype(object)
+                    column[missing] = MISSING
+                    columns = [column]
+            results = TRANSFORM_KINDS[transform['kind']][1](*columns)
+            self._write(table, transform, results)
+        return unused
+
+    @staticmethod
+    def _write(table, transform, results):
+        if len(results) == 1:
+            results = results * len(transform['outputs'])
+        for output, value in zip(transform['outputs'], results):
+            table[output] = value
+
+    def to_dict(self):
+        return {'version': PLAN_VERSION, 'transforms': self.transforms}
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError('Unsupported mapping plan version: %s' % data.get('version'))
+        return cls(data['transforms'])
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+
+def table_records(table, n_rows):
+    # one {model parameter: value} dict per row of a batch table, without the MISSING entries
+    columns = {name: column.tolist() if isinstance(column, np.ndarray) else list(column)
+               for name, column in table.items()}
+    return [{name: column[i] for name, column in columns.items() if column[i] is not MISSING} for i in range(n_rows)]
+
+
+def compile_mapping_plan(params, province_names):
+    """
+    Compiles the mapping of user parameters to model parameters into a MappingPlan: the special cases below first,
+    then every ingest parameter with a MapTo entry, in params order.
+    """
+    transforms = [
+        {'kind': 'copy', 'inputs': ['BaseInfectivity'], 'outputs': ['Base_Infectivity']},
+        {'kind': 'ordered_pair', 'inputs': ['PreARTLinkMin', 'PreARTLinkMax'],
+         'outputs': ['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Min',
+                     'Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Max']},
+        {'kind': 'young_old_multipliers', 'inputs': ['MaleToFemaleYoung', 'MaleToFemaleOld'],
+         'outputs': ['Male_To_Female_Relative_Infectivity_Multipliers']}
+    ]
+    for province in province_names:
+        transforms.append({'kind': 'risk_split', 'inputs': ['%sLOWRisk' % province],
+                           'outputs': ['Initial_Distribution__KP_Risk_%s' % province]})
+        for name, suffix in [('Risk Reduction Fraction', 'Ramp_Max'), ('Risk Ramp Rate', 'Ramp_Rate'),
+                             ('Risk Ramp MidYear', 'Ramp_MidYear')]:
+            # one value for every province
+            transforms.append({'kind': 'copy_unless_nan', 'inputs': [name], 'shared': True,
+                               'outputs': ['Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.%s' %
+                                           (province, suffix)]})
+    transforms.append({'kind': 'assortivity_matrix', 'inputs': ['RiskAssortivity'],
+                       'outputs': ['Weighting_Matrix_RowMale_ColumnFemale__KP_RiskAssortivity']})
+
+    for p in params:
+        if 'MapTo' in p:
+            transforms.append({'kind': 'copy', 'inputs': [p['Name']],
+                               'outputs': p['MapTo'] if isinstance(p['MapTo'], list) else [p['MapTo']]})
+    return MappingPlan(transforms)
+
+
+# The counties of the Nyanza site, the values of site_info['node_map'] in the ingest form
+NYANZA_PROVINCES = ['Homa_Bay', 'Kisii', 'Kisumu', 'Migori', 'Nyamira', 'Siaya']
+
+
+def columns_as_params(columns, province_names=NYANZA_PROVINCES):
+    """
+    Ingest-style params (as optim_script.load_ingest_data returns them) mapping every column of a parameter set that
+    has no special case in compile_mapping_plan to the model parameter of the same name. Lets parameter sets be
+    mapped without the ingest form, which needs dtk to parse.
+    """
+    special = {name for transform in compile_mapping_plan([], province_names).transforms
+               for name in transform['inputs']}
+    return [{'Name': name, 'MapTo': name} for name in columns
+            if name not in special and name not in NON_PARAMETER_COLUMNS]
+
+
+def benchmark(plan, samples, n_repeats=10):
+    # returns (seconds per single-sample pass over all rows, seconds per batch pass) and checks they agree
+    samples = samples.drop(columns=[c for c in NON_PARAMETER_COLUMNS if c in samples.columns])
+    records = samples.to_dict(orient='records')
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        single_tables = []
+        for record in records:
+            table = {}
+            plan.apply(record, table)
+            single_tables.append(table)
+    single_time = (time.perf_counter() - start) / n_repeats
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        batch_table = {}
+        plan.apply_batch(samples, batch_table)
+    batch_time = (time.perf_counter() - start) / n_repeats
+
+    batch_rows = table_records(batch_table, len(samples))
+    for single, batch in zip(single_tables, batch_rows):
+        if json.dumps(single, sort_keys=True, default=float) != json.dumps(batch, sort_keys=True, default=float):
+            raise AssertionError('Single-sample and batch mapping differ')
+    return single_time, batch_time
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('samples', type=str, help='csv of parameter sets, e.g. resampled_parameter_sets_short.csv')
+    parser.add_argument('--plan', dest='plan', type=str, default=None,
+                        help='Saved mapping plan (json). Default: the plan of optim_script.py, with every '
+                             'parameter without a special case mapped to a model parameter of its own name.')
+    parser.add_argument('--repeats', dest='n_repeats', type=int, default=10, help='Timing repeats (Default: 10).')
+    script_args = parser.parse_args()
+
+    samples = pd.read_csv(script_args.samples)
+    if script_args.plan is None:
+        mapping_plan = compile_mapping_plan(columns_as_params(samples.columns), NYANZA_PROVINCES)
+    else:
+        mapping_plan = MappingPlan.load(script_args.plan)
+    single_time, batch_time = benchmark(mapping_plan, samples, n_repeats=script_args.n_repeats)
+    print('%d samples: %.2f ms one sample at a time, %.2f ms as one batch' %
+          (len(samples), single_time * 1000, batch_time * 1000))
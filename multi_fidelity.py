@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+# Multi-fidelity calibration. Every candidate point proposed by the next-point algorithm (OptimTool) is first run at a
+# cheap, low population scale; only the candidates whose low-fidelity likelihood passes the promotion threshold are
+# then run at full scale. Each calibration iteration of the wrapped algorithm therefore takes two CalibManager
+# iterations: an even one (screening, fidelity 0) and an odd one (promoted candidates, fidelity 1).
+#
+# Replicates are set per fidelity here, not by CalibManager: each candidate is repeated low_fidelity_replicates times
+# in the screening samples and each promoted one full_fidelity_replicates times in the full-scale samples, so
+# CalibManager must run one simulation per sample (sim_runs_per_param_set=1). The likelihood of a candidate is the mean
+# over its replicates.
+#
+# The fidelity level of a sample travels in its FIDELITY_COLUMN, which the calibration script's
+# map_sample_to_model_input_fn must pop and turn into the matching x_Base_Population and simulation tags.
+#
+# When the results go back to the wrapped algorithm, promoted candidates get their full-scale likelihood and the
+# others their low-fidelity likelihood (which by construction is below the threshold). Iteration numbers passed to
+# the wrapped algorithm are its own (CalibManager iteration // 2), and the candidates, low-fidelity results and
+# promotions are saved with the wrapped algorithm's state, so a resumed calibration continues mid-iteration.
+
+RESULTS_COLUMN = 'total'
+FIDELITY_COLUMN = 'Fidelity'
+LOW_FIDELITY = 0
+FULL_FIDELITY = 1
+STATE_KEY = 'multi_fidelity'
+
+
+class MultiFidelityNextPoint(object):
+    def __init__(self, next_point, low_fidelity_replicates=3, full_fidelity_replicates=1, promotion_margin=10.0,
+                 min_promoted=1):
+        self.next_point = next_point
+        self.replicates = {LOW_FIDELITY: low_fidelity_replicates, FULL_FIDELITY: full_fidelity_replicates}
+        self.promotion_margin = promotion_margin  # promote candidates within this log-likelihood of the best one
+        self.min_promoted = min_promoted
+        self.candidates = {}  # wrapped iteration -> candidate samples
+        self.low_fidelity_results = {}  # wrapped iteration -> mean low-fidelity likelihood per candidate
+        self.promoted = {}  # wrapped iteration -> positions of the promoted candidates
+
+    def __getattr__(self, name):
+        # methods without an iteration argument (end_condition, get_final_samples, ...) are the wrapped algorithm's
+        return getattr(self.next_point, name)
+
+    def update_iteration(self, iteration):
+        return self.next_point.update_iteration(iteration // 2)
+
+    def get_state(self):
+        state = dict(self.next_point.get_state())
+        state[STATE_KEY] = {
+            'candidates': {str(i): {'columns': list(candidates.columns), 'data': candidates.values.tolist()}
+                           for i, candidates in self.candidates.items()},
+            'low_fidelity_results': {str(i): likelihoods.tolist()
+                                     for i, likelihoods in self.low_fidelity_results.items()},
+            'promoted': {str(i): promoted.tolist() for i, promoted in self.promoted.items()}
+        }
+        return state
+
+    def set_state(self, state, iteration):
+        state = dict(state)
+        own_state = state.pop(STATE_KEY, {})
+        self.candidates = {int(i): pd.DataFrame(candidates['data'], columns=candidates['columns'])
+                           for i, candidates in own_state.get('candidates', {}).items()}
+        self.low_fidelity_results = {int(i): np.array(likelihoods, dtype=np.float64)
+                                     for i, likelihoods in own_state.get('low_fidelity_results', {}).items()}
+        self.promoted = {int(i): np.array(promoted, dtype=int) for i, promoted in own_state.get('promoted', {}).items()}
+        return self.next_point.set_state(state, iteration // 2)
+
+    def get_samples_for_iteration(self, iteration):
+        wrapped_iteration, stage = divmod(iteration, 2)
+        if wrapped_iteration not in self.candidates:
+            self.candidates[wrapped_iteration] = self.next_point.get_samples_for_iteration(wrapped_iteration)
+        candidates = self.candidates[wrapped_iteration]
+        if stage == FULL_FIDELITY:
+            candidates = candidates.iloc[self.promoted[wrapped_iteration]].reset_index(drop=True)
+        # each candidate repeated once per replicate, more at low fidelity to absorb the noise of small populations
+        samples = candidates.loc[candidates.index.repeat(self.replicates[stage])].reset_index(drop=True)
+        samples[FIDELITY_COLUMN] = stage
+        return samples
+
+    def replicate_means(self, results, stage):
+        return results[RESULTS_COLUMN].values.reshape(-1, self.replicates[stage]).mean(axis=1)
+
+    def select_promoted(self, likelihoods):
+        best = np.nanmax(likelihoods)
+        promoted = np.flatnonzero(likelihoods >= best - self.promotion_margin)
+        if len(promoted) < self.min_promoted:
+            promoted = np.argsort(-likelihoods)[:self.min_promoted]
+        return np.sort(promoted)
+
+    def set_results_for_iteration(self, iteration, results):
+        wrapped_iteration, stage = divmod(iteration, 2)
+        if stage == LOW_FIDELITY:
+            n_candidates = len(self.candidates[wrapped_iteration])
+            likelihoods = self.replicate_means(results, stage)
+            self.low_fidelity_results[wrapped_iteration] = likelihoods
+            self.promoted[wrapped_iteration] = self.select_promoted(likelihoods)
+            print('Multi-fidelity iteration %d: promoting %d of %d candidates to full scale' %
+                  (wrapped_iteration, len(self.promoted[wrapped_iteration]), n_candidates))
+            return
+
+        likelihoods = self.low_fidelity_results[wrapped_iteration].copy()
+        likelihoods[self.promoted[wrapped_iteration]] = self.replicate_means(results, stage)
+        return self.next_point.set_results_for_iteration(wrapped_iteration,
+                                                         pd.DataFrame({RESULTS_COLUMN: likelihoods}))
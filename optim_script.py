@@ -1,31 +1,31 @@
 import copy
+import hashlib
 import itertools
 import math
 import numpy as np
 import os
+import pickle
 import random
 import re
-from scipy.special import gammaln  # for calculation of mu_r
+import sys
+import time
+import types
+from collections.abc import Mapping
 
-from calibtool.algorithms.OptimTool import OptimTool
-from calibtool.CalibManager import CalibManager
-from calibtool.plotters.LikelihoodPlotter import LikelihoodPlotter
-from calibtool.plotters.OptimToolPlotter import OptimToolPlotter
-from calibtool.plotters.SiteDataPlotter import SiteDataPlotter
-
-from calibtool.resamplers.CramerRaoResampler import CramerRaoResampler
-from calibtool.resamplers.RandomPerturbationResampler import RandomPerturbationResampler
-from dtk.utils.builders.ConfigTemplate import ConfigTemplate
 from dtk.utils.builders.TemplateHelper import TemplateHelper
-from dtk.utils.builders.TaggedTemplate import DemographicsTemplate
-from dtk.utils.core.DTKConfigBuilder import DTKConfigBuilder
-from dtk.utils.observations.utils import parse_ingest_data_from_xlsm
+from mapping_plan import compile_mapping_plan, table_records
 from simtools.SetupParser import SetupParser
 
-from hiv.analysis.HIVCalibSite import HIVCalibSite
-from hiv.utils.utils import make_campaign_template, add_post_channel_config_as_asset
+# NOTE: the calibtool, hiv and template-loading imports are done inside the build_* functions below. Importing this
+# file (e.g. from run_scenarios.py) only loads what is actually used, see __getattr__ at the bottom.
+
+INGEST_CACHE_VERSION = 1
+
 
 def load_campaign_templates(template_dir):
+    from hiv.utils.utils import make_campaign_template
+    from template_index import indexed_template_class
+
     # Finds and loads all campaign files in the specified directory, returning a {filename: template} filled dict
     campaign_file_regex = re.compile("^campaign_.+\.json$")
     campaign_templates = {}
@@ -33,7 +33,13 @@ def load_campaign_templates(template_dir):
         if campaign_file_regex.match(filename) is not None:
             full_filename = os.path.join(template_dir, filename)
             campaign_template = make_campaign_template(base_campaign_filename=full_filename)
+            # the same campaign, as an indexed template of the class make_campaign_template chose: built from the
+            # contents it produced, so the file is only parsed once
+            campaign_template = indexed_template_class(type(campaign_template))(full_filename,
+                                                                                campaign_template.contents)
             campaign_template.set_params(static_params)
+            if hasattr(campaign_template, 'build_path_index'):
+                campaign_template.build_path_index()
             campaign_templates[filename] = campaign_template
     return campaign_templates
 
@@ -52,98 +58,230 @@ N_SAMPLES_PER_ITERATION = 20  # the number of distinct parameter sets to run per
 N_REPLICATES = 3  # replicates > 1 helps OptimTool to be more stable at the cost of more simulations. 3 is recommended.
 TEST_N = '3'  # TEST_N is macro variable used to create directory name
 
+# Surrogate pre-screening: OptimTool proposes SURROGATE_OVERSAMPLE times N_SAMPLES_PER_ITERATION candidates per
+# iteration, a Gaussian-process emulator trained on all previous results ranks them and only the best
+# N_SAMPLES_PER_ITERATION are simulated, OptimTool's center repeats always among them. OptimTool is only given the
+# results of the simulated samples. Predictions are logged to surrogate_predictions.csv .
+SURROGATE_SCREENING = False
+SURROGATE_OVERSAMPLE = 3
+
+# Multi-fidelity calibration: every candidate is first run LOW_FIDELITY_REPLICATES times at
+# LOW_FIDELITY_SCALE_FACTOR, and only candidates within PROMOTION_MARGIN log-likelihood of the best one (at least
+# MIN_PROMOTED) are run FULL_FIDELITY_REPLICATES times at BASE_POPULATION_SCALE_FACTOR. Each calibration iteration then
+# takes two CalibManager iterations. The replicates of both fidelities are set here and CalibManager runs one
+# simulation per sample, so an iteration runs N_SAMPLES_PER_ITERATION * LOW_FIDELITY_REPLICATES (here 60) low-scale
+# simulations plus FULL_FIDELITY_REPLICATES per promoted candidate. Keep in mind that very low scale factors can stop
+# the epidemic from taking off in some counties (see above), the replicates only absorb part of that noise.
+MULTI_FIDELITY = False
+LOW_FIDELITY_SCALE_FACTOR = 0.02
+LOW_FIDELITY_REPLICATES = 3
+FULL_FIDELITY_REPLICATES = N_REPLICATES
+PROMOTION_MARGIN = 10.0
+MIN_PROMOTED = 5
+FIDELITY_SCALE_FACTORS = [LOW_FIDELITY_SCALE_FACTOR, BASE_POPULATION_SCALE_FACTOR]  # by fidelity level
+
+# Lazy demographics: the demographics templates are memory-mapped and only the json objects holding __KP tagged
+# parameters are parsed up front; the rest of each file is parsed once, when the first simulation is written, and
+# shared by all simulations instead of being copied per simulation. Worth turning on for county-level or national
+# demographics files, which are mostly untagged node data.
+LAZY_DEMOGRAPHICS = False
+
+# Resample checkpoints: the result of every resample step is saved in RESAMPLE_CHECKPOINT_DIR, keyed on the calibrated
+# points and the step's settings, and an interrupted resample skips the steps already done. Delete it to start over.
+RESAMPLE_CHECKPOINT_DIR = 'resample_checkpoints'
+
 # The excel file with parameter, analyzer, and reference data to parse
 ingest_xlsm_filename = os.path.join('Data', 'calibration_ingest_form_Nyanza.xlsm')
 
-# params is a dict, site_info is a dict, reference is a PopulationObs object, analyzers is a list of dictionaries of
-# analyzer arguments
-params, site_info, reference, analyzers, channels = parse_ingest_data_from_xlsm(filename=ingest_xlsm_filename)
+
+
+def _file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_ingest_data(filename):
+    """
+    Parsing the ingest form with parse_ingest_data_from_xlsm is slow, so the parsed data is pickled to a sidecar file
+    (<filename>.cache.pkl). The sidecar is used as-is while the form's mtime and size are unchanged and is revalidated
+    by content hash otherwise, so touching or copying the form does not force a re-parse but editing it does.
+    """
+    cache_filename = filename + '.cache.pkl'
+    stat = os.stat(filename)
+    cached = None
+    if os.path.exists(cache_filename):
+        try:
+            with open(cache_filename, 'rb') as f:
+                cached = pickle.load(f)
+            if cached.get('version') != INGEST_CACHE_VERSION:
+                cached = None
+        except Exception:  # an unreadable cache (e.g. written by a different dtk-tools version) is simply rebuilt
+            cached = None
+
+    if cached is not None and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+        return cached['data']
+
+    sha256 = _file_sha256(filename)
+    if cached is not None and cached['sha256'] == sha256:
+        data = cached['data']
+    else:
+        from dtk.utils.observations.utils import parse_ingest_data_from_xlsm
+        data = parse_ingest_data_from_xlsm(filename=filename)
+
+    cached = {'version': INGEST_CACHE_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': sha256,
+              'data': data}
+    try:
+        with open(cache_filename, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except (OSError, pickle.PicklingError) as e:
+        print('Unable to write ingest cache %s: %s' % (cache_filename, e))
+    return data
+
+
+# params is a dict, site_info is a dict, reference is a PopulationObs object, ingest_analyzers is a list of dictionaries
+# of analyzer arguments
+_ingest_start = (time.perf_counter(), time.process_time())
+params, site_info, reference, ingest_analyzers, channels = load_ingest_data(filename=ingest_xlsm_filename)
+ingest_load_times = {'wall_seconds': time.perf_counter() - _ingest_start[0],
+                     'cpu_seconds': time.process_time() - _ingest_start[1]}  # reported by run_scenarios.py --profile
 # making this available to any script that imports this file as a module, like run_scenarios.py
 reference_info = {
     'params': params,
     'site_info': site_info,
     'reference': reference,
-    'analyzers': analyzers,
+    'analyzers': ingest_analyzers,
     'channels': channels
 }
 
-# This is now generic and is part of the HIV repository. Any local site python file is unnecessary and will be unused.
-site = HIVCalibSite(analyzers=analyzers, site_data=site_info, reference_data=reference, force_apply=True)
 
-# dtk analyze compatibility
-analyzers = site.analyzers
+province_names = list(site_info['node_map'].values())
 
-plotters = [
-    LikelihoodPlotter(),
-    OptimToolPlotter()
-]
+# compiled once, applied to every sample by map_sample_to_model_input(s)
+mapping_plan = compile_mapping_plan(params, province_names)
 
-province_names = list(site_info['node_map'].values())
 
-static_params = {'x_Base_Population': BASE_POPULATION_SCALE_FACTOR}
+def build_site():
+    from hiv.analysis.HIVCalibSite import HIVCalibSite
+
+    # This is now generic and is part of the HIV repository. Any local site python file is unnecessary and will be
+    # unused.
+    return HIVCalibSite(analyzers=ingest_analyzers, site_data=site_info, reference_data=reference,
+                        force_apply=True)
+
 
-# Setting up our model configuration from templates
-# There must be at least ONE entry in the scenario_template_sets dictionary: Baseline
-# The Baseline template set will be used for calibration.
-# The only reason for including additional template sets in scenario_template_sets is if you wish to run scenarios
-# later on with run_scenarios.py and wish to use multiple templates sets (one per scenario) instead of the csv
-# table style of scenario generation.
-scenario_template_sets = {}
+def build_plotters():
+    from calibtool.plotters.LikelihoodPlotter import LikelihoodPlotter
+    from calibtool.plotters.OptimToolPlotter import OptimToolPlotter
+
+    return [
+        LikelihoodPlotter(),
+        OptimToolPlotter()
+    ]
+
+
+static_params = {'x_Base_Population': BASE_POPULATION_SCALE_FACTOR}
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 template_files_dir = os.path.join(dir_path, 'InputFiles', 'Templates')
 static_files_dir = os.path.join(dir_path, 'InputFiles', 'Static')
 
-# Defining the base calibration scenario
-config_templates = []
-config_filename = os.path.join(template_files_dir, 'config.json')
-cfg = ConfigTemplate.from_file(config_filename)
-cfg.set_params(static_params)
-config_templates.append(cfg)
-
-# This returns a dictionary filled with file_basename: campaign_template items
-campaign_templates = load_campaign_templates(template_dir=template_files_dir)
-
-demographics_templates = []
 demographics_filenames = [
     os.path.join(static_files_dir, 'Demographics.json'),
     os.path.join(template_files_dir, 'PFA_Overlay.json'),
     os.path.join(template_files_dir, 'Accessibility_and_Risk_IP_Overlay.json'),
     os.path.join(template_files_dir, 'Risk_Assortivity_Overlay.json')
 ]
-for filename in demographics_filenames:
-    template = DemographicsTemplate.from_file(filename)
-    demographics_templates.append(template)
-
-configuration_templates = {
-    'config': config_templates,
-    'campaign': campaign_templates,
-    'demographics': demographics_templates
-}
 
-# If you intend to run template-set-based scenarios in addition to the one used for calibration (your 'baseline'),
-# you will eventually need to define additional entries in scenario_template_sets
-scenario_template_sets[CALIBRATION_SCENARIO] = configuration_templates
 
+def build_scenario_template_sets():
+    from dtk.utils.builders.ConfigTemplate import ConfigTemplate
+    from dtk.utils.builders.TaggedTemplate import DemographicsTemplate
+    from lazy_json import lazy_template
+    from template_index import indexed_template_class
+
+    # Setting up our model configuration from templates
+    # There must be at least ONE entry in the scenario_template_sets dictionary: Baseline
+    # The Baseline template set will be used for calibration.
+    # The only reason for including additional template sets in scenario_template_sets is if you wish to run scenarios
+    # later on with run_scenarios.py and wish to use multiple templates sets (one per scenario) instead of the csv
+    # table style of scenario generation.
+    scenario_template_sets = {}
+
+    # Defining the base calibration scenario
+    config_templates = []
+    config_filename = os.path.join(template_files_dir, 'config.json')
+    cfg = indexed_template_class(ConfigTemplate).from_file(config_filename)
+    cfg.set_params(static_params)
+    # tagged and config parameter locations are looked up once here, per-simulation writes go straight to them
+    cfg.path_index_roots = (('parameters',), ())
+    cfg.build_path_index()
+    config_templates.append(cfg)
+
+    # This returns a dictionary filled with file_basename: campaign_template items
+    campaign_templates = load_campaign_templates(template_dir=template_files_dir)
+
+    demographics_templates = []
+    for filename in demographics_filenames:
+        if LAZY_DEMOGRAPHICS:
+            demographics_templates.append(lazy_template(DemographicsTemplate, filename))
+        else:
+            template = indexed_template_class(DemographicsTemplate).from_file(filename)
+            template.build_path_index()
+            demographics_templates.append(template)
+
+    configuration_templates = {
+        'config': config_templates,
+        'campaign': campaign_templates,
+        'demographics': demographics_templates
+    }
 
-def resolve_scenario_template_set(template_set_name, campaign_template_name):
-    # This is required to generate a flat list of templates with the desired campaign template, as there could well be
-    # more than one of them in the 'campaign' dict
-    active_templates = copy.deepcopy(scenario_template_sets[template_set_name])
-    campaign_templates = active_templates.pop('campaign')
-    if campaign_template_name is None:  # grab the one and only campaign file, error if > 1 of them
-        n_campaign_templates = len(campaign_templates)
-        if n_campaign_templates != 1:
-            raise Exception('There must be exactly one campaign template in template set: %s. There are %d .' % (template_set_name, n_campaign_templates))
-        active_templates['campaign'] = list(campaign_templates.values())  # only one of them, we checked
-    else:
-        campaign_template = campaign_templates.get(campaign_template_name, None)
-        if campaign_template is not None:
-            active_templates['campaign'] = [campaign_template]
+    # If you intend to run template-set-based scenarios in addition to the one used for calibration (your 'baseline'),
+    # you will eventually need to define additional entries in scenario_template_sets
+    scenario_template_sets[CALIBRATION_SCENARIO] = configuration_templates
+    return scenario_template_sets
+
+
+# Resolved template sets are immutable once built, so they are computed once per (template_set_name,
+# campaign_template_name) and shared. Templates are reset and re-parameterized by TemplateHelper for every simulation,
+# so callers receive a fresh dict of fresh lists (safe to pop/append) that point at the shared template objects.
+_resolved_template_sets = {}
+
+
+def _resolve_scenario_template_set(template_set_name, campaign_template_name):
+    key = (template_set_name, campaign_template_name)
+    if key not in _resolved_template_sets:
+        # This is required to generate a flat list of templates with the desired campaign template, as there could
+        # well be more than one of them in the 'campaign' dict
+        active_templates = copy.deepcopy(_lazy('scenario_template_sets')[template_set_name])
+        campaign_templates = active_templates.pop('campaign')
+        if campaign_template_name is None:  # grab the one and only campaign file, error if > 1 of them
+            n_campaign_templates = len(campaign_templates)
+            if n_campaign_templates != 1:
+                raise Exception('There must be exactly one campaign template in template set: %s. There are %d .' % (template_set_name, n_campaign_templates))
+            active_templates['campaign'] = list(campaign_templates.values())  # only one of them, we checked
         else:
-            raise Exception('Unknown campaign specified: %s' % campaign_template_name)
-    return active_templates
+            campaign_template = campaign_templates.get(campaign_template_name, None)
+            if campaign_template is not None:
+                active_templates['campaign'] = [campaign_template]
+            else:
+                raise Exception('Unknown campaign specified: %s' % campaign_template_name)
+        _resolved_template_sets[key] = active_templates
+    return _resolved_template_sets[key]
+
+
+def resolve_scenario_template_set(template_set_name, campaign_template_name):
+    resolved = _resolve_scenario_template_set(template_set_name=template_set_name,
+                                              campaign_template_name=campaign_template_name)
+    return {template_type: list(templates) for template_type, templates in resolved.items()}
+
+
+def clear_resolved_template_cache():
+    # Call this after modifying anything in scenario_template_sets so later resolutions pick up the change
+    _resolved_template_sets.clear()
 
 
 def base_table_for_scenario(template_set_name, scenario_name, campaign_filename):
@@ -156,11 +294,16 @@ def base_table_for_scenario(template_set_name, scenario_name, campaign_filename)
     return base_table
 
 
-config_builder = DTKConfigBuilder()
-config_builder.ignore_missing = True
+def build_config_builder():
+    from dtk.utils.core.DTKConfigBuilder import DTKConfigBuilder
+    from hiv.utils.utils import add_post_channel_config_as_asset
 
-# generate channel config as an asset
-add_post_channel_config_as_asset(config_builder, channels, reference, site_info)
+    config_builder = DTKConfigBuilder()
+    config_builder.ignore_missing = True
+
+    # generate channel config as an asset
+    add_post_channel_config_as_asset(config_builder, channels, reference, site_info)
+    return config_builder
 
 
 def constrain_sample(sample):
@@ -173,9 +316,18 @@ def constrain_sample(sample):
 
 def map_sample_to_model_input_fn(config_builder, sample_dict, scenario_name=CALIBRATION_SCENARIO):
     # for calibration use, only
+    from multi_fidelity import FIDELITY_COLUMN
+
     templates = TemplateHelper()
+    sample_dict = dict(sample_dict)
+    fidelity = sample_dict.pop(FIDELITY_COLUMN, None)
     table = map_sample_to_model_input(sample_dict, template_set_name=CALIBRATION_SCENARIO, scenario_name=scenario_name,
                                       campaign_filename=None)  # campaign filename not needed for calibration
+    if fidelity is not None:
+        # multi-fidelity calibration, the tags keep low and full scale results apart in the analysis
+        fidelity = int(fidelity)
+        table['x_Base_Population'] = FIDELITY_SCALE_FACTORS[fidelity]
+        table['TAGS'].update({FIDELITY_COLUMN: fidelity, 'x_Base_Population': FIDELITY_SCALE_FACTORS[fidelity]})
     return templates.mod_dynamic_parameters(config_builder, table)
 
 
@@ -190,130 +342,187 @@ def map_sample_to_model_input(sample_dict, template_set_name, scenario_name, cam
     if random_run_number:
         table['Run_Number'] = random.randint(0, 65535)  # Random random number seed
 
-    sample = copy.deepcopy(sample_dict)
-
-    if 'BaseInfectivity' in sample:
-        value = sample.pop('BaseInfectivity')
-        table['Base_Infectivity'] = value
-
-    if ('PreARTLinkMin' in sample) and ('PreARTLinkMax' in sample):
-        min_value = sample.pop('PreARTLinkMin')
-        max_value = sample.pop('PreARTLinkMax')
-        if max_value > min_value:
-            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Min'] = min_value
-            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Max'] = max_value
-        else:
-            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Min'] = max_value
-            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Max'] = min_value
-
-    if ('MaleToFemaleYoung' in sample) and ('MaleToFemaleOld' in sample):
-        young = sample.pop('MaleToFemaleYoung')
-        old = sample.pop('MaleToFemaleOld')
-        table['Male_To_Female_Relative_Infectivity_Multipliers'] = [young, young, old]
-
-    risk_reduction_fraction = sample.pop('Risk Reduction Fraction') if 'Risk Reduction Fraction' in sample else float(
-        'NaN')
-    risk_ramp_rate = sample.pop('Risk Ramp Rate') if 'Risk Ramp Rate' in sample else float('NaN')
-    risk_ramp_midyear = sample.pop('Risk Ramp MidYear') if 'Risk Ramp MidYear' in sample else float('NaN')
-
-    for province in ['Homa_Bay', 'Kisii', 'Kisumu', 'Migori', 'Nyamira', 'Siaya']:
-        key = '%sLOWRisk' % province
-        if key in sample:
-            value = sample.pop(key)
-            param = 'Initial_Distribution__KP_Risk_%s' % province
-            table[param] = [value, 1 - value, 0]
-
-        if not math.isnan(risk_reduction_fraction):
-            param = 'Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.Ramp_Max' % province
-            table[param] = risk_reduction_fraction
-
-        if not math.isnan(risk_ramp_rate):
-            param = 'Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.Ramp_Rate' % province
-            table[param] = risk_ramp_rate
-
-        if not math.isnan(risk_ramp_midyear):
-            param = 'Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.Ramp_MidYear' % province
-            table[param] = risk_ramp_midyear
-
-    if 'RiskAssortivity' in sample:
-        v = sample.pop('RiskAssortivity')
-        table['Weighting_Matrix_RowMale_ColumnFemale__KP_RiskAssortivity'] = [
-            [v, 1 - v, 0],
-            [1 - v, v, v],
-            [0, v, 1 - v]]
-
-    for p in params:
-        # print('Mapping parameter: %s' % p)
-        if 'MapTo' in p:
-            try:
-                value = sample.pop(p['Name'])
-            except KeyError:
-                continue  # no mapping needed, key not present in sample
-
-            if isinstance(p['MapTo'], list):
-                for mapto in p['MapTo']:
-                    table[mapto] = value
-            else:
-                table[p['MapTo']] = value
+    unused = mapping_plan.apply(sample_dict, table)
 
     # verify all parameters were mapped
-    for name, value in sample.items():
+    for name in unused:
         print('UNUSED PARAMETER:', name)
-    assert(len(sample) == 0)  # All params used
+    assert(len(unused) == 0)  # All params used
     return table
 
 
-# Compute hypersphere radius as a function of the number of dynamic parameters
-volume_fraction = 0.1  # fraction of N-sphere area to unit cube area for numerical derivative
-num_params = len([p for p in params if p['Dynamic']])
-
-r = OptimTool.get_r(num_params, volume_fraction)
-# Check, here's the formula for the volume of a N-sphere
-computed_volume_fraction = math.exp(
-    num_params / 2. * math.log(math.pi) - gammaln(num_params / 2. + 1) + num_params * math.log(r))
-
-optimtool = OptimTool(
-    params,
-    constrain_sample,  # <-- Will not be saved in iteration state
-    mu_r=r,  # <-- Mean percent of parameter range for numerical derivative.  CAREFUL with integer parameters!
-    sigma_r=r / 10.,  # <-- stddev of above
-    samples_per_iteration=N_SAMPLES_PER_ITERATION,
-    center_repeats=10,  # 10 is real size, 2 is testing
-    rsquared_thresh=0.81
-    # Linear regression goodness of fit threshold, [0:1].  Above this, regression is used.  Below, use best point. Best to be fairly high.
-)
-
-calib_manager = CalibManager(
-    name='%s--%s--rep%s--test%s' % (site_info['site_name'], BASE_POPULATION_SCALE_FACTOR, N_REPLICATES, TEST_N),
-    config_builder=config_builder,
-    map_sample_to_model_input_fn=map_sample_to_model_input_fn,
-    sites=[site],
-    next_point=optimtool,
-    sim_runs_per_param_set=N_REPLICATES,
-    max_iterations=N_ITERATIONS,
-    plotters=plotters
-
-)
+def map_samples_to_model_input(samples, template_set_name, scenario_name, campaign_filename, random_run_number=True):
+    """
+    Batch version of map_sample_to_model_input, used by the scenario-running script when available.
+    samples is a DataFrame with one row per sample and one column per user parameter. Returns one table per sample,
+    identical to calling map_sample_to_model_input (parameters a sample leaves out are not in its table) except that
+    ACTIVE_TEMPLATES is left out: the scenario-running script uses its own resolved templates, so mapping does not
+    load or copy the templates (e.g. in its generation worker processes).
+    """
+    n_samples = len(samples)
+    table = {
+        'TAGS': [{'Scenario': scenario_name, 'pyOptimTool': None} for _ in range(n_samples)]  # one per simulation
+    }
+    if random_run_number:
+        table['Run_Number'] = [random.randint(0, 65535) for _ in range(n_samples)]  # Random random number seed
+
+    unmapped = mapping_plan.apply_batch(samples, table)
+
+    # verify all parameters were mapped
+    for name in unmapped:
+        print('UNUSED PARAMETER:', name)
+    assert(len(unmapped) == 0)  # All params used
+    return table_records(table, n_samples)
+
+
+def build_optimtool():
+    from calibtool.algorithms.OptimTool import OptimTool
+    from scipy.special import gammaln  # for calculation of mu_r
+
+    # Compute hypersphere radius as a function of the number of dynamic parameters
+    volume_fraction = 0.1  # fraction of N-sphere area to unit cube area for numerical derivative
+    num_params = len([p for p in params if p['Dynamic']])
+
+    r = OptimTool.get_r(num_params, volume_fraction)
+    # Check, here's the formula for the volume of a N-sphere
+    computed_volume_fraction = math.exp(
+        num_params / 2. * math.log(math.pi) - gammaln(num_params / 2. + 1) + num_params * math.log(r))
+
+    return OptimTool(
+        params,
+        constrain_sample,  # <-- Will not be saved in iteration state
+        mu_r=r,  # <-- Mean percent of parameter range for numerical derivative.  CAREFUL with integer parameters!
+        sigma_r=r / 10.,  # <-- stddev of above
+        samples_per_iteration=N_SAMPLES_PER_ITERATION * (SURROGATE_OVERSAMPLE if SURROGATE_SCREENING else 1),
+        center_repeats=10,  # 10 is real size, 2 is testing
+        rsquared_thresh=0.81
+        # Linear regression goodness of fit threshold, [0:1].  Above this, regression is used.  Below, use best point. Best to be fairly high.
+    )
+
+
+def build_next_point():
+    next_point = _lazy('optimtool')
+    if SURROGATE_SCREENING:
+        from surrogate import SurrogateScreenedNextPoint
+
+        dynamic_params = [p for p in params if p['Dynamic']]
+        next_point = SurrogateScreenedNextPoint(next_point,
+                                                param_names=[p['Name'] for p in dynamic_params],
+                                                n_keep=N_SAMPLES_PER_ITERATION,
+                                                lower=[p['Min'] for p in dynamic_params],
+                                                upper=[p['Max'] for p in dynamic_params])
+    if MULTI_FIDELITY:
+        from multi_fidelity import MultiFidelityNextPoint
+
+        next_point = MultiFidelityNextPoint(next_point,
+                                            low_fidelity_replicates=LOW_FIDELITY_REPLICATES,
+                                            full_fidelity_replicates=FULL_FIDELITY_REPLICATES,
+                                            promotion_margin=PROMOTION_MARGIN,
+                                            min_promoted=MIN_PROMOTED)
+    return next_point
+
+
+def build_calib_manager():
+    from calibtool.CalibManager import CalibManager
+
+    return CalibManager(
+        name='%s--%s--rep%s--test%s' % (site_info['site_name'], BASE_POPULATION_SCALE_FACTOR, N_REPLICATES, TEST_N),
+        config_builder=_lazy('config_builder'),
+        map_sample_to_model_input_fn=map_sample_to_model_input_fn,
+        sites=[_lazy('site')],
+        next_point=_lazy('next_point'),
+        sim_runs_per_param_set=1 if MULTI_FIDELITY else N_REPLICATES,  # multi-fidelity samples repeat per replicate
+        max_iterations=N_ITERATIONS * (2 if MULTI_FIDELITY else 1),  # multi-fidelity: screening + full scale
+        plotters=_lazy('plotters')
+
+    )
+
 
 # *******************************************************************
 # Resampling specific code
 
-# Define the resamplers to run (one or more) in list order.
-resample_steps = [
-    # can pass kwargs directly to the underlying resampling routines if needed
-    RandomPerturbationResampler(M=1800, N=10, n=1),
-    CramerRaoResampler(num_of_pts=1000)
-]
+def build_resample_steps():
+    from calibtool.resamplers.CramerRaoResampler import CramerRaoResampler
+    from calibtool.resamplers.RandomPerturbationResampler import RandomPerturbationResampler
+    from resample_checkpoint import checkpointed_resampler
+
+    # Define the resamplers to run (one or more) in list order. The steps cannot overlap: CramerRaoResampler estimates
+    # the Hessian from all of RandomPerturbationResampler's evaluated points. The points of each step are run by
+    # calibtool as one experiment, so they are already simulated in parallel on the cluster. Each finished step is
+    # checkpointed (see RESAMPLE_CHECKPOINT_DIR).
+    checkpoint_dir = os.path.join(dir_path, RESAMPLE_CHECKPOINT_DIR)
+    return [
+        # can pass kwargs directly to the underlying resampling routines if needed
+        checkpointed_resampler(RandomPerturbationResampler, checkpoint_dir, M=1800, N=10, n=1),
+        checkpointed_resampler(CramerRaoResampler, checkpoint_dir, num_of_pts=1000)
+    ]
 # *******************************************************************
 
-# REQUIRED variable name: run_calib_args . Required key: 'resamplers', even if empty.
-run_calib_args = {
-    'resamplers': resample_steps,
-    'calib_manager': calib_manager,
-    'scenario_template_sets': scenario_template_sets,  # This entry is required by run_scenarios.py
-    'reference_info': reference_info  # This entry is required by run_scenarios.py
+
+# Module attributes that are expensive to create are built by these functions the first time they are accessed, e.g.
+# optim_script.calib_manager, and then kept as regular module attributes.
+_lazy_attribute_builders = {
+    'site': build_site,
+    'analyzers': lambda: _lazy('site').analyzers,  # dtk analyze compatibility
+    'plotters': build_plotters,
+    'scenario_template_sets': build_scenario_template_sets,
+    'config_builder': build_config_builder,
+    'optimtool': build_optimtool,
+    'next_point': build_next_point,
+    'calib_manager': build_calib_manager,
+    'resample_steps': build_resample_steps
 }
 
+
+def _lazy(name):
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+def __getattr__(name):
+    if name not in _lazy_attribute_builders:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    value = _lazy_attribute_builders[name]()
+    globals()[name] = value
+    return value
+
+
+class _LazyAttributesModule(types.ModuleType):
+    # A module-level __getattr__ (above) is only called from Python 3.7 on (PEP 562). Giving this module this class
+    # makes the lazy attributes resolve on Python 3.6 too.
+    def __getattr__(self, name):
+        return __getattr__(name)
+
+
+_this_module = sys.modules.get(__name__)
+if _this_module is not None and vars(_this_module) is globals():  # imported the regular way (registered)
+    _this_module.__class__ = _LazyAttributesModule
+
+
+class LazyCalibArgs(Mapping):
+    # run_calib_args entries are looked up (and built) only when a caller actually asks for them
+    def __init__(self, attribute_names):
+        self.attribute_names = attribute_names
+
+    def __getitem__(self, key):
+        if key == 'reference_info':
+            return reference_info
+        return _lazy(self.attribute_names[key])
+
+    def __iter__(self):
+        return iter(list(self.attribute_names) + ['reference_info'])
+
+    def __len__(self):
+        return len(self.attribute_names) + 1
+
+
+# REQUIRED variable name: run_calib_args . Required key: 'resamplers', even if empty.
+run_calib_args = LazyCalibArgs({
+    'resamplers': 'resample_steps',
+    'calib_manager': 'calib_manager',
+    'scenario_template_sets': 'scenario_template_sets',  # This entry is required by run_scenarios.py
+    # 'reference_info' is always available and required by run_scenarios.py
+})
+
 if __name__ == "__main__":
     SetupParser.init()
-    calib_manager.run_calibration()
+    _lazy('calib_manager').run_calibration()
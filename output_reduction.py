@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from scenario_outputs import DEFAULT_CHUNKSIZE, DEFAULT_REPORT_BASENAME, KEY_COLUMNS
+
+# Reduction of each simulation's ReportHIVByAgeAndGender.csv to the strata that are actually used, applied by
+# run_scenarios.py --reduce while the reports are downloaded. Nodes are mapped to provinces (counties) with the site's
+# node_map, ages are binned, and only the report columns needed for the requested channels are kept, summed per
+# group. The reduced frames hold sums (counts of people), never ratios, so they can be summed further, e.g. over all
+# provinces.
+#
+# Reduced reports are stored as <report basename>_reduced_<spec key>_TPI####_REP####.csv next to where the full report
+# would have gone, so scenario_outputs.iter_report_files(output_path, spec.reduced_basename) finds them. The spec key is
+# a hash of the channels' columns, group-by keys, age bins and node map, so a reduction with other settings never
+# reuses (or is mixed up with) reports reduced differently.
+
+PROVINCE_COLUMN = 'Province'
+AGE_BIN_COLUMN = 'AgeBin'
+DEFAULT_GROUP_BY = ['Year', PROVINCE_COLUMN, 'Gender', AGE_BIN_COLUMN]
+DEFAULT_AGE_BINS = [15, 25, 35, 50]
+REDUCED_SUFFIX = '_reduced'
+
+# report columns needed to compute each calibration channel (ingest form channel names)
+CHANNEL_COLUMNS = {
+    'Prevalence': ['Infected', 'Population'],
+    'Population': ['Population'],
+    'OnART': ['On_ART'],
+    'Incidence': ['Newly Infected', 'Infected', 'Population'],
+    'ARTCoverage': ['On_ART', 'Infected'],
+    'Mortality': ['Died_from_HIV', 'Population']
+}
+
+
+def age_bin_labels(age_bins):
+    # same [min:max) notation as the reference data
+    return ['[%g:%g)' % (low, high) for low, high in zip(age_bins[:-1], age_bins[1:])]
+
+
+class ReductionSpec(object):
+    def __init__(self, channels, node_map, group_by=None, age_bins=None, report_basename=DEFAULT_REPORT_BASENAME):
+        self.group_by = list(group_by or DEFAULT_GROUP_BY)
+        invalid = [key for key in self.group_by if key not in KEY_COLUMNS + [PROVINCE_COLUMN, AGE_BIN_COLUMN]]
+        if invalid:
+            raise ValueError('Unknown group-by key(s): %s (allowed: %s)' %
+                             (', '.join(invalid), ', '.join(KEY_COLUMNS + [PROVINCE_COLUMN, AGE_BIN_COLUMN])))
+        self.age_bins = list(age_bins or DEFAULT_AGE_BINS)
+        self.report_basename = report_basename
+        # node ids may be strings in the ingest form
+        self.node_map = {int(node_id): name for node_id, name in node_map.items()}
+        unknown = [channel for channel in channels if channel not in CHANNEL_COLUMNS]
+        if unknown:
+            raise ValueError('No report columns are known for channel(s) %s (known channels: %s)' %
+                             (', '.join(unknown), ', '.join(sorted(CHANNEL_COLUMNS))))
+        self.columns = []
+        for channel in channels:
+            for column in CHANNEL_COLUMNS[channel]:
+                if column not in self.columns:
+                    self.columns.append(column)
+
+    @property
+    def key(self):
+        # identifies the reduced output: everything that changes the reduced rows
+        settings = {'columns': self.columns, 'group_by': self.group_by, 'age_bins': self.age_bins,
+                    'node_map': sorted(self.node_map.items())}
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+    @property
+    def reduced_basename(self):
+        return self.report_basename + REDUCED_SUFFIX + '_' + self.key
+
+    def reduced_filename(self, filename):
+        # e.g. output/ReportHIVByAgeAndGender.csv -> output/ReportHIVByAgeAndGender_reduced_<key>.csv
+        extension = os.path.splitext(filename)[1]
+        return os.path.join(os.path.dirname(filename), self.reduced_basename + extension)
+
+    def applies_to(self, filename):
+        return os.path.splitext(os.path.basename(filename))[0] == self.report_basename
+
+    def reduce_frame(self, report):
+        missing = [column for column in self.columns if column not in report.columns]
+        if missing:
+            raise KeyError('Report is missing the column(s) needed for the reduction: %s' % ', '.join(missing))
+        report = report.copy()
+        if PROVINCE_COLUMN in self.group_by:
+            report[PROVINCE_COLUMN] = report['NodeId'].map(self.node_map)
+            if report[PROVINCE_COLUMN].isna().any():
+                unknown = sorted(report.loc[report[PROVINCE_COLUMN].isna(), 'NodeId'].unique())
+                raise KeyError('NodeId(s) not in the site node_map: %s' % ', '.join(str(n) for n in unknown))
+        if AGE_BIN_COLUMN in self.group_by:
+            report[AGE_BIN_COLUMN] = pd.cut(report['Age'], bins=self.age_bins, right=False,
+                                            labels=age_bin_labels(self.age_bins))
+            report = report[report[AGE_BIN_COLUMN].notna()]  # ages outside the bins
+        return report.groupby(self.group_by, observed=True)[self.columns].sum().reset_index()
+
+    def reduce_file(self, source, destination, chunksize=DEFAULT_CHUNKSIZE):
+        """
+        Reduces the report at source into destination (written through a .part file), chunk by chunk. Returns the
+        number of rows written.
+        """
+        reduced = None
+        for chunk in pd.read_csv(source, chunksize=chunksize):
+            chunk_reduced = self.reduce_frame(chunk)
+            reduced = chunk_reduced if reduced is None else pd.concat([reduced, chunk_reduced], ignore_index=True)
+            # groups can span chunks, re-sum what has been collected so far
+            reduced = reduced.groupby(self.group_by, observed=True)[self.columns].sum().reset_index()
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        partial = destination + '.part'
+        reduced.to_csv(partial, index=False)
+        os.replace(partial, destination)
+        return len(reduced)
+
+
+def reduction_spec_from_module(loaded_module, age_bins=None, group_by=None):
+    # the calibration channels and node map of the calibration script's ingest form
+    reference_info = loaded_module.run_calib_args['reference_info']
+    return ReductionSpec(channels=reference_info['channels'], node_map=reference_info['site_info']['node_map'],
+                         age_bins=age_bins, group_by=group_by)
+
+
+def find_reduced_basenames(output_path, report_basename=DEFAULT_REPORT_BASENAME):
+    # the basenames of the reduced reports in output_path, one per reduction spec that was used
+    prefix = report_basename + REDUCED_SUFFIX + '_'
+    basenames = set()
+    for scenario in sorted(os.listdir(output_path)) if os.path.isdir(output_path) else []:
+        scenario_dir = os.path.join(output_path, scenario)
+        if os.path.isdir(scenario_dir):
+            basenames.update(filename.split('_TPI')[0] for filename in os.listdir(scenario_dir)
+                             if filename.startswith(prefix) and '_TPI' in filename)
+    return sorted(basenames)
+
+
+def parse_group_by(value):
+    return [key.strip() for key in value.split(',') if key.strip()]
+
+
+def parse_age_bins(value):
+    age_bins = [float(edge) for edge in value.split(',')]
+    if len(age_bins) < 2 or np.any(np.diff(age_bins) <= 0):
+        raise ValueError('Age bins must be at least two increasing edges, e.g. 15,25,35,50 . Got: %s' % value)
+    return age_bins
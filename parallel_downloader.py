@@ -0,0 +1,137 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scenario_outputs import REP_TAG, TPI_TAG, download_destination
+
+# Downloading the result files of finished simulations from a shared filesystem, used by
+# run_scenarios.analyze_experiments. Kept free of simtools imports: only a simulation's get_path(), tags and
+# experiment.exp_name are used, so test fakes can be downloaded too.
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+
+
+def file_md5(filename):
+    digest = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParallelDownloader(object):
+    """
+    Copies result files from simulation directories into output_path with a pool of worker threads, using the same
+    <output_path>/<experiment name>/<file basename>_TPI####_REP####<ext> layout as DownloadAnalyzerTPI. Copies go
+    through a temporary .part file (removed again if the copy fails) and keep the source's modification time, so an
+    interrupted or repeated download (e.g. re-running with -id SUITE_ID) only fetches what is missing: a file already
+    present with the source's size and modification time is skipped without reading it. Only when the sizes match but
+    the times do not (e.g. files downloaded by an older version) are both files checksummed.
+    With a reduction (output_reduction.ReductionSpec), the reports it applies to are reduced straight from the
+    simulation directory and only the reduced report is stored.
+    """
+    def __init__(self, output_path, filenames, n_workers=DEFAULT_DOWNLOAD_WORKERS, verify_checksum=True,
+                 reduction=None):
+        self.output_path = output_path
+        self.filenames = filenames
+        self.verify_checksum = verify_checksum
+        self.reduction = reduction
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.futures = []
+        self.lock = threading.Lock()
+        self.n_copied = 0
+        self.n_skipped = 0
+        self.n_reduced = 0
+        self.n_bytes = 0
+        self.missing = []
+        self.start_time = None
+
+    def destination(self, simulation, filename):
+        return os.path.join(self.output_path, download_destination(simulation.experiment.exp_name,
+                                                                   parameterization_id=simulation.tags[TPI_TAG],
+                                                                   run_number=simulation.tags[REP_TAG],
+                                                                   filename=filename))
+
+    def is_present(self, source, destination):
+        if not os.path.exists(destination):
+            return False
+        source_stat, destination_stat = os.stat(source), os.stat(destination)
+        if source_stat.st_size != destination_stat.st_size:
+            return False
+        if source_stat.st_mtime_ns == destination_stat.st_mtime_ns or not self.verify_checksum:
+            return True
+        if file_md5(source) != file_md5(destination):
+            return False
+        os.utime(destination, ns=(destination_stat.st_atime_ns, source_stat.st_mtime_ns))  # not hashed again
+        return True
+
+    def copy_file(self, source, destination):
+        if not os.path.exists(source):
+            with self.lock:
+                self.missing.append(source)
+            return
+        if self.is_present(source, destination):
+            with self.lock:
+                self.n_skipped += 1
+            return
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        partial = destination + '.part'
+        try:
+            shutil.copyfile(source, partial)
+            source_stat = os.stat(source)
+            os.utime(partial, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            os.replace(partial, destination)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        with self.lock:
+            self.n_copied += 1
+            self.n_bytes += os.path.getsize(destination)
+
+    def reduce_file(self, source, destination):
+        if not os.path.exists(source):
+            with self.lock:
+                self.missing.append(source)
+            return
+        if os.path.exists(destination):  # reduced by an earlier download with the same spec (the key is in the name)
+            with self.lock:
+                self.n_skipped += 1
+            return
+        self.reduction.reduce_file(source, destination)
+        with self.lock:
+            self.n_reduced += 1
+            self.n_bytes += os.path.getsize(destination)
+
+    def submit(self, simulations):
+        # queue the files of the given simulations for download and return immediately
+        if self.start_time is None:
+            self.start_time = time.time()
+        for simulation in simulations:
+            for filename in self.filenames:
+                source = os.path.join(simulation.get_path(), filename)
+                if self.reduction is not None and self.reduction.applies_to(filename):
+                    self.futures.append(self.executor.submit(
+                        self.reduce_file, source=source,
+                        destination=self.destination(simulation, self.reduction.reduced_filename(filename))))
+                else:
+                    self.futures.append(self.executor.submit(self.copy_file, source=source,
+                                                             destination=self.destination(simulation, filename)))
+
+    def finish(self):
+        # wait for all queued downloads, re-raising the first copy error, and report throughput
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(wait=True)
+        elapsed = max(time.time() - (self.start_time or time.time()), 1e-6)
+        n_files = self.n_copied + self.n_reduced
+        print('Downloaded %d file(s) (%d reduced, %.1f MB stored), skipped %d already present file(s) in %.1f s: '
+              '%.1f files/s, %.2f MB/s' % (n_files, self.n_reduced, self.n_bytes / 1e6, self.n_skipped, elapsed,
+                                          n_files / elapsed, self.n_bytes / 1e6 / elapsed))
+        for source in self.missing:
+            print('MISSING FILE: %s' % source)
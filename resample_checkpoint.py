@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+# Resumable resample steps. A resample step (e.g. RandomPerturbationResampler) evaluates thousands of points, and an
+# interrupted resample used to start over from the first step. CheckpointedResampler wraps a calibtool resampler and
+# pickles what its resample_and_run returns (the evaluated points and the selection values handed to the next step)
+# as soon as the step finishes. A restarted resample with the same calibrated points and the same step settings loads
+# that result instead of running the step again. Any other calibrated point, or any change of the step's resampler
+# class, keyword arguments or position, makes a new checkpoint. Delete the checkpoint directory to start over.
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return repr(value)
+
+
+def point_values(point):
+    # the parameter values of a calibtool Point (or of a plain {parameter: value} dict)
+    if hasattr(point, 'to_value_dict'):
+        return point.to_value_dict()
+    return point if isinstance(point, dict) else vars(point)
+
+
+def checkpoint_key(calibrated_points, resample_step, settings):
+    canonical = json.dumps({'points': [point_values(point) for point in calibrated_points],
+                            'step': resample_step, 'settings': settings},
+                           sort_keys=True, default=_json_default)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CheckpointedResampler(object):
+    def __init__(self, resampler, settings, checkpoint_dir):
+        # settings: everything that determines the step's output, e.g. {'M': 1800, 'N': 10, 'n': 1}
+        self.__dict__['_resampler'] = resampler
+        self.__dict__['_settings'] = dict(settings, resampler=resampler.__class__.__name__)
+        self.__dict__['_checkpoint_dir'] = checkpoint_dir
+
+    # everything but resample_and_run is the wrapped resampler's, e.g. set_calibration_manager and output_location
+    def __getattr__(self, name):
+        return getattr(self._resampler, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resampler, name, value)
+
+    def checkpoint_filename(self, calibrated_points, resample_step):
+        key = checkpoint_key(calibrated_points, resample_step, self._settings)
+        return os.path.join(self._checkpoint_dir, '%s_%s.pkl' % (resample_step, key[:16]))
+
+    def resample_and_run(self, calibrated_points, resample_step, selection_values, initial_calibration_points):
+        filename = self.checkpoint_filename(calibrated_points, resample_step)
+        if os.path.exists(filename):
+            print('Resample step %s (%s): loading its checkpoint %s' %
+                  (resample_step, self._settings['resampler'], filename))
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+
+        result = self._resampler.resample_and_run(calibrated_points=calibrated_points, resample_step=resample_step,
+                                                  selection_values=selection_values,
+                                                  initial_calibration_points=initial_calibration_points)
+        os.makedirs(self._checkpoint_dir, exist_ok=True)
+        with open(filename + '.part', 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(filename + '.part', filename)  # an interrupted write leaves no checkpoint
+        return result
+
+
+def checkpointed_resampler(resampler_class, checkpoint_dir, **kwargs):
+    # resampler_class(**kwargs), checkpointed on its keyword arguments
+    return CheckpointedResampler(resampler_class(**kwargs), kwargs, checkpoint_dir)
@@ -2,23 +2,36 @@ import itertools
 import numpy as np
 import os
 import pandas as pd
-import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 
-from calibtool.CalibManager import CalibManager
-from calibtool.ParameterSet import ParameterSet, NaNDetectedError
+from calibtool.ParameterSet import NaNDetectedError
 
 from dtk.utils.builders.TemplateHelper import TemplateHelper
 from dtk.utils.core.DTKConfigBuilder import DTKConfigBuilder
 from simtools.Analysis.AnalyzeManager import AnalyzeManager
 from simtools.Analysis.BaseAnalyzers.DownloadAnalyzerTPI import DownloadAnalyzerTPI
 from simtools.ExperimentManager.ExperimentManagerFactory import ExperimentManagerFactory
-from simtools.ModBuilder import ModBuilder
+from simtools.ModBuilder import ModBuilder, ModFn
 from simtools.SetupParser import SetupParser
 from simtools.Utilities.Initialization import load_config_module
 
 from hiv.utils.utils import add_post_channel_config_as_asset
 
+from completion_index import CompletionIndex, filter_completed_rows
+from completion_watcher import CompletionWatcher
+from input_dedup import write_deduplicated, write_manifest
+from lazy_json import close_lazy_templates
+from local_pool import LOCAL_POOL_BACKEND, run_on_local_pool
+from output_reduction import DEFAULT_GROUP_BY, parse_age_bins, parse_group_by, reduction_spec_from_module
+from parallel_downloader import DEFAULT_DOWNLOAD_WORKERS, ParallelDownloader
+from sample_store import SampleStore, roulette_resample
+from scenario_outputs import TPI_TAG, REP_TAG, convert_reports_to_parquet, download_destination
+from scenario_table import load_scenario_table
+from slurm_bundles import (DEFAULT_BUNDLE_COMMAND, DEFAULT_SBATCH_COMMAND, BundledExperimentManager, absolute_paths,
+                           bundle_dir_for_suite, submit_bundles, suite_was_bundled)
+from suite_profiler import DEFAULT_REPORT_FILENAME, profiler
+
 SetupParser.default_block = 'NYUCLUSTER'
 
 RESAMPLING_METHODS_STR = ', '.join(['roulette', 'provided'])
@@ -26,13 +39,20 @@ DEFAULT_N_SAMPLES = 300
 DEFAULT_BLOCK = 'NYUCLUSTER'
 DEFAULT_OUTPUT_DIR = 'Calibrated_RSA_Scenarios'
 DEFAULT_DOWNLOAD_FILES = os.path.join('output', 'ReportHIVByAgeAndGender.csv')
+# Worker processes only map samples (the cheap part); template application and writing the simulations stay in the
+# main process, because simtools writes simulations inside create_simulations/run_simulations. Check with
+# --benchmark-generation that more workers pay off for a suite before using them. Memory use only stays flat in the
+# number of samples with one worker: with more (and more than one scenario), every scenario's full table is built and
+# held until its experiment is created.
+DEFAULT_GENERATION_WORKERS = 1
+DEFAULT_MAPPING_CHUNK_SIZE = 1000  # samples mapped to model parameters at a time
+
+# block types whose simulations live on a shared filesystem and can be copied directly from their sim directory
+FILESYSTEM_BLOCK_TYPES = ('CLUSTER', 'LOCAL')
 
 SCENARIO_TABLE_MODE = 'scenario_table'
 SCENARIO_TEMPLATE_SETS_MODE = 'scenario_template_sets'
 
-TPI_TAG = 'parameterization_id'
-REP_TAG = 'Run_Number'
-
 DEFAULT_CAMPAIGN = 'Default_Campaign'
 
 
@@ -40,10 +60,6 @@ class UnknownResampleMethodException(Exception):
     pass
 
 
-class MissingCampaignSpecificationException(Exception):
-    pass
-
-
 DOLPHIN = '''
                                   _
                              _.-~~.)
@@ -70,33 +86,207 @@ def load_templates(loaded_module):
     for scenario_name, scenario_templates in loaded_module.run_calib_args['scenario_template_sets'].items():
         for template in scenario_templates['config']:
             template.set_param("Enable_Demographics_Builtin", 0, allow_new_parameters=True)
+    # resolved template sets are cached by the calibration module and must be rebuilt after modification
+    if hasattr(loaded_module, 'clear_resolved_template_cache'):
+        loaded_module.clear_resolved_template_cache()
+
+
+def get_bundle_size():
+    # simulations per Slurm array task, from the selected simtools.ini block. 1 means one job per simulation (simtools)
+    return int(SetupParser.get('bundle_size', default=1) or 1)
+
+
+def get_status_timeout():
+    # seconds without a status change after which a bundled simulation counts as failed, None to wait indefinitely
+    status_timeout = SetupParser.get('status_timeout', default=None)
+    return float(status_timeout) if status_timeout else None
+
+
+def submit_simulation_bundles(experiment_managers, suite_id):
+    command = SetupParser.get('bundle_command', default=DEFAULT_BUNDLE_COMMAND)
+    command = command.format(exe_path=absolute_paths(SetupParser.get('exe_path')),
+                             input_root=absolute_paths(SetupParser.get('input_root')),
+                             sim_dir='{sim_dir}', sim_name='{sim_name}')  # filled in per simulation by the bundle
+    return submit_bundles(experiment_managers,
+                          bundle_size=get_bundle_size(),
+                          bundle_dir=bundle_dir_for_suite(SetupParser.get('sim_root'), suite_id),
+                          command=command,
+                          sbatch_command=SetupParser.get('sbatch_command', default=DEFAULT_SBATCH_COMMAND),
+                          status_timeout=get_status_timeout(),
+                          partition=SetupParser.get('partition', default=None),
+                          time_limit=SetupParser.get('time_limit', default=None),
+                          memory_per_cpu=SetupParser.get('memory_per_cpu', default=None),
+                          account=SetupParser.get('account', default=None),
+                          notification_email=SetupParser.get('notification_email', default=None))
+
+
+class DeduplicatingConfigBuilder(DTKConfigBuilder):
+    # --dedup-inputs: the input files of each simulation are written through input_dedup (once per experiment and
+    # content, linked into the simulation directory) instead of as separate copies
+    def dump_files(self, working_directory):
+        os.makedirs(working_directory, exist_ok=True)
+        self.file_writer(lambda name, content: write_deduplicated(working_directory, '%s.json' % name, content))
+
+
+def use_local_pool():
+    # execution_backend = local_pool: simulations run on this machine instead of being submitted to the scheduler
+    return SetupParser.get('execution_backend', default='') == LOCAL_POOL_BACKEND
+
+
+def run_simulations_on_local_pool(experiment_managers, rerun_finished=True):
+    # The simulations run in the background while analyze_experiments polls their status files; the process does not
+    # exit before they are done.
+    command = SetupParser.get('pool_command', default=DEFAULT_BUNDLE_COMMAND)
+    command = command.format(exe_path=absolute_paths(SetupParser.get('exe_path')),
+                             input_root=absolute_paths(SetupParser.get('input_root')),
+                             sim_dir='{sim_dir}', sim_name='{sim_name}')
+    timeout = SetupParser.get('sim_timeout', default=None)
+    _, experiment_managers = run_on_local_pool(experiment_managers,
+                                               command=command,
+                                               max_workers=int(SetupParser.get('max_local_sims', default=0) or 0) or None,
+                                               timeout=float(timeout) if timeout else None,
+                                               retries=int(SetupParser.get('sim_retries', default=0) or 0),
+                                               rerun_finished=rerun_finished)
+    return experiment_managers
 
 
-# These are two methods for traversing nested python structures of lists/dicts and converting strings representing lists
-# to actual lists. e.g. {'somekey': {'a': 4, 'b': '[1,2,3]'}} => {'somekey': {'a': 4, 'b': [1,2,3]}}
-def check_recurse(item, indexer):
-    if isinstance(item[indexer], str):
-        if '[' in item[indexer]:
-            item[indexer] = eval(item[indexer])
-    else:
-        find_and_eval(item[indexer])
-
-
-def find_and_eval(item):
-    if isinstance(item, list):
-        for index in range(len(item)):
-            check_recurse(item, index)
-    elif isinstance(item, dict):
-        keys = item.keys()
-        for key in keys:
-            check_recurse(item, key)
-    else:
-        pass  # do nothing
+def get_scenario_specs(scenario_template_sets, scenario_param_dicts):
+    # returns one (template_set_name, scenario_name, campaign_template_name, scenario_params) per experiment to create,
+    # one experiment per template_set X scenario_params combination
+    specs = []
+    for template_set_name in scenario_template_sets.keys():
+        for scenario_params in scenario_param_dicts:
+            scenario_params = dict(scenario_params)  # Campaign & Scenario are popped below, keep the originals intact
 
+            # Determine which campaign file to use as the campaign template for this scenario
+            campaign_template_name = scenario_params.pop('Campaign', None)
 
-def build_and_run_simulations(samples, scenario_template_sets, scenario_param_dicts, suite_name, loaded_module):
+            # name the scenario (experiment) by combining the template set name and provided Scenario name
+            sn = scenario_params.pop('Scenario', 'DefaultScenario')
+            campaign_string = os.path.splitext(campaign_template_name)[0] if campaign_template_name else DEFAULT_CAMPAIGN
+            if sn is None:
+                scenario_name = '-'.join([template_set_name, campaign_string])
+            else:
+                scenario_name = '-'.join([template_set_name, campaign_string, sn])
+            specs.append((template_set_name, scenario_name, campaign_template_name, scenario_params))
+    return specs
+
+
+def strip_known_prefixes(name):
+    # headers for TemplateHelper - replacing "well known" prefixes as needed
+    return name.replace('CONFIG.', '').replace('DEMOGRAPHICS.', '').replace('CAMPAIGN.', '')
+
+
+def generate_scenario_rows(loaded_module, samples, template_set_name, scenario_name, campaign_template_name,
+                           scenario_params, chunk_size=DEFAULT_MAPPING_CHUNK_SIZE):
+    """
+    Maps the samples (a SampleStore) to model parameters for one scenario, chunk_size samples at a time, and yields
+    one {header: value} dict per simulation. The ACTIVE_TEMPLATES column is left out (the caller adds its own
+    templates back in).
+    """
+    for sample_table, run_numbers, parameterization_ids in samples.iter_chunks(chunk_size):
+        # map the sample parameters to model parameters
+        with profiler.phase('mapping'):
+            if hasattr(loaded_module, 'map_samples_to_model_input'):
+                # one {model parameter: value} dict per sample
+                mapped_sample_params = loaded_module.map_samples_to_model_input(samples=sample_table,
+                                                                                template_set_name=template_set_name,
+                                                                                scenario_name=scenario_name,
+                                                                                campaign_filename=campaign_template_name,
+                                                                                random_run_number=False)
+            else:
+                mapped_sample_params = [loaded_module.map_sample_to_model_input(sample_dict=param_dict,
+                                                                                template_set_name=template_set_name,
+                                                                                scenario_name=scenario_name,
+                                                                                campaign_filename=campaign_template_name,
+                                                                                random_run_number=False)
+                                        for param_dict in sample_table.to_dict(orient='records')]
+
+        # Combine scenario name and scenario table parameters with sample param dicts
+        for sample, run_number, parameterization_id in zip(mapped_sample_params, run_numbers.tolist(),
+                                                           parameterization_ids.tolist()):
+            current = {}
+            current.update(sample)
+            current[REP_TAG] = run_number  # for tracking which parameterization & run number is which sim/result
+            current.update(scenario_params)
+            current.update({'Config_Name': scenario_name, REP_TAG: run_number})
+            current.pop('ACTIVE_TEMPLATES', None)
+
+            # including parameterization id number (TPI) and run number as tags
+            current['TAGS'] = dict(current.get('TAGS', {}))
+            current['TAGS'].update({TPI_TAG: parameterization_id, REP_TAG: run_number})
+            yield {strip_known_prefixes(name): value for name, value in current.items()}
+
+
+def generate_scenario_table(loaded_module, samples, template_set_name, scenario_name, campaign_template_name,
+                            scenario_params):
+    """
+    All rows of one scenario as a (headers, table) pair, for generation in worker processes: a list-of-lists table is
+    cheaper to send back than one dict per simulation.
+    """
+    rows = generate_scenario_rows(loaded_module, samples, template_set_name, scenario_name, campaign_template_name,
+                                  scenario_params)
+    first = next(rows)
+    headers = list(first.keys())
+    table = [list(first.values())] + [list(row.values()) for row in rows]
+    return headers, table
+
+
+def counted_rows(rows):
+    for row in rows:
+        profiler.count('simulations_generated')
+        yield row
+
+
+# scenario table generation in worker processes. Forked workers inherit the calibration module loaded by the main
+# process; workers started another way (no fork) load it once themselves.
+_generation_worker_module = None
+
+
+def _start_generation_workers(loaded_module, n_workers):
+    global _generation_worker_module
+    _generation_worker_module = loaded_module
+    return ProcessPoolExecutor(max_workers=n_workers)
+
+
+def _generate_scenario_table_in_worker(calibration_script, *args):
+    global _generation_worker_module
+    if _generation_worker_module is None:
+        _generation_worker_module = load_config_module(calibration_script)
+    return generate_scenario_table(_generation_worker_module, *args)
+
+
+def _stop_generation_workers(executor, futures):
+    # Future.cancel only stops tables that have not started; shutdown(cancel_futures=True) needs Python 3.9
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+
+def benchmark_generation(samples, specs, loaded_module, n_workers):
+    """
+    Seconds to generate all scenario tables (sample mapping only) in this process and in n_workers worker processes,
+    worker start-up included.
+    """
+    start = time.perf_counter()
+    for spec in specs:
+        generate_scenario_table(loaded_module, samples, *spec)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with _start_generation_workers(loaded_module, n_workers) as executor:
+        for future in [executor.submit(_generate_scenario_table_in_worker, loaded_module.__file__, samples, *spec)
+                       for spec in specs]:
+            future.result()
+    parallel_time = time.perf_counter() - start
+    return serial_time, parallel_time
+
+
+def build_and_run_simulations(samples, scenario_template_sets, scenario_param_dicts, suite_name, loaded_module,
+                              n_generation_workers=DEFAULT_GENERATION_WORKERS, dedup_inputs=False,
+                              completion_index=None, download_filenames=None):
     # Create the default config builder
-    config_builder = DTKConfigBuilder()
+    config_builder = DeduplicatingConfigBuilder() if dedup_inputs else DTKConfigBuilder()
 
     # This is REQUIRED by the template
     config_builder.ignore_missing = True
@@ -111,181 +301,200 @@ def build_and_run_simulations(samples, scenario_template_sets, scenario_param_di
     # Create a suite to hold all the experiments
     suite_id = None # create_suite(suite_name)
 
-    # Create the scenarios
-    for template_set_name, scenario_template_set in scenario_template_sets.items():
-        # available_campaigns = scenario_template_set.pop('campaign')  # we will add the selected campaign back in later
-        # generate one experiment per template_set X scenario_params combination
-        for scenario_params in scenario_param_dicts:
-            # Determine which campaign file to use as the campaign template for this scenario
-            campaign_template_name = scenario_params.pop('Campaign', None)
+    specs = get_scenario_specs(scenario_template_sets, scenario_param_dicts)
+
+    # Generate the scenario tables, concurrently if there is more than one scenario. Experiments are submitted in
+    # order below as soon as their table is ready, while the remaining tables are still being generated. With a
+    # single generation worker, rows are instead mapped chunk by chunk as the simulations are created, so memory use
+    # does not grow with the number of samples.
+    n_workers = min(n_generation_workers, len(specs))
+    executor = None
+    if n_workers > 1:
+        executor = _start_generation_workers(loaded_module, n_workers)
+        tables = [executor.submit(_generate_scenario_table_in_worker, loaded_module.__file__, samples, *spec)
+                  for spec in specs]
+    else:
+        tables = [None] * len(specs)
+
+    try:
+        # Create the scenarios
+        for spec, table_future in zip(specs, tables):
+            template_set_name, scenario_name, campaign_template_name, scenario_params = spec
+            print('Scenario: %s Using template set: %s' % (scenario_name, template_set_name))
+
             resolved_scenario_template_set = loaded_module.resolve_scenario_template_set(template_set_name=template_set_name,
                                                                                          campaign_template_name=campaign_template_name)
+            active_templates = list(itertools.chain(*resolved_scenario_template_set.values()))
 
-            # campaign_template = _get_campaign_template(campaign_template_name=campaign_template_name,
-            #                                            scenario_name=scenario_params['Scenario'],
-            #                                            available_campaigns=available_campaigns)
-
-            # name the scenario (experiment) by combining the template set name and provided Scenario name
-            sn = scenario_params.pop('Scenario', 'DefaultScenario')
-            campaign_string = os.path.splitext(campaign_template_name)[0] if campaign_template_name else DEFAULT_CAMPAIGN
-            if sn is None:
-                scenario_name = '-'.join([template_set_name, campaign_string])
+            if table_future is not None:
+                with profiler.phase('mapping_wait'):  # time spent waiting for a worker's table
+                    headers, table = table_future.result()
+                rows = (dict(zip(headers, row)) for row in table)
             else:
-                scenario_name = '-'.join([template_set_name, campaign_string, sn])
-
-            print('Scenario: %s Using template set: %s' % (scenario_name, template_set_name))
-
-            # map the sample parameters to model parameters
-            mapped_sample_params = []
-            for sample in samples:
-                mapped = loaded_module.map_sample_to_model_input(sample_dict=sample.param_dict,
-                                                                 template_set_name=template_set_name,
-                                                                 scenario_name=scenario_name,
-                                                                 campaign_filename=campaign_template_name,
-                                                                 random_run_number=False)
-
-                # for tracking which parameterization & run number is which sim/result
-                mapped[REP_TAG] = sample.run_number
-                mapped[TPI_TAG] = sample.parameterization_id
-
-                mapped_sample_params.append(mapped)
-
-            # Combine scenario name and scenario table parameters with sample param dicts
-            combined_params = []
-            for sample in mapped_sample_params:
-                current = {}
-                current.update(sample)
-                current.update(scenario_params)
-                current.update({'Config_Name': scenario_name, REP_TAG: current[REP_TAG]})
-
-                # including parameterization id number (TPI) and run number as tags
-                if 'TAGS' not in current:
-                    current['TAGS'] = {}
-
-                parameterization_id = current.pop(TPI_TAG)
-                current['TAGS'].update({TPI_TAG: parameterization_id, REP_TAG: current[REP_TAG]})
-                combined_params.append(current)
-
-            # Extract the headers - replacing "well known" prefixes as needed
-            headers = [k.replace('CONFIG.', '').replace('DEMOGRAPHICS.', '').replace('CAMPAIGN.', '') for k in
-                       combined_params[0].keys()]
-
-            # Construct the table
-            table = [list(c.values()) for c in combined_params]
-
-            # Initialize the template & create the experiment builder
+                rows = generate_scenario_rows(loaded_module, samples, *spec)
+
+            if completion_index is not None:
+                rows = filter_completed_rows(rows, completion_index, resolved_scenario_template_set,
+                                             template_set_name=template_set_name, scenario_name=scenario_name,
+                                             download_filenames=download_filenames)
+            first_row = next(rows, None)
+            if first_row is None:
+                continue
+            rows = itertools.chain([first_row], rows)
+
+            # Initialize the template & create the experiment builder, one simulation per row. With --profile,
+            # applying each simulation's parameters to the templates is timed separately from the rest of simulation
+            # creation (writing the sim directories and, without bundles, submitting them).
             tpl = TemplateHelper()
-            tpl.set_dynamic_header_table(headers, table)
-            tpl.active_templates = list(itertools.chain(*resolved_scenario_template_set.values()))
-
-            experiment_builder = ModBuilder.from_combos(tpl.get_modifier_functions())
+            tpl.active_templates = active_templates
+            apply_parameters = profiler.timed('template_application', tpl.mod_dynamic_parameters)
+            experiment_builder = ModBuilder.from_list(
+                [ModFn(apply_parameters, dict(ACTIVE_TEMPLATES=active_templates, **row))] for row in counted_rows(rows))
 
             experiment_manager = ExperimentManagerFactory.from_cb(config_builder)
             suite_id = suite_id or experiment_manager.create_suite(suite_name=suite_name)
-            experiment_manager.run_simulations(exp_name=scenario_name, exp_builder=experiment_builder,
-                                               suite_id=suite_id)
+            with profiler.phase('create_simulations'):
+                if get_bundle_size() > 1 or use_local_pool():
+                    # only write the simulations out, they are submitted together (bundles or local pool) below
+                    experiment_manager.create_simulations(exp_name=scenario_name, exp_builder=experiment_builder,
+                                                          suite_id=suite_id)
+                else:
+                    experiment_manager.run_simulations(exp_name=scenario_name, exp_builder=experiment_builder,
+                                                       suite_id=suite_id)
             experiment_managers.append(experiment_manager)
 
-    return experiment_managers
+            if dedup_inputs:
+                # the inputs were deduplicated as they were written, this only records which asset each one links to
+                with profiler.phase('dedup_manifest'):
+                    write_manifest([simulation.get_path() for simulation in experiment_manager.experiment.simulations],
+                                   manifest_name=experiment_manager.experiment.exp_id)
+            if profiler.enabled:
+                with profiler.phase('measure_sim_dirs'):
+                    profiler.count_directory_bytes([simulation.get_path()
+                                                    for simulation in experiment_manager.experiment.simulations])
+    finally:
+        if executor is not None:
+            _stop_generation_workers(executor, tables)
+
+    if completion_index is not None:
+        completion_index.save()
+
+    if use_local_pool() and len(experiment_managers) > 0:
+        with profiler.phase('submission'):
+            experiment_managers = run_simulations_on_local_pool(experiment_managers)
+    elif get_bundle_size() > 1 and len(experiment_managers) > 0:
+        with profiler.phase('submission'):
+            experiment_managers = submit_simulation_bundles(experiment_managers, suite_id=suite_id)
 
+    return experiment_managers
 
-def analyze_experiments(experiment_managers, output_path, suite_id, download_filenames):
-    # if suite_id was provided AND our block type is CLUSTER, we will not wait but just download.
 
-    # Download (analyze) files for experiments as they finish up.
-    while not all([em.finished() for em in experiment_managers]):
-        print("Waiting 60 seconds for experiments to complete...")
-        sys.stdout.flush()
-        time.sleep(60)
-        [e.refresh_experiment() for e in experiment_managers]
-    
-    print('Experiments complete, downloading...')
+def download_simulations(simulations, output_path, download_filenames, reduction=None):
     am = AnalyzeManager(verbose=False)
-    for em in experiment_managers:
-        print(em.experiment.simulations)
-        am.add_experiment(em.experiment)
+    for simulation in simulations:
+        am.add_simulation(simulation)
     am.add_analyzer(DownloadAnalyzerTPI(filenames=download_filenames,
                                         output_path=output_path,
                                         TPI_tag=TPI_TAG,
                                         REP_tag=REP_TAG))
-    print(am.analyzers)
-    print(am.simulations)
     am.analyze()
-
-
-def load_scenario_table(filename):
-    # returns a list of parameter dicts, one for each scenario (scenario table row)
-    if filename is not None:
-        scenario_table = pd.read_csv(filename)
-        if 'Campaign' not in scenario_table.columns:
-            raise MissingCampaignSpecificationException('Column \'Campaign\' is missing from %s if used' % filename)
-        scenario_param_dicts = scenario_table.to_dict(orient='records')
-        find_and_eval(scenario_param_dicts)  # convert any strings representing lists to actual python lists
-    else:
-        scenario_param_dicts = [{'Scenario': None, 'Campaign': None}]
-    return scenario_param_dicts
-
-
-def set_parameterization_ids(samples):
-    for index in range(len(samples)):
-        samples[index].parameterization_id = index
-    return samples
+    if reduction is not None:
+        # the full reports have to be downloaded first here, they are replaced by their reduction right away
+        for simulation in simulations:
+            for filename in download_filenames:
+                if not reduction.applies_to(filename):
+                    continue
+                full = os.path.join(output_path, download_destination(simulation.experiment.exp_name,
+                                                                      simulation.tags[TPI_TAG],
+                                                                      simulation.tags[REP_TAG], filename))
+                if os.path.exists(full):
+                    reduction.reduce_file(full, os.path.join(output_path, download_destination(
+                        simulation.experiment.exp_name, simulation.tags[TPI_TAG], simulation.tags[REP_TAG],
+                        reduction.reduced_filename(filename))))
+                    os.remove(full)
+
+
+def analyze_experiments(experiment_managers, output_path, suite_id, download_filenames, watcher=None,
+                        n_download_workers=DEFAULT_DOWNLOAD_WORKERS, reduction=None):
+    # Download (analyze) files for simulations as they finish up, reducing reports on the way if a reduction is given.
+    watcher = watcher or CompletionWatcher(experiment_managers, sleep=profiler.timed('polling_wait', time.sleep))
+    downloader = None
+    if SetupParser.get('type') in FILESYSTEM_BLOCK_TYPES:
+        downloader = ParallelDownloader(output_path=output_path, filenames=download_filenames,
+                                        n_workers=n_download_workers, reduction=reduction)
+    n_downloaded = 0
+    for finished_simulations in watcher.watch():
+        print('%d simulation(s) finished, downloading...' % len(finished_simulations))
+        if downloader is not None:
+            downloader.submit(finished_simulations)
+        else:
+            with profiler.phase('download'):
+                download_simulations(finished_simulations, output_path=output_path,
+                                     download_filenames=download_filenames, reduction=reduction)
+            profiler.count('files_downloaded', len(finished_simulations) * len(download_filenames))
+        n_downloaded += len(finished_simulations)
+    if downloader is not None:
+        # downloads run in the background while waiting, this is only the time spent waiting for the last ones
+        with profiler.phase('download'):
+            downloader.finish()
+        profiler.count('files_downloaded', downloader.n_copied + downloader.n_reduced)
+        profiler.count('bytes_downloaded', downloader.n_bytes)
+    print('Experiments complete. Downloaded files for %d simulation(s), %d simulation(s) did not succeed.' %
+          (n_downloaded, watcher.n_failed))
 
 
 def get_samples(args):
+    # returns a SampleStore
     resample_method = args.resample_method.lower()
 
     if resample_method == 'provided':
-        # the provided csv files needs to be in the exact same format at dumped into resampled_parameter_sets.csv below
-        samples = pd.read_csv(args.samples_file)
-        sample_dicts = samples.to_dict(orient='records')
-        try:
-            samples = [ParameterSet.from_dict(d) for d in sample_dicts]
-        except NaNDetectedError as e:
-            e.args = (f"One or more blank entries or lines found in samples file {args.samples_file} . "
-                      f"Please fix/remove them. Enjoy this dolphin.\n{DOLPHIN}",)
-            raise e
+        # the provided csv files needs to be in the exact same format at dumped into resampled_parameter_sets.csv below,
+        # or a directory with a saved SampleStore (memory-mapped)
+        if os.path.isdir(args.samples_file):
+            samples = SampleStore.load(args.samples_file, mmap=True)
+        else:
+            samples = SampleStore.from_csv(args.samples_file)
+        if len(samples.nan_rows()) > 0:
+            raise NaNDetectedError(f"One or more blank entries or lines found in samples file {args.samples_file} . "
+                                   f"Please fix/remove them. Enjoy this dolphin.\n{DOLPHIN}")
     else:
         if resample_method == 'roulette':
+            from calibtool.CalibManager import CalibManager
+
             # obtain existing samples and their likelihoods
             calib_manager = CalibManager.open_for_reading(args.calibration_dir)
             parameter_sets = calib_manager.get_parameter_sets_with_likelihoods()
-            sorted_parameter_sets = sorted(parameter_sets, key=lambda ps: ps.likelihood_exponentiated,
-                                           reverse=True)
-            # determine distribution of top and probabilistically selected samples
-            n_top_samples = int(np.ceil(args.n_samples / 3))
-            n_roulette_samples = args.n_samples - n_top_samples
-
-            # select the top samples - sorted_parameter_sets is sorted most<->least likely
-            top_samples = sorted_parameter_sets[0:n_top_samples]
-
-            # remove selected "top" samples and roulette sample the remaining to prevent duplication
-            remaining_sorted_parameter_sets = sorted_parameter_sets[n_top_samples:-1]
 
-            # normalize the parameter set likelihoods for probabilistic selection
-            total_likelihood = sum([ps.likelihood_exponentiated for ps in remaining_sorted_parameter_sets])
-            p = [ps.likelihood_exponentiated / total_likelihood for ps in remaining_sorted_parameter_sets]
-
-            # probabilistically select the remaining samples - duplicates of top_samples are allowed
-            roulette_samples = list(np.random.choice(remaining_sorted_parameter_sets, p=p, size=n_roulette_samples, replace=False))
-
-            samples = top_samples + roulette_samples
+            # ParameterSet.likelihood is the log-likelihood, sample on that instead of likelihood_exponentiated
+            log_likelihoods = np.fromiter((ps.likelihood for ps in parameter_sets), dtype=np.float64,
+                                          count=len(parameter_sets))
+            selected = roulette_resample(log_likelihoods, n_samples=args.n_samples,
+                                         rng=np.random.default_rng(args.seed))
+            samples = SampleStore.from_records(parameter_sets[index].to_dict() for index in selected)
         else:
             raise UnknownResampleMethodException('Unknown resample method: %s' % resample_method)
 
         # for readable logging purposes
-        samples = set_parameterization_ids(samples)
+        samples.set_parameterization_ids()
 
         # note that we are not re-writing this file if resample_method == 'provided'
-        samples_df = pd.DataFrame(data=[s.to_dict() for s in samples])
-        samples_df.to_csv('resampled_parameter_sets.csv', index=False)
+        samples.to_csv('resampled_parameter_sets.csv')
 
     return samples
 
 
 def main(args):
+    reduction = None
+    stored_filenames = args.download_filenames  # as stored in the output directory
+    if args.reduce:
+        reduction = reduction_spec_from_module(args.loaded_module, age_bins=args.reduce_age_bins,
+                                               group_by=args.reduce_group_by)
+        stored_filenames = [reduction.reduced_filename(f) if reduction.applies_to(f) else f
+                            for f in args.download_filenames]
+        print('Reduced reports are stored as %s_TPI####_REP####.csv' % reduction.reduced_basename)
+
     if args.suite_id:
-        if SetupParser.get('type') == 'CLUSTER':
+        if SetupParser.get('type') in FILESYSTEM_BLOCK_TYPES:
             from simtools.Utilities.ClusterUtilities import exps_for_suite_id
         else:
             from simtools.Utilities.COMPSUtilities import exps_for_suite_id
@@ -295,27 +504,71 @@ def main(args):
         experiments = exps_for_suite_id(args.suite_id)
         experiments = [retrieve_experiment(e.id) for e in experiments]
         experiment_managers = [ExperimentManagerFactory.from_experiment(experiment=exp) for exp in experiments]
-        if SetupParser.get('type') == 'CLUSTER':
-            for em in experiment_managers:
-                em.wait_for_finished()
+        if use_local_pool():
+            # simulations left unfinished by an interrupted run (queued or running) are run again
+            experiment_managers = run_simulations_on_local_pool(experiment_managers, rerun_finished=False)
+        elif suite_was_bundled(SetupParser.get('sim_root'), args.suite_id):
+            # decided by how the suite was submitted (its bundle manifest), not by the current bundle_size
+            experiment_managers = [BundledExperimentManager(em, status_timeout=get_status_timeout())
+                                   for em in experiment_managers]
+        # analyze_experiments waits for (and downloads) simulations as they finish
     else:
         # load scenario information
-        load_templates(args.loaded_module)
+        with profiler.phase('load_templates'):
+            load_templates(args.loaded_module)
 
         # load scenario table if needed - returns a virtually blank dataframe if no load was necessary
-        scenario_param_dicts = load_scenario_table(filename=args.scenario_table)
+        available_campaigns = set()
+        for scenario_template_set in args.loaded_module.run_calib_args['scenario_template_sets'].values():
+            available_campaigns.update(scenario_template_set['campaign'].keys())
+        scenario_param_dicts = load_scenario_table(filename=args.scenario_table, available_campaigns=available_campaigns)
 
         # now determine the samples to use as the basis for each scenario
-        samples = get_samples(args)
+        with profiler.phase('sampling'):
+            samples = get_samples(args)
+
+        if args.benchmark_generation:
+            specs = get_scenario_specs(args.loaded_module.run_calib_args['scenario_template_sets'],
+                                       scenario_param_dicts)
+            n_workers = max(args.generation_workers, 2)
+            serial_time, parallel_time = benchmark_generation(samples, specs, args.loaded_module, n_workers)
+            print('%d scenario table(s) of %d sample(s): %.2f s in one process, %.2f s with %d worker processes' %
+                  (len(specs), len(samples), serial_time, parallel_time, n_workers))
+            return
+
+        # in incremental mode, only combinations without results in the output directory are run
+        completion_index = CompletionIndex(args.output_path) if args.incremental else None
 
         # now run the samples X scenarios simulations
-        experiment_managers = build_and_run_simulations(samples,
-                                                        scenario_template_sets=args.loaded_module.run_calib_args['scenario_template_sets'],
-                                                        scenario_param_dicts=scenario_param_dicts,
-                                                        suite_name=args.suite_name,
-                                                        loaded_module=args.loaded_module)
+        with profiler.phase('generate_and_submit'), profiler.counting_deep_copies():
+            experiment_managers = build_and_run_simulations(samples,
+                                                            scenario_template_sets=args.loaded_module.run_calib_args['scenario_template_sets'],
+                                                            scenario_param_dicts=scenario_param_dicts,
+                                                            suite_name=args.suite_name,
+                                                            loaded_module=args.loaded_module,
+                                                            n_generation_workers=args.generation_workers,
+                                                            dedup_inputs=args.dedup_inputs,
+                                                            completion_index=completion_index,
+                                                            download_filenames=stored_filenames)
+        # all simulations are written, the parsed demographics are not needed while waiting and downloading
+        close_lazy_templates(args.loaded_module.run_calib_args['scenario_template_sets'])
     if not args.no_download:
-        analyze_experiments(experiment_managers, output_path=args.output_path, suite_id=args.suite_id, download_filenames=args.download_filenames)
+        with profiler.phase('wait_and_download'):
+            analyze_experiments(experiment_managers, output_path=args.output_path, suite_id=args.suite_id,
+                                download_filenames=args.download_filenames, n_download_workers=args.download_workers,
+                                reduction=reduction)
+        if args.incremental:
+            n_completed = CompletionIndex(args.output_path).update_completed()
+            print('Recorded %d newly completed simulation(s) in the completion index.' % n_completed)
+        if args.parquet_store is not None:
+            with profiler.phase('parquet_conversion'):
+                if reduction is None:
+                    convert_reports_to_parquet(output_path=args.output_path, dataset_path=args.parquet_store)
+                else:
+                    convert_reports_to_parquet(output_path=args.output_path, dataset_path=args.parquet_store,
+                                               report_basename=reduction.reduced_basename)
+    # written next to resampled_parameter_sets.csv
+    profiler.write_report(DEFAULT_REPORT_FILENAME)
     print('Done!')
 
 
@@ -330,28 +583,72 @@ def parse_args():
                         help='Resampling methodology to use (Required) (Valid: %s)' % RESAMPLING_METHODS_STR)
 
     parser.add_argument('--samples', dest='samples_file', type=str, default=None,
-                        help='csv file with user-defined samples to use (Required for resampling method \'provided\')')
+                        help='csv file with user-defined samples, or a directory with a saved SampleStore, to use '
+                             '(Required for resampling method \'provided\')')
 
     parser.add_argument('-n', '--nsamples', dest='n_samples', type=int, default=DEFAULT_N_SAMPLES,
                         help='Number of resampled parameter sets to generate and use (Default: %d) '
                              '(Not valid with resampling method \'provided\'.' % DEFAULT_N_SAMPLES)
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Random seed for resampling method \'roulette\', to make the selected samples reproducible '
+                             '(Default: unseeded).')
     parser.add_argument('-o', '--output-dir', dest='output_path', type=str, default=DEFAULT_OUTPUT_DIR,
                         help='Directory to hold scenario output files (Default: %s).'
                              % DEFAULT_OUTPUT_DIR)
     parser.add_argument('-f', '--files', dest='download_filenames', type=str, default=DEFAULT_DOWNLOAD_FILES,
                         help='Filenames to retrieve from scenario simulations (if downloading). Paths relative to simulation directories. Comma-separated list if more than one (Default: %s)' % DEFAULT_DOWNLOAD_FILES)
+    parser.add_argument('--generation-workers', dest='generation_workers', type=int,
+                        default=DEFAULT_GENERATION_WORKERS,
+                        help='Number of processes generating scenario tables concurrently when there is more than one '
+                             'scenario. Only sample mapping runs in the workers. With more than one worker, whole '
+                             'scenario tables are held in memory, so keep 1 for very large sample sets (Default: %d).'
+                             % DEFAULT_GENERATION_WORKERS)
+    parser.add_argument('--benchmark-generation', dest='benchmark_generation', action='store_true',
+                        help='Time generating the scenario tables in one process and in --generation-workers (at '
+                             'least 2) processes, then exit without creating a suite.')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='Only run (scenario, parameterization, replicate) combinations that do not already have '
+                             'results in --output-dir, merging new results into it (Default: run everything).')
+    parser.add_argument('--dedup-inputs', dest='dedup_inputs', action='store_true',
+                        help='Write identical generated simulation input files once per experiment, to '
+                             '<experiment dir>/input_assets, and link them into the simulation directories (Default: '
+                             'one copy per simulation).')
+    parser.add_argument('--download-workers', dest='download_workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+                        help='Number of files to download concurrently from a filesystem-based block (Default: %d).'
+                             % DEFAULT_DOWNLOAD_WORKERS)
+    parser.add_argument('--reduce', dest='reduce', action='store_true',
+                        help='Reduce each downloaded ReportHIVByAgeAndGender.csv to sums per year, province (county), '
+                             'gender and age bin of the columns needed for the ingest form\'s channels, storing only '
+                             'the reduced report (Default: store full reports).')
+    parser.add_argument('--reduce-age-bins', dest='reduce_age_bins', type=parse_age_bins, default=None,
+                        help='Comma-separated age bin edges for --reduce (Default: 15,25,35,50).')
+    parser.add_argument('--reduce-group-by', dest='reduce_group_by', type=parse_group_by, default=None,
+                        help='Comma-separated keys the reduced report is summed by, from Year, NodeId, Gender, Age, '
+                             'Province and AgeBin (Default: %s).' % ','.join(DEFAULT_GROUP_BY))
+    parser.add_argument('--parquet-store', dest='parquet_store', type=str, default=None,
+                        help='After downloading, convert the downloaded ReportHIVByAgeAndGender.csv files into a Parquet '
+                             'dataset at this path, partitioned by scenario and parameterization_id (Default: no '
+                             'conversion).')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Time each phase of suite generation, submission and download and write a timing report '
+                             'to %s (Default: no profiling).' % DEFAULT_REPORT_FILENAME)
+    parser.add_argument('--profile-phases', dest='profile_phases', type=str, default='',
+                        help='Comma-separated phases to also run under cProfile with --profile, e.g. '
+                             'mapping,template_application,create_simulations (Default: none).')
     parser.add_argument('--no-download', dest='no_download', action='store_true',
                         help='Do not download files after running scenarios (Default: download files).')
     parser.add_argument('-s', '--suite-name', dest='suite_name', type=str, required=True,
                         help='Name of suite for scenario experiment to be run (Required).')
     parser.add_argument('--table', dest='scenario_table', type=str, default=None,
-                        help='Scenarios will be generated using a csv table file (mutually exclusive with --template-sets).')
+                        help='Scenarios will be generated using a csv (or .parquet/.feather) table file (mutually exclusive with '
+                             '--template-sets).')
     parser.add_argument('--template-sets', dest='template_sets', action='store_true',
                         help='Scenarios will be generated using template sets (mutually exclusive with --table).')
     parser.add_argument('-id', dest='suite_id', type=str, default=None,
                         help='ID of existing scenarios suite to download. Will not run scenarios (Default: run scenarios.)')
     parser.add_argument('-b', '--block', dest='selected_block', type=str, default=DEFAULT_BLOCK,
-                        help='simtools.ini block to use (Default: %s)' % DEFAULT_BLOCK)
+                        help='simtools.ini block to use, e.g. LOCAL_POOL to run the simulations on this machine '
+                             '(Default: %s)' % DEFAULT_BLOCK)
 
     args = parser.parse_args()
     return args
@@ -370,15 +667,24 @@ if __name__ == '__main__':
     else:
         script_args.scenario_mode = SCENARIO_TEMPLATE_SETS_MODE
 
-    script_args.loaded_module = load_config_module(script_args.calibration_script)
-
-    n_template_sets = len(script_args.loaded_module.scenario_template_sets)
-    if n_template_sets == 0:
-        raise Exception('Cannot proceed with zero template sets in provided calibration script.')
-
-    if script_args.scenario_mode == SCENARIO_TABLE_MODE:
-        if n_template_sets > 1:
-            raise Exception('Exactly one template set (Baseline) must be specified in provided calibration script. There are %d.' % n_template_sets)
+    if script_args.profile:
+        profiler.enable(cprofile_phases=[phase for phase in script_args.profile_phases.split(',') if phase])
+    with profiler.phase('load_calibration_module'):
+        script_args.loaded_module = load_config_module(script_args.calibration_script)
+    # parsing (or loading the cached) ingest form is part of loading the calibration module
+    ingest_load_times = getattr(script_args.loaded_module, 'ingest_load_times', None)
+    if ingest_load_times is not None:
+        profiler.record('load_ingest_form', **ingest_load_times)
+
+    # templates are only loaded (by the calibration script) when scenarios are actually going to be generated
+    if script_args.suite_id is None:
+        n_template_sets = len(script_args.loaded_module.run_calib_args['scenario_template_sets'])
+        if n_template_sets == 0:
+            raise Exception('Cannot proceed with zero template sets in provided calibration script.')
+
+        if script_args.scenario_mode == SCENARIO_TABLE_MODE:
+            if n_template_sets > 1:
+                raise Exception('Exactly one template set (Baseline) must be specified in provided calibration script. There are %d.' % n_template_sets)
 
     if script_args.resample_method == 'provided':
         if script_args.samples_file is None:
@@ -0,0 +1,185 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Columnar store of the parameter sets (samples) that scenarios are run for: one float64 matrix of parameter values
+# (samples x parameters) plus parameterization_id and run_number arrays, instead of one ParameterSet object (and
+# several dicts) per sample. Samples are handed out row by row or in chunks, so callers never need all of them as
+# Python objects at once. Integer (and boolean) parameters, e.g. SeedYrHigh, are stored in the float64 matrix too and
+# are handed out with their original dtype again, so their values (and the fingerprints of incremental runs) are the
+# same as when read from the csv.
+#
+# A store can be saved as a directory of .npy files and loaded memory-mapped, e.g. for 10k+ samples:
+# SampleStore.from_csv('resampled_parameter_sets.csv').save('samples_store')
+# run_scenarios.py -m provided --samples samples_store ...
+#
+# roulette_resample selects the parameter sets of a calibration to run scenarios for (run_scenarios.py -m roulette).
+
+ID_COLUMN = 'parameterization_id'
+RUN_NUMBER_COLUMN = 'run_number'
+# columns of resampled_parameter_sets.csv that are not model parameters, kept as-is for writing the csv back out
+METADATA_COLUMNS = ['iteration_number', 'sim_id', 'likelihood']
+VALUES_FILENAME = 'values.npy'
+IDS_FILENAME = 'parameterization_id.npy'
+RUN_NUMBERS_FILENAME = 'run_number.npy'
+INFO_FILENAME = 'store.json'
+
+
+class SampleStore(object):
+    def __init__(self, names, values, parameterization_ids, run_numbers, metadata=None, columns=None, dtypes=None):
+        self.names = list(names)
+        self.values = values  # float64, len(samples) x len(names), possibly a read-only np.memmap
+        # name -> dtype of the parameters that are not float64 in the source, restored when samples are handed out
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in (dtypes or {}).items()}
+        self.parameterization_ids = np.asarray(parameterization_ids, dtype=np.int64)
+        self.run_numbers = np.asarray(run_numbers, dtype=np.int64)
+        self.metadata = metadata  # DataFrame of METADATA_COLUMNS present in the source, or None
+        self.columns = columns or [ID_COLUMN] + self.names + [RUN_NUMBER_COLUMN]  # csv column order
+        self.path = None  # set when loaded from disk
+
+    def __len__(self):
+        return len(self.parameterization_ids)
+
+    @classmethod
+    def from_dataframe(cls, samples):
+        # samples in the resampled_parameter_sets.csv format: ids, run numbers, metadata and one column per parameter
+        for column in [ID_COLUMN, RUN_NUMBER_COLUMN]:
+            if column not in samples.columns:
+                raise ValueError('Samples are missing the required column: %s' % column)
+        metadata_columns = [c for c in METADATA_COLUMNS if c in samples.columns]
+        names = [c for c in samples.columns if c not in [ID_COLUMN, RUN_NUMBER_COLUMN] + metadata_columns]
+        dtypes = {name: samples[name].dtype for name in names
+                  if samples[name].dtype.kind in 'iub' and samples[name].dtype != np.float64}
+        return cls(names=names,
+                   values=np.ascontiguousarray(samples[names].to_numpy(dtype=np.float64)),
+                   parameterization_ids=samples[ID_COLUMN].to_numpy(),
+                   run_numbers=samples[RUN_NUMBER_COLUMN].to_numpy(),
+                   metadata=samples[metadata_columns].reset_index(drop=True) if metadata_columns else None,
+                   columns=list(samples.columns),
+                   dtypes=dtypes)
+
+    @classmethod
+    def from_csv(cls, filename):
+        return cls.from_dataframe(pd.read_csv(filename))
+
+    @classmethod
+    def from_records(cls, records):
+        # records are dicts in the resampled_parameter_sets.csv format, e.g. ParameterSet.to_dict()
+        return cls.from_dataframe(pd.DataFrame.from_records(records))
+
+    def nan_rows(self):
+        # positions of samples with a missing (NaN) value, as in a csv with blank entries
+        missing = np.isnan(self.values).any(axis=1)
+        if self.metadata is not None:
+            missing |= self.metadata.isna().any(axis=1).to_numpy()
+        return np.flatnonzero(missing)
+
+    def set_parameterization_ids(self, parameterization_ids=None):
+        self.parameterization_ids = (np.arange(len(self), dtype=np.int64) if parameterization_ids is None
+                                     else np.asarray(parameterization_ids, dtype=np.int64))
+
+    def chunk(self, start, stop):
+        # DataFrame of the parameter values of samples [start, stop), one column per parameter
+        chunk = pd.DataFrame(self.values[start:stop], columns=self.names,
+                             index=pd.RangeIndex(start, min(stop, len(self))))
+        return chunk.astype(self.dtypes) if self.dtypes else chunk
+
+    def iter_chunks(self, chunk_size):
+        # (parameter DataFrame, run numbers, parameterization ids) for consecutive chunks of samples
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            yield self.chunk(start, stop), self.run_numbers[start:stop], self.parameterization_ids[start:stop]
+
+    def iter_records(self):
+        # (param_dict, run_number, parameterization_id) for one sample at a time
+        for i in range(len(self)):
+            param_dict = dict(zip(self.names, self.values[i].tolist()))
+            for name, dtype in self.dtypes.items():
+                param_dict[name] = dtype.type(param_dict[name]).item()
+            yield param_dict, int(self.run_numbers[i]), int(self.parameterization_ids[i])
+
+    def to_csv(self, filename, chunk_size=10000):
+        # writes the samples in the resampled_parameter_sets.csv format, chunk by chunk
+        for start in range(0, max(len(self), 1), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            chunk = self.chunk(start, stop)
+            chunk[ID_COLUMN] = self.parameterization_ids[start:stop]
+            chunk[RUN_NUMBER_COLUMN] = self.run_numbers[start:stop]
+            if self.metadata is not None:
+                for column in self.metadata.columns:
+                    chunk[column] = self.metadata[column].to_numpy()[start:stop]
+            chunk[self.columns].to_csv(filename, index=False, mode='w' if start == 0 else 'a', header=start == 0)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, VALUES_FILENAME), np.asarray(self.values, dtype=np.float64))
+        np.save(os.path.join(path, IDS_FILENAME), self.parameterization_ids)
+        np.save(os.path.join(path, RUN_NUMBERS_FILENAME), self.run_numbers)
+        info = {'names': self.names, 'columns': self.columns,
+                'dtypes': {name: dtype.str for name, dtype in self.dtypes.items()},
+                'metadata': None if self.metadata is None else self.metadata.to_dict(orient='list')}
+        with open(os.path.join(path, INFO_FILENAME), 'w') as f:
+            json.dump(info, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # with mmap, parameter values are read from disk as they are used instead of all at once
+        with open(os.path.join(path, INFO_FILENAME)) as f:
+            info = json.load(f)
+        store = cls(names=info['names'],
+                    values=np.load(os.path.join(path, VALUES_FILENAME), mmap_mode='r' if mmap else None),
+                    parameterization_ids=np.load(os.path.join(path, IDS_FILENAME)),
+                    run_numbers=np.load(os.path.join(path, RUN_NUMBERS_FILENAME)),
+                    metadata=None if info['metadata'] is None else pd.DataFrame(info['metadata']),
+                    columns=info['columns'],
+                    dtypes=info.get('dtypes'))
+        store.path = path
+        return store
+
+    def __getstate__(self):
+        # a memory-mapped store is sent to worker processes by path, they map the same file
+        state = dict(self.__dict__)
+        if self.path is not None and isinstance(self.values, np.memmap):
+            state['values'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.values is None:
+            self.values = np.load(os.path.join(self.path, VALUES_FILENAME), mmap_mode='r')
+
+
+def roulette_resample(log_likelihoods, n_samples, rng):
+    """
+    Returns the indices of n_samples parameter sets: the ceil(n_samples / 3) most likely ones, plus the rest drawn from
+    the remaining sets with probability proportional to their likelihood, without replacement. Everything is done on
+    log-likelihoods, so values that would overflow when exponentiated are handled exactly. Weighted sampling without
+    replacement uses the Gumbel-top-k trick: the k largest of log(p) + Gumbel noise are such a sample.
+    """
+    from scipy.special import logsumexp
+
+    log_likelihoods = np.asarray(log_likelihoods, dtype=np.float64)
+    log_likelihoods = np.where(np.isnan(log_likelihoods), -np.inf, log_likelihoods)  # unusable sets are never drawn
+    n_top_samples = int(np.ceil(n_samples / 3))
+    n_roulette_samples = n_samples - n_top_samples
+    if n_samples > np.isfinite(log_likelihoods).sum():
+        raise ValueError('Cannot select %d samples from %d parameter sets with a finite likelihood.' %
+                         (n_samples, np.isfinite(log_likelihoods).sum()))
+
+    # select the top samples, most likely first
+    top_indices = np.argpartition(-log_likelihoods, n_top_samples - 1)[:n_top_samples]
+    top_indices = top_indices[np.argsort(-log_likelihoods[top_indices])]
+
+    # roulette sample the remaining sets to prevent duplication of the top samples
+    remaining_indices = np.setdiff1d(np.arange(len(log_likelihoods)), top_indices, assume_unique=True)
+    if n_roulette_samples == 0:
+        return top_indices
+    log_p = log_likelihoods[remaining_indices] - logsumexp(log_likelihoods[remaining_indices])
+    print('Roulette sampling from %d parameter sets, effective sample size: %.1f' %
+          (len(remaining_indices), 1 / np.sum(np.exp(2 * log_p))))
+    keys = log_p + rng.gumbel(size=len(log_p))
+    roulette_positions = np.argpartition(-keys, n_roulette_samples - 1)[:n_roulette_samples]
+    roulette_positions = roulette_positions[np.argsort(-keys[roulette_positions])]
+    return np.concatenate([top_indices, remaining_indices[roulette_positions]])
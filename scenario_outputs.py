@@ -0,0 +1,179 @@
+import os
+import re
+import time
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+# Helpers for working with the per-simulation report files downloaded by run_scenarios.py, which are laid out as
+# <output_path>/<scenario (experiment) name>/<report basename>_TPI####_REP####.csv
+#
+# The Parquet result store needs pyarrow (see README.md). Compare loading the reports from the csv files and from the
+# store (converted first if it does not exist yet) with, e.g.
+# python scenario_outputs.py sim_output sim_output.parquet --columns Year,Infected,Population
+
+TPI_TAG = 'parameterization_id'
+REP_TAG = 'Run_Number'
+SCENARIO_COLUMN = 'Scenario'
+
+DEFAULT_REPORT_BASENAME = 'ReportHIVByAgeAndGender'
+DEFAULT_CHUNKSIZE = 500000
+
+# ReportHIVByAgeAndGender.csv columns that identify a row rather than count people
+KEY_COLUMNS = ['Year', 'NodeId', 'Gender', 'Age']
+CATEGORICAL_COLUMNS = ['Gender', 'Age']
+
+REPORT_FILENAME_REGEX = re.compile(r'^(?P<basename>.+)_TPI(?P<tpi>\d+)_REP(?P<rep>\d+)\.csv$')
+
+
+def iter_report_files(output_path, report_basename=DEFAULT_REPORT_BASENAME):
+    # yields (scenario, parameterization_id, run_number, filename) for every downloaded report, in a stable order
+    for scenario in sorted(os.listdir(output_path)):
+        scenario_dir = os.path.join(output_path, scenario)
+        if not os.path.isdir(scenario_dir):
+            continue
+        for filename in sorted(os.listdir(scenario_dir)):
+            match = REPORT_FILENAME_REGEX.match(filename)
+            if match is None or match.group('basename') != report_basename:
+                continue
+            yield scenario, int(match.group('tpi')), int(match.group('rep')), os.path.join(scenario_dir, filename)
+
+
+def download_destination(scenario_name, parameterization_id, run_number, filename):
+    # where a simulation's file ends up relative to the output directory, same naming as DownloadAnalyzerTPI
+    basename, extension = os.path.splitext(os.path.basename(filename))
+    return os.path.join(scenario_name, '%s_TPI%04d_REP%04d%s' % (basename, int(parameterization_id), int(run_number),
+                                                               extension))
+
+
+def compact_report_dtypes(report):
+    # categoricals for the small-cardinality strata, float32 for all people counts
+    for column in report.columns:
+        if column in CATEGORICAL_COLUMNS or report[column].dtype == object:
+            report[column] = report[column].astype('category')
+        elif column == 'NodeId':
+            report[column] = report[column].astype(np.int32)
+        elif column not in KEY_COLUMNS and np.issubdtype(report[column].dtype, np.number):
+            report[column] = report[column].astype(np.float32)
+    return report
+
+
+def remove_converted_report(dataset_path, scenario, parameterization_id, prefix):
+    # the Scenario / parameterization_id partition directory, its values URL-encoded by recent pyarrow versions
+    for scenario_dir in {str(scenario), quote(str(scenario), safe='')}:
+        partition_dir = os.path.join(dataset_path, '%s=%s' % (SCENARIO_COLUMN, scenario_dir),
+                                     '%s=%s' % (TPI_TAG, parameterization_id))
+        if not os.path.isdir(partition_dir):
+            continue
+        for name in os.listdir(partition_dir):
+            if name.startswith(prefix):
+                os.remove(os.path.join(partition_dir, name))
+
+
+def convert_reports_to_parquet(output_path, dataset_path, report_basename=DEFAULT_REPORT_BASENAME,
+                               chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Streams every downloaded report in output_path, chunk by chunk, into one Parquet dataset at dataset_path that is
+    partitioned by Scenario and parameterization_id. The Run_Number is added as a column. Re-running the conversion
+    replaces the files of a report instead of duplicating them.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is required to write the Parquet result store (pip install pyarrow)')
+
+    n_reports = 0
+    n_rows = 0
+    for scenario, parameterization_id, run_number, filename in iter_report_files(output_path, report_basename):
+        # a report converted before may have had more chunks than now, none of its earlier files may be left over
+        remove_converted_report(dataset_path, scenario, parameterization_id,
+                                '%s_REP%04d_chunk' % (report_basename, run_number))
+        for chunk_number, chunk in enumerate(pd.read_csv(filename, chunksize=chunksize)):
+            chunk = compact_report_dtypes(chunk)
+            chunk[SCENARIO_COLUMN] = scenario
+            chunk[TPI_TAG] = parameterization_id
+            chunk[REP_TAG] = np.int32(run_number)
+            pq.write_to_dataset(pa.Table.from_pandas(chunk, preserve_index=False), root_path=dataset_path,
+                                partition_cols=[SCENARIO_COLUMN, TPI_TAG],
+                                basename_template='%s_REP%04d_chunk%d_{i}.parquet' % (report_basename, run_number,
+                                                                                       chunk_number))
+            n_rows += len(chunk)
+        n_reports += 1
+    print('Converted %d report(s) (%d rows) into Parquet dataset: %s' % (n_reports, n_rows, dataset_path))
+    return n_reports
+
+
+def load_result_store(dataset_path, columns=None, scenarios=None, parameterization_ids=None):
+    # reads only the requested columns and Scenario/parameterization_id partitions of a converted result store
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is required to read the Parquet result store (pip install pyarrow)')
+
+    filters = []
+    if scenarios is not None:
+        filters.append((SCENARIO_COLUMN, 'in', list(scenarios)))
+    if parameterization_ids is not None:
+        filters.append((TPI_TAG, 'in', list(parameterization_ids)))
+    table = pq.read_table(dataset_path, columns=columns, filters=filters or None)
+    return table.to_pandas()
+
+
+def load_report_files(output_path, columns=None, report_basename=DEFAULT_REPORT_BASENAME):
+    # the csv counterpart of load_result_store: all downloaded reports in one DataFrame
+    frames = []
+    for scenario, parameterization_id, run_number, filename in iter_report_files(output_path, report_basename):
+        usecols = None if columns is None else [c for c in columns if c not in (SCENARIO_COLUMN, TPI_TAG, REP_TAG)]
+        frame = pd.read_csv(filename, usecols=usecols)
+        frame[SCENARIO_COLUMN] = scenario
+        frame[TPI_TAG] = parameterization_id
+        frame[REP_TAG] = run_number
+        frames.append(frame if columns is None else frame[columns])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, filename)) for root, _, filenames in os.walk(path)
+               for filename in filenames)
+
+
+def benchmark(output_path, dataset_path, columns=None, n_repeats=3):
+    """
+    Loads all reports from the csv files and from the Parquet result store (converted first, untimed, if dataset_path
+    does not exist). Returns (seconds, bytes in memory, bytes on disk) for each, the best time of n_repeats loads.
+    """
+    if not os.path.exists(dataset_path):
+        convert_reports_to_parquet(output_path, dataset_path)
+    csv_disk = sum(os.path.getsize(filename) for _, _, _, filename in iter_report_files(output_path))
+
+    results = []
+    for load, disk in [(lambda: load_report_files(output_path, columns=columns), csv_disk),
+                       (lambda: load_result_store(dataset_path, columns=columns), _disk_usage(dataset_path))]:
+        times = []
+        for _ in range(n_repeats):
+            start = time.perf_counter()
+            frame = load()
+            times.append(time.perf_counter() - start)
+        results.append((min(times), int(frame.memory_usage(deep=True).sum()), disk))
+    return tuple(results)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_path', type=str, help='Directory of downloaded reports (run_scenarios.py --output-dir).')
+    parser.add_argument('dataset_path', type=str, help='Parquet result store, converted first if it does not exist.')
+    parser.add_argument('--columns', dest='columns', type=str, default=None,
+                        help='Comma-separated columns to load (Default: all).')
+    parser.add_argument('--repeats', dest='n_repeats', type=int, default=3, help='Timing repeats (Default: 3).')
+    script_args = parser.parse_args()
+
+    columns = None if script_args.columns is None else script_args.columns.split(',')
+    for name, (seconds, memory, disk) in zip(['csv', 'Parquet'], benchmark(script_args.output_path,
+                                                                          script_args.dataset_path, columns=columns,
+                                                                          n_repeats=script_args.n_repeats)):
+        print('%-8s %8.2f s to load %8.1f MB in memory %8.1f MB on disk' % (name, seconds, memory / 1e6, disk / 1e6))
@@ -0,0 +1,93 @@
+import ast
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Reading of the scenario tables given to run_scenarios.py --table: one row per scenario, with a Campaign column and
+# a column per model parameter. Cells such as [1,2,3] are parsed into lists as literals, nothing in a table is
+# executed.
+
+
+class MissingCampaignSpecificationException(Exception):
+    pass
+
+
+class UnknownCampaignException(Exception):
+    pass
+
+
+class ScenarioTableParseException(Exception):
+    pass
+
+
+def is_text_column(values):
+    # object columns, and string columns (pandas >= 3 reads text as the str dtype instead of object)
+    return pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+
+
+def parse_literal(value):
+    # strings representing lists/matrices, e.g. '[1,2,3]' => [1,2,3]. Only literals are accepted, nothing is executed.
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def parse_literal_columns(scenario_table, filename):
+    # converts, column by column, any string cells representing lists to actual python lists
+    for column in scenario_table.columns:
+        values = scenario_table[column]
+        if not is_text_column(values):
+            continue
+        is_literal = [isinstance(v, str) and '[' in v for v in values]
+        if not any(is_literal):
+            continue
+        try:
+            scenario_table[column] = [parse_literal(v) if literal else v for v, literal in zip(values, is_literal)]
+        except (ValueError, SyntaxError) as e:
+            raise ScenarioTableParseException('Column %s of %s contains a value that is not a valid list literal: %s' %
+                                              (column, filename, e))
+    return scenario_table
+
+
+def read_scenario_table(filename):
+    # csv, or Parquet/feather tables with native list columns
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.parquet', '.pq'):
+        scenario_table = pd.read_parquet(filename)
+    elif extension in ('.feather', '.ftr'):
+        scenario_table = pd.read_feather(filename)
+    else:
+        return parse_literal_columns(pd.read_csv(filename), filename=filename)
+
+    # native list columns are read as numpy arrays
+    for column in scenario_table.columns:
+        if is_text_column(scenario_table[column]):
+            scenario_table[column] = scenario_table[column].map(lambda v: v.tolist() if isinstance(v, np.ndarray) else v)
+    return scenario_table
+
+
+def load_scenario_table(filename, available_campaigns=None):
+    # returns a list of parameter dicts, one for each scenario (scenario table row)
+    if filename is not None:
+        scenario_table = read_scenario_table(filename)
+        if 'Campaign' not in scenario_table.columns:
+            raise MissingCampaignSpecificationException('Column \'Campaign\' is missing from %s if used' % filename)
+
+        # blank Scenario/Campaign cells mean 'not specified'
+        for column in ['Scenario', 'Campaign']:
+            if column in scenario_table.columns:
+                scenario_table[column] = scenario_table[column].astype(object).where(scenario_table[column].notna(), None)
+
+        # check the campaigns before anything is generated or submitted
+        if available_campaigns is not None:
+            unknown = sorted(set(scenario_table['Campaign'].dropna()) - set(available_campaigns))
+            if unknown:
+                raise UnknownCampaignException('Unknown campaign(s) in %s: %s . Available campaigns: %s' %
+                                               (filename, ', '.join(unknown), ', '.join(sorted(available_campaigns))))
+        scenario_param_dicts = scenario_table.to_dict(orient='records')
+    else:
+        scenario_param_dicts = [{'Scenario': None, 'Campaign': None}]
+    return scenario_param_dicts
@@ -0,0 +1,336 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs EMOD simulation directories in bundles: the simulations of a suite are split into bundles of bundle_size
+# simulations, all bundles are submitted as ONE Slurm job array, and each array task runs the simulations of its
+# bundle concurrently (one per cpu) from a local work queue. The progress of every simulation is recorded in a status
+# file in its directory, which BundledExperimentManager reads to look like a regular experiment manager to
+# run_scenarios.analyze_experiments .
+#
+# Bundling is enabled with bundle_size > 1 in the simtools.ini block. The bundle manifest is written to
+# <sim_root>/bundles_<suite id>/bundles.json, which also records that the suite was bundled: run_scenarios.py -id
+# tracks a suite through its status files only if that manifest exists, whatever bundle_size is set to by then.
+#
+# A simulation without a status file is in an unknown state. With a status_timeout, a simulation that has been Running
+# (since its array task started it) or without a status file for that many seconds (e.g. its array task was killed by
+# the scheduler) is counted as failed; set it above the array's time_limit. Queued (Created) simulations never time
+# out, however long the array waits in the Slurm queue.
+#
+# The sbatch executable is taken from sbatch_command so that a local fake can run the array tasks as plain
+# subprocesses, e.g. sbatch_command = python fake_sbatch.py
+
+STATUS_FILENAME = 'bundle_status.txt'
+STATE_QUEUED = 'Created'
+STATE_RUNNING = 'Running'
+STATE_SUCCEEDED = 'Succeeded'
+STATE_FAILED = 'Failed'
+STATE_UNKNOWN = 'Unknown'
+FINAL_STATES = (STATE_SUCCEEDED, STATE_FAILED)
+BUNDLE_MANIFEST_FILENAME = 'bundles.json'
+
+DEFAULT_BUNDLE_COMMAND = '{exe_path} --config config.json --input-path {input_root}'
+DEFAULT_SBATCH_COMMAND = 'sbatch'
+
+
+# simulation processes started by run_simulation in this process, by sim_dir, so they can be stopped on exit
+_running_processes = {}
+_running_lock = threading.Lock()
+_stopping = threading.Event()
+
+
+def absolute_paths(value):
+    # the words of a command setting (exe_path, input_root) that are existing relative paths, made absolute, because
+    # simulations run in their own directory
+    if not value:
+        return value
+    return ' '.join(os.path.abspath(word) if not os.path.isabs(word) and os.path.exists(word) else word
+                    for word in value.split())
+
+
+def bundle_dir_for_suite(sim_root, suite_id):
+    return os.path.join(sim_root, 'bundles_%s' % suite_id)
+
+
+def suite_was_bundled(sim_root, suite_id):
+    return os.path.exists(os.path.join(bundle_dir_for_suite(sim_root, suite_id), BUNDLE_MANIFEST_FILENAME))
+
+
+def plan_bundles(sim_dirs, bundle_size):
+    return [sim_dirs[start:start + bundle_size] for start in range(0, len(sim_dirs), bundle_size)]
+
+
+def current_owner():
+    return '%s %d' % (socket.gethostname(), os.getpid())
+
+
+def write_status(sim_dir, state, owner=None):
+    # owner (current_owner() of the process that will run the simulation) is recorded on a second line
+    partial = os.path.join(sim_dir, STATUS_FILENAME + '.part')
+    with open(partial, 'w') as f:
+        f.write(state if owner is None else '%s\n%s' % (state, owner))
+    os.replace(partial, os.path.join(sim_dir, STATUS_FILENAME))
+
+
+def _read_status_lines(sim_dir):
+    try:
+        with open(os.path.join(sim_dir, STATUS_FILENAME)) as f:
+            return f.read().split('\n')
+    except OSError:
+        return None
+
+
+def read_status(sim_dir):
+    lines = _read_status_lines(sim_dir)
+    return None if lines is None else lines[0].strip()
+
+
+def owner_is_alive(sim_dir):
+    """
+    Whether the process recorded as the owner of the simulation's status may still be running it: True for a live
+    process of this host and for owners on other hosts (which cannot be checked), False without an owner.
+    """
+    lines = _read_status_lines(sim_dir)
+    if lines is None or len(lines) < 2 or not lines[1].strip():
+        return False
+    host, pid = lines[1].strip().rsplit(' ', 1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def stop_running_simulations():
+    """
+    Kills the process groups of all simulations run by this process and puts them back in the queued state, so that
+    they are run again when the suite is resumed. No new simulations or retries are started afterwards.
+    """
+    _stopping.set()
+    with _running_lock:
+        processes = dict(_running_processes)
+    for sim_dir, process in processes.items():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+        write_status(sim_dir, STATE_QUEUED)
+    if processes:
+        print('Stopped %d running simulation(s)' % len(processes))
+
+
+def status_age(sim_dir):
+    # seconds since the status file was last written, or None if there is none
+    try:
+        return time.time() - os.path.getmtime(os.path.join(sim_dir, STATUS_FILENAME))
+    except OSError:
+        return None
+
+
+def write_bundle_manifest(manifest_filename, bundles, command):
+    # command is formatted with {sim_dir} and {sim_name} (plus anything already substituted by the caller) for each
+    # simulation
+    for bundle in bundles:
+        for sim_dir in bundle:
+            write_status(sim_dir, STATE_QUEUED)
+    with open(manifest_filename, 'w') as f:
+        json.dump({'command': command, 'bundles': bundles}, f, indent=2)
+
+
+def write_array_script(script_filename, manifest_filename, n_bundles, bundle_size, partition=None, time_limit=None,
+                       memory_per_cpu=None, account=None, notification_email=None, job_name='EMOD_bundles'):
+    log_dir = os.path.dirname(os.path.abspath(manifest_filename))
+    lines = [
+        '#!/bin/bash',
+        '#SBATCH --job-name=%s' % job_name,
+        '#SBATCH --array=0-%d' % (n_bundles - 1),
+        '#SBATCH --nodes=1',
+        '#SBATCH --ntasks-per-node=1',
+        '#SBATCH --cpus-per-task=%d' % bundle_size,
+        '#SBATCH --output=%s' % os.path.join(log_dir, 'bundle_%A_%a.out')
+    ]
+    if partition:
+        lines.append('#SBATCH --partition=%s' % partition)
+    if time_limit:
+        lines.append('#SBATCH --time=%s' % time_limit)
+    if memory_per_cpu:
+        lines.append('#SBATCH --mem-per-cpu=%s' % memory_per_cpu)
+    if account:
+        lines.append('#SBATCH --account=%s' % account)
+    if notification_email:
+        lines.append('#SBATCH --mail-type=END')
+        lines.append('#SBATCH --mail-user=%s' % notification_email)
+    lines.append('')
+    lines.append('%s %s run-bundle %s ${SLURM_ARRAY_TASK_ID} --workers %d' %
+                 (sys.executable, os.path.abspath(__file__), os.path.abspath(manifest_filename), bundle_size))
+    with open(script_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return script_filename
+
+
+def submit_array_script(script_filename, sbatch_command=DEFAULT_SBATCH_COMMAND):
+    result = subprocess.run(sbatch_command.split() + [script_filename], check=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    print(result.stdout.strip())
+    return result.stdout
+
+
+def run_simulation(sim_dir, command, timeout=None, retries=0, owner=None):
+    # runs one simulation in its directory, capturing its output like the regular cluster runner does. A failed or timed
+    # out run is retried up to retries times; only the final outcome is written to the status file. After
+    # stop_running_simulations, nothing is run and the simulation is left queued.
+    if _stopping.is_set():
+        return STATE_QUEUED
+    write_status(sim_dir, STATE_RUNNING, owner=owner)
+    for attempt in range(retries + 1):
+        with open(os.path.join(sim_dir, 'StdOut.txt'), 'w') as stdout, \
+                open(os.path.join(sim_dir, 'StdErr.txt'), 'w') as stderr:
+            # in its own process group, so that a timeout also stops what the command started (e.g. singularity)
+            with _running_lock:
+                if _stopping.is_set():
+                    write_status(sim_dir, STATE_QUEUED)
+                    return STATE_QUEUED
+                process = subprocess.Popen(command.format(sim_dir=sim_dir, sim_name=os.path.basename(sim_dir)),
+                                           shell=True, cwd=sim_dir, stdout=stdout, stderr=stderr,
+                                           start_new_session=True)
+                _running_processes[sim_dir] = process
+            try:
+                return_code = process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                stderr.write('Simulation timed out after %s seconds\n' % timeout)
+                return_code = None
+            finally:
+                with _running_lock:
+                    _running_processes.pop(sim_dir, None)
+        if _stopping.is_set():
+            return STATE_QUEUED  # killed by stop_running_simulations, which has reset the status
+        if return_code == 0:
+            break
+        if attempt < retries:
+            print('Simulation in %s failed (attempt %d of %d), retrying.' % (sim_dir, attempt + 1, retries + 1))
+    state = STATE_SUCCEEDED if return_code == 0 else STATE_FAILED
+    write_status(sim_dir, state)
+    return state
+
+
+def run_bundle(manifest_filename, bundle_index, n_workers):
+    with open(manifest_filename) as f:
+        manifest = json.load(f)
+    sim_dirs = manifest['bundles'][bundle_index]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        states = list(executor.map(lambda sim_dir: run_simulation(sim_dir, manifest['command']), sim_dirs))
+    n_failed = states.count(STATE_FAILED)
+    print('Bundle %d: %d simulation(s) succeeded, %d failed.' % (bundle_index, len(states) - n_failed, n_failed))
+    return n_failed
+
+
+def submit_bundles(experiment_managers, bundle_size, bundle_dir, command, sbatch_command=DEFAULT_SBATCH_COMMAND,
+                   status_timeout=None, **sbatch_options):
+    """
+    Bundles all (already created, not yet commissioned) simulations of the given experiment managers into a single
+    Slurm job array and submits it. Returns BundledExperimentManager wrappers for tracking the simulations.
+    """
+    sim_dirs = [simulation.get_path() for em in experiment_managers for simulation in em.experiment.simulations]
+    bundles = plan_bundles(sim_dirs, bundle_size)
+    os.makedirs(bundle_dir, exist_ok=True)
+    manifest_filename = os.path.join(bundle_dir, BUNDLE_MANIFEST_FILENAME)
+    write_bundle_manifest(manifest_filename, bundles, command)
+    script_filename = write_array_script(os.path.join(bundle_dir, 'bundles.sbatch'), manifest_filename,
+                                         n_bundles=len(bundles), bundle_size=bundle_size, **sbatch_options)
+    print('Submitting %d simulation(s) as %d bundle(s) of up to %d simulation(s)' %
+          (len(sim_dirs), len(bundles), bundle_size))
+    submit_array_script(script_filename, sbatch_command=sbatch_command)
+    return [BundledExperimentManager(em, status_timeout=status_timeout) for em in experiment_managers]
+
+
+class BundledSimulation(object):
+    # a simulation whose status comes from its bundle status file instead of the scheduler
+    def __init__(self, simulation, status_timeout=None):
+        self.simulation = simulation
+        self.status_timeout = status_timeout
+        self.status = None
+        self.missing_since = None  # when the status file was first found missing
+
+    def __getattr__(self, name):
+        return getattr(self.simulation, name)
+
+    def refresh_status(self):
+        sim_dir = self.simulation.get_path()
+        status = read_status(sim_dir)
+        if status in FINAL_STATES:
+            self.status = status
+            return
+        if status is None:
+            self.missing_since = self.missing_since or time.time()
+            age = time.time() - self.missing_since
+        else:
+            self.missing_since = None
+            # the status file is rewritten when the simulation starts, so this is the time it has been running
+            age = (status_age(sim_dir) or 0) if status == STATE_RUNNING else 0
+        if self.status_timeout is not None and age > self.status_timeout:
+            print('Simulation in %s has been %s for %d s, counting it as failed' %
+                  (sim_dir, status or 'without a status', age))
+            status = STATE_FAILED
+        self.status = status or STATE_UNKNOWN
+
+
+class BundledExperiment(object):
+    def __init__(self, experiment, status_timeout=None):
+        self.experiment = experiment
+        self.simulations = [BundledSimulation(simulation, status_timeout=status_timeout)
+                            for simulation in experiment.simulations]
+
+    def __getattr__(self, name):
+        return getattr(self.experiment, name)
+
+
+class BundledExperimentManager(object):
+    # provides the experiment manager interface used by run_scenarios.analyze_experiments for bundled simulations
+    def __init__(self, experiment_manager, status_timeout=None):
+        self.experiment_manager = experiment_manager
+        self.experiment = BundledExperiment(experiment_manager.experiment, status_timeout=status_timeout)
+        self.refresh_experiment()
+
+    def refresh_experiment(self):
+        for simulation in self.experiment.simulations:
+            simulation.refresh_status()
+
+    def finished(self):
+        return all(simulation.status in FINAL_STATES for simulation in self.experiment.simulations)
+
+    def wait_for_finished(self, poll_interval=30):
+        while not self.finished():
+            time.sleep(poll_interval)
+            self.refresh_experiment()
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='action')
+    run_parser = subparsers.add_parser('run-bundle', help='Run the simulations of one bundle (used by array tasks).')
+    run_parser.add_argument('manifest', type=str, help='Bundle manifest json written at submission.')
+    run_parser.add_argument('bundle_index', type=int, help='Index of the bundle to run (SLURM_ARRAY_TASK_ID).')
+    run_parser.add_argument('--workers', dest='n_workers', type=int, default=1,
+                            help='Number of simulations of the bundle to run concurrently (Default: 1).')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    script_args = parse_args()
+    if script_args.action == 'run-bundle':
+        n_failed = run_bundle(script_args.manifest, script_args.bundle_index, script_args.n_workers)
+        sys.exit(1 if n_failed else 0)
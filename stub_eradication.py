@@ -0,0 +1,57 @@
+import json
+import os
+import random
+import sys
+import time
+
+# Stand-in for the Eradication executable, for trying out the LOCAL_POOL backend and the download/reduction/scoring
+# steps without running EMOD. Accepts the same --config/--input-path arguments, sleeps a little and writes a
+# ReportHIVByAgeAndGender.csv with random counts for the years of the config's Base_Year/Simulation_Duration.
+#
+# Behaviour can be changed with environment variables:
+# STUB_ERADICATION_SECONDS - run time of each simulation (Default: 1)
+# STUB_ERADICATION_FAIL_RATE - probability that a run fails, to exercise retries (Default: 0)
+# STUB_ERADICATION_NODES - comma-separated NodeIds in the report (Default: 1)
+
+REPORT_COLUMNS = ['Year', 'NodeId', 'Gender', 'Age', 'Population', 'Infected', 'Newly Infected', 'On_ART',
+                  'Died_from_HIV']
+
+
+def write_report(filename, base_year, n_years, node_ids, rng):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(','.join(REPORT_COLUMNS) + '\n')
+        for step in range(int(n_years * 2)):
+            year = base_year + 0.5 * step
+            for node_id in node_ids:
+                for gender in [0, 1]:
+                    for age in range(0, 100, 5):
+                        population = rng.randint(100, 1000)
+                        infected = rng.randint(0, population // 4)
+                        f.write('%g,%d,%d,%d,%d,%d,%d,%d,%d\n' %
+                                (year, node_id, gender, age, population, infected, rng.randint(0, 10),
+                                 rng.randint(0, infected), rng.randint(0, 5)))
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', dest='config', type=str, default='config.json')
+    parser.add_argument('--input-path', dest='input_path', type=str, default='.')
+    return parser.parse_known_args()[0]
+
+
+if __name__ == '__main__':
+    script_args = parse_args()
+    with open(script_args.config) as f:
+        parameters = json.load(f).get('parameters', {})
+    rng = random.Random(parameters.get('Run_Number', 0))
+    time.sleep(float(os.environ.get('STUB_ERADICATION_SECONDS', 1)))
+    if random.random() < float(os.environ.get('STUB_ERADICATION_FAIL_RATE', 0)):
+        print('Stub failure')
+        sys.exit(1)
+    base_year = float(parameters.get('Base_Year', 1960.5))
+    n_years = float(parameters.get('Simulation_Duration', 365 * 10)) / 365
+    node_ids = [int(n) for n in os.environ.get('STUB_ERADICATION_NODES', '1').split(',')]
+    write_report(os.path.join('output', 'ReportHIVByAgeAndGender.csv'), base_year, n_years, node_ids, rng)
+    print('Stub simulation finished')
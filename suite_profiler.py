@@ -0,0 +1,161 @@
+import contextlib
+import copy
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+# Phase timers and counters for run_scenarios.py --profile. Each phase records its wall time and the process CPU time
+# spent during it; a phase whose CPU time is close to its wall time is CPU-bound, one with little CPU time is waiting
+# on I/O (e.g. GPFS) or on the scheduler. Selected phases can additionally be run under cProfile.
+#
+# When profiling is not enabled every call is a cheap no-op, so the instrumentation can stay in place.
+
+DEFAULT_REPORT_FILENAME = 'suite_profile.json'
+N_PROFILE_FUNCTIONS = 25  # functions listed per cProfile'd phase in the report
+
+
+class SuiteProfiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_phases = set()
+        self.phases = {}  # name -> {'calls', 'wall_seconds', 'cpu_seconds'}
+        self.counters = {}
+        self.profiles = {}  # phase name -> pstats.Stats
+        self.lock = threading.Lock()
+        self._cprofile_active = False
+        self.start_time = None
+
+    def enable(self, cprofile_phases=()):
+        self.enabled = True
+        self.cprofile_phases = set(cprofile_phases)
+        self.start_time = time.perf_counter()
+
+    def record(self, name, wall_seconds, cpu_seconds):
+        # adds one call of phase name, for phases timed elsewhere
+        if not self.enabled:
+            return
+        with self.lock:
+            phase = self.phases.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            phase['calls'] += 1
+            phase['wall_seconds'] += wall_seconds
+            phase['cpu_seconds'] += cpu_seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        profile = None
+        if name in self.cprofile_phases and not self._cprofile_active:  # only one cProfile can run at a time
+            self._cprofile_active = True
+            profile = cProfile.Profile()
+            profile.enable()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+            if profile is not None:
+                profile.disable()
+                self._cprofile_active = False
+                with self.lock:
+                    if name in self.profiles:
+                        self.profiles[name].add(profile)
+                    else:
+                        self.profiles[name] = pstats.Stats(profile)
+
+    def timed(self, name, fn):
+        # fn wrapped so that every call is recorded as phase name
+        if not self.enabled:
+            return fn
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def counting_deep_copies(self):
+        # Counts the outermost copy.deepcopy calls made while active by the thread that entered it; copies made by
+        # other threads (e.g. download workers) are not counted. Only the copy module's attribute is replaced, so
+        # code that holds the function itself (from copy import deepcopy, imported before) is not counted either.
+        if not self.enabled:
+            yield
+            return
+        original_deepcopy = copy.deepcopy
+        owner = threading.get_ident()
+        depth = [0]
+
+        def counting_deepcopy(x, memo=None, _nil=[]):
+            if threading.get_ident() != owner:
+                return original_deepcopy(x, memo)
+            if depth[0] == 0:
+                self.count('deep_copies')
+            depth[0] += 1
+            try:
+                return original_deepcopy(x, memo)
+            finally:
+                depth[0] -= 1
+
+        copy.deepcopy = counting_deepcopy
+        try:
+            yield
+        finally:
+            copy.deepcopy = original_deepcopy
+
+    def count_directory_bytes(self, directories, name='bytes_written'):
+        # total size of the files in the given directories, e.g. generated simulation directories
+        if not self.enabled:
+            return
+        n_bytes = n_files = 0
+        for directory in directories:
+            for root, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    n_bytes += os.path.getsize(os.path.join(root, filename))
+                    n_files += 1
+        self.count(name, n_bytes)
+        self.count('files_written', n_files)
+
+    def report(self):
+        phases = {}
+        for name, phase in self.phases.items():
+            phases[name] = dict(phase, cpu_fraction=phase['cpu_seconds'] / phase['wall_seconds']
+                                if phase['wall_seconds'] > 0 else None)
+        profiles = {}
+        for name, stats in self.profiles.items():
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(N_PROFILE_FUNCTIONS)
+            profiles[name] = stream.getvalue()
+        return {'total_wall_seconds': time.perf_counter() - self.start_time, 'phases': phases,
+                'counters': self.counters, 'cprofile': profiles}
+
+    def write_report(self, filename=DEFAULT_REPORT_FILENAME):
+        if not self.enabled:
+            return
+        report = self.report()
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+        base = os.path.splitext(filename)[0]
+        for name, stats in self.profiles.items():
+            stats.dump_stats('%s_%s.prof' % (base, name))  # for snakeviz, pstats etc.
+        print('Wrote timing report to %s' % filename)
+        for name, phase in sorted(report['phases'].items(), key=lambda item: -item[1]['wall_seconds']):
+            print('  %-28s %10.2f s wall %10.2f s cpu (%d call(s))' %
+                  (name, phase['wall_seconds'], phase['cpu_seconds'], phase['calls']))
+        for name, value in sorted(report['counters'].items()):
+            print('  %-28s %12d' % (name, value))
+
+
+# the profiler used by run_scenarios.py, enabled by --profile
+profiler = SuiteProfiler()
@@ -0,0 +1,228 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Surrogate-model pre-screening of calibration candidate points. A Gaussian-process emulator is trained on every
+# (parameters, likelihood) pair seen so far and used to rank an oversampled set of candidates, so that only the most
+# promising ones are run as full EMOD simulations.
+#
+# SurrogateScreenedNextPoint wraps a next-point algorithm (OptimTool) that is configured to propose oversample times
+# more samples per iteration than should be run. Replicated candidates, i.e. OptimTool's center repeats, are always
+# run: they are one point, and OptimTool needs them to compare the center with its neighbours. The other candidates
+# are ranked and the best are run, n_keep in all. Every prediction is logged next to the real likelihood (where one
+# exists) in a csv file.
+#
+# When the iteration's results are handed back, OptimTool only gets the simulated candidates: the screened-out ones
+# are dropped from its samples (its data table), so its regression is fitted on simulation results, not on
+# predictions. A wrapped algorithm without such a table gets a complete iteration instead, with the screened-out
+# candidates given their predicted likelihood, or before the surrogate is trained the value of a linear fit of the
+# simulated ones (see async_calibration.linear_fit_prediction).
+#
+# Until there are min_training_points results to train on, a random selection of the candidates is run, as many as
+# without screening. The candidates, their predictions and the training data are saved with the wrapped algorithm's
+# state, so a resumed calibration hands back results for the candidates it ran.
+#
+# The emulator can be evaluated offline on past parameter sets, e.g.
+# python surrogate.py resampled_parameter_sets_short.csv
+
+RESULTS_COLUMN = 'total'
+DEFAULT_OVERSAMPLE = 3
+DEFAULT_MIN_TRAINING_POINTS = 10
+DEFAULT_EXPLORATION = 1.0
+NON_PARAMETER_COLUMNS = ['parameterization_id', 'iteration_number', 'sim_id', 'likelihood', 'run_number']
+STATE_KEY = 'surrogate'
+
+
+class GaussianProcessSurrogate(object):
+    """
+    GP regression with a squared-exponential kernel on parameters scaled to [0, 1]. The length scale defaults to the
+    median distance between training points and the targets are standardized, so it needs no tuning.
+    """
+    def __init__(self, lower=None, upper=None, length_scale=None, noise=1e-2):
+        self.lower = None if lower is None else np.asarray(lower, dtype=np.float64)
+        self.upper = None if upper is None else np.asarray(upper, dtype=np.float64)
+        self.length_scale = length_scale
+        self.noise = noise
+
+    def _scale(self, x):
+        span = np.where(self.upper > self.lower, self.upper - self.lower, 1.0)
+        return (x - self.lower) / span
+
+    def _kernel(self, a, b):
+        squared_distances = np.sum(a ** 2, 1)[:, None] + np.sum(b ** 2, 1)[None, :] - 2 * a @ b.T
+        return np.exp(-0.5 * np.maximum(squared_distances, 0) / self.fitted_length_scale ** 2)
+
+    def fit(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if self.lower is None:
+            self.lower, self.upper = x.min(axis=0), x.max(axis=0)
+        self.x = self._scale(x)
+        self.y_mean, self.y_std = y.mean(), (y.std() or 1.0)
+        if self.length_scale is None:
+            distances = np.sqrt(np.maximum(np.sum((self.x[:, None, :] - self.x[None, :, :]) ** 2, axis=2), 0))
+            self.fitted_length_scale = np.median(distances[np.triu_indices(len(self.x), 1)]) or 1.0
+        else:
+            self.fitted_length_scale = self.length_scale
+        k = self._kernel(self.x, self.x) + self.noise * np.eye(len(self.x))
+        self.cholesky = np.linalg.cholesky(k)
+        self.alpha = np.linalg.solve(self.cholesky.T, np.linalg.solve(self.cholesky, (y - self.y_mean) / self.y_std))
+        return self
+
+    def predict(self, x):
+        # returns (mean, std) of the predicted likelihood for each row of x
+        x = self._scale(np.asarray(x, dtype=np.float64))
+        k_star = self._kernel(x, self.x)
+        mean = k_star @ self.alpha
+        v = np.linalg.solve(self.cholesky, k_star.T)
+        variance = np.maximum(1.0 - np.sum(v ** 2, axis=0), 0)
+        return mean * self.y_std + self.y_mean, np.sqrt(variance) * self.y_std
+
+
+class SurrogateScreenedNextPoint(object):
+    def __init__(self, next_point, param_names, n_keep, lower=None, upper=None, log_filename='surrogate_predictions.csv',
+                 min_training_points=DEFAULT_MIN_TRAINING_POINTS, exploration=DEFAULT_EXPLORATION, seed=None):
+        self.next_point = next_point
+        self.param_names = param_names
+        self.n_keep = n_keep
+        self.lower = lower
+        self.upper = upper
+        self.log_filename = log_filename
+        self.min_training_points = min_training_points
+        self.exploration = exploration  # candidates are ranked by mean + exploration * std
+        self.rng = np.random.default_rng(seed)
+        self.training_x = []
+        self.training_y = []
+        self.candidates = {}  # iteration -> (candidates, kept positions, predicted mean, predicted std)
+
+    def __getattr__(self, name):
+        # everything else (final samples, end condition, ...) is the wrapped algorithm's business
+        return getattr(self.next_point, name)
+
+    def get_state(self):
+        state = dict(self.next_point.get_state())
+        state[STATE_KEY] = {
+            'candidates': {str(i): {'columns': list(candidates.columns), 'data': candidates.values.tolist(),
+                                    'kept': kept.tolist(), 'mean': mean.tolist(), 'std': std.tolist()}
+                           for i, (candidates, kept, mean, std) in self.candidates.items()},
+            'training_x': self.training_x,
+            'training_y': self.training_y
+        }
+        return state
+
+    def set_state(self, state, iteration):
+        state = dict(state)
+        own_state = state.pop(STATE_KEY, {})
+        self.candidates = {int(i): (pd.DataFrame(c['data'], columns=c['columns']), np.array(c['kept'], dtype=int),
+                                    np.array(c['mean'], dtype=np.float64), np.array(c['std'], dtype=np.float64))
+                           for i, c in own_state.get('candidates', {}).items()}
+        self.training_x = own_state.get('training_x', [])
+        self.training_y = own_state.get('training_y', [])
+        return self.next_point.set_state(state, iteration)
+
+    def get_samples_for_iteration(self, iteration):
+        if iteration not in self.candidates:
+            candidates = self.next_point.get_samples_for_iteration(iteration)
+            mean = np.full(len(candidates), np.nan)
+            std = np.full(len(candidates), np.nan)
+            replicated = np.flatnonzero(candidates[self.param_names].duplicated(keep=False).values)  # center repeats
+            ranked = np.setdiff1d(np.arange(len(candidates)), replicated)
+            n_ranked = max(self.n_keep - len(replicated), 0)
+            if len(self.training_y) >= self.min_training_points and len(candidates) > self.n_keep:
+                surrogate = GaussianProcessSurrogate(lower=self.lower, upper=self.upper)
+                surrogate.fit(np.array(self.training_x), np.array(self.training_y))
+                mean, std = surrogate.predict(candidates[self.param_names].values)
+                best = ranked[np.argsort(-(mean[ranked] + self.exploration * std[ranked]))[:n_ranked]]
+            else:
+                # not enough data to screen yet, run as many as without screening
+                best = self.rng.choice(ranked, min(n_ranked, len(ranked)), replace=False)
+            kept = np.sort(np.concatenate([replicated, best]).astype(int))
+            self.candidates[iteration] = (candidates, kept, mean, std)
+        candidates, kept, _, _ = self.candidates[iteration]
+        return candidates.iloc[kept].reset_index(drop=True)
+
+    def set_results_for_iteration(self, iteration, results):
+        candidates, kept, mean, std = self.candidates[iteration]
+        actual = np.full(len(candidates), np.nan)
+        actual[kept] = results[RESULTS_COLUMN].values
+        self.training_x.extend(candidates[self.param_names].values[kept].tolist())
+        self.training_y.extend(actual[kept].tolist())
+        self.log_predictions(iteration, kept, mean, std, actual)
+
+        if self.drop_screened_out(iteration, len(candidates), kept):
+            simulated_results = pd.DataFrame({RESULTS_COLUMN: actual[kept]})
+            return self.next_point.set_results_for_iteration(iteration, simulated_results)
+        return self.next_point.set_results_for_iteration(iteration, self.complete_results(candidates, kept, mean,
+                                                                                          actual))
+
+    def drop_screened_out(self, iteration, n_candidates, kept):
+        # Removes the candidates that were not simulated from OptimTool's samples of the iteration (its data table,
+        # one row per sample with an Iteration column). Returns False for algorithms without such a table.
+        data = getattr(self.next_point, 'data', None)
+        if not isinstance(data, pd.DataFrame) or 'Iteration' not in data.columns:
+            return False
+        rows = np.flatnonzero(data['Iteration'].values == iteration)
+        if len(rows) == n_candidates:  # not dropped yet, e.g. by a run that was interrupted after handing them over
+            screened_out = np.setdiff1d(np.arange(n_candidates), kept)
+            self.next_point.data = data.drop(index=data.index[rows[screened_out]]).reset_index(drop=True)
+        return True
+
+    def complete_results(self, candidates, kept, mean, actual):
+        # every candidate's result: simulated, predicted, or before the surrogate was trained the linear fit's value
+        from async_calibration import linear_fit_prediction
+
+        imputed = mean.copy()
+        unscreened = np.flatnonzero(np.isnan(actual) & np.isnan(mean))  # not simulated before the surrogate was ready
+        if len(unscreened) > 0:
+            imputed[unscreened] = linear_fit_prediction(candidates[self.param_names], kept, actual[kept], unscreened)
+        return pd.DataFrame({RESULTS_COLUMN: np.where(np.isnan(actual), imputed, actual)})
+
+    def log_predictions(self, iteration, kept, mean, std, actual):
+        log = pd.DataFrame({'iteration': iteration, 'candidate': np.arange(len(mean)),
+                            'simulated': np.isin(np.arange(len(mean)), kept), 'predicted_likelihood': mean,
+                            'predicted_std': std, 'likelihood': actual})
+        log.to_csv(self.log_filename, mode='a', index=False, header=not os.path.exists(self.log_filename))
+
+
+def evaluate_on_history(history, n_folds=5, oversample=DEFAULT_OVERSAMPLE, seed=0):
+    """
+    Cross-validates the surrogate on past parameter sets (a csv like resampled_parameter_sets.csv). Returns the
+    Spearman rank correlation of predicted vs. real likelihoods and the fraction of each fold's true top
+    1/oversample points that screening would have kept.
+    """
+    from scipy.stats import spearmanr
+
+    param_names = [c for c in history.columns if c not in NON_PARAMETER_COLUMNS]
+    likelihood = history['likelihood'].values.astype(np.float64)
+    if np.all(likelihood > 0):  # exponentiated likelihoods, work on the log scale
+        likelihood = np.log(likelihood)
+    x = history[param_names].values.astype(np.float64)
+    folds = np.array_split(np.random.default_rng(seed).permutation(len(history)), n_folds)
+
+    predicted = np.empty(len(history))
+    recalls = []
+    for fold in folds:
+        train = np.setdiff1d(np.arange(len(history)), fold)
+        surrogate = GaussianProcessSurrogate(lower=x.min(axis=0), upper=x.max(axis=0)).fit(x[train], likelihood[train])
+        predicted[fold], _ = surrogate.predict(x[fold])
+        n_keep = max(1, len(fold) // oversample)
+        true_top = set(fold[np.argsort(-likelihood[fold])[:n_keep]])
+        kept = set(fold[np.argsort(-predicted[fold])[:n_keep]])
+        recalls.append(len(true_top & kept) / n_keep)
+    return spearmanr(predicted, likelihood).correlation, float(np.mean(recalls))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('history', type=str, help='csv of past parameter sets with a likelihood column.')
+    parser.add_argument('--folds', dest='n_folds', type=int, default=5, help='Cross-validation folds (Default: 5).')
+    parser.add_argument('--oversample', dest='oversample', type=int, default=DEFAULT_OVERSAMPLE,
+                        help='Candidates proposed per simulated point (Default: %d).' % DEFAULT_OVERSAMPLE)
+    script_args = parser.parse_args()
+
+    correlation, recall = evaluate_on_history(pd.read_csv(script_args.history), n_folds=script_args.n_folds,
+                                              oversample=script_args.oversample)
+    print('Rank correlation of predicted vs. real likelihood: %.3f' % correlation)
+    print('Fraction of true top 1/%d points kept by screening: %.3f' % (script_args.oversample, recall))
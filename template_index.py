@@ -0,0 +1,216 @@
+import copy
+import json
+import time
+
+# Indexed, copy-on-write parameter application for ConfigTemplate/CampaignTemplate/DemographicsTemplate.
+#
+# Tagged parameters are marked in the templates by a marker key next to the parameter, e.g.
+# "Initial_Distribution__KP_Risk_Homa_Bay": "<-- MARKER" next to "Initial_Distribution". TemplatePathIndex walks a
+# template document once and records, for every marker, the path (a tuple of dict keys and list indices) of the
+# parameter it marks. Parameter names such as Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Min are
+# expanded to <marked path> + ('Ramp_Min',), and untagged dotted names (e.g. Base_Infectivity in config.json) are
+# resolved once and memoized.
+#
+# IndexedTemplateMixin keeps the loaded document as a pristine copy. Each simulation starts from a shallow copy of its
+# root, and set_param copies only the containers on the path it writes to (path copying), so a simulation costs a
+# few small copies per parameter instead of a deep copy of the whole document plus a search for every tag. Documents
+# handed out for earlier simulations are never modified afterwards.
+#
+# Compare with a deep copy per simulation on a template file, e.g.
+# python template_index.py InputFiles/Templates/campaign_Nyanza_baseline_202301.json
+
+DEFAULT_TAG = '__KP'
+
+
+_MISSING = object()
+
+
+def _child(container, key):
+    if isinstance(container, dict):
+        return container.get(key, _MISSING)
+    if isinstance(container, list) and isinstance(key, int) and 0 <= key < len(container):
+        return container[key]
+    return _MISSING
+
+
+def _resolve(document, path):
+    # the value at path, or _MISSING if it does not exist
+    node = document
+    for key in path:
+        node = _child(node, key)
+        if node is _MISSING:
+            return _MISSING
+    return node
+
+
+class TemplatePathIndex(object):
+    def __init__(self, contents, tag=DEFAULT_TAG, roots=((),)):
+        self.tag = tag
+        self.roots = roots  # prefixes tried, in order, for untagged parameter names
+        self.tagged_paths = {}
+        self._expanded = {}
+        self._index(contents, ())
+        self.contents = contents
+
+    def _index(self, node, path):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if self.tag in key:
+                    self.tagged_paths.setdefault(key, []).append(path + (key.split(self.tag)[0],))
+                self._index(value, path + (key,))
+        elif isinstance(node, list):
+            for i, value in enumerate(node):
+                self._index(value, path + (i,))
+
+    @staticmethod
+    def _split(name):
+        return [int(part) if part.isdigit() else part for part in name.split('.')]
+
+    def expand(self, param):
+        """
+        Returns the list of paths that param refers to, empty if it is not in the document. Only locations that already
+        exist match, so an untagged name is never added to the document (and a misspelled one is not found).
+        """
+        if param not in self._expanded:
+            parts = param.split('.')
+            if self.tag in parts[0]:
+                rest = tuple(self._split('.'.join(parts[1:]))) if len(parts) > 1 else ()
+                paths = [path + rest for path in self.tagged_paths.get(parts[0], [])]
+            else:
+                paths = [root + tuple(self._split(param)) for root in self.roots]
+            paths = [path for path in paths if _resolve(self.contents, path) is not _MISSING]
+            if self.tag not in parts[0]:
+                paths = paths[:1]  # the first root it is found under
+            self._expanded[param] = paths
+        return self._expanded[param]
+
+
+def copy_on_write_set(document, path, value, copied):
+    """
+    Sets document[path] = value, shallow-copying every container on the path that is not in copied (a set of ids of
+    containers that already belong to this document). document itself must already be in copied.
+    """
+    node = document
+    for key in path[:-1]:
+        child = node[key]
+        if id(child) not in copied:
+            child = child.copy()
+            copied.add(id(child))
+            node[key] = child
+        node = child
+    node[path[-1]] = value
+
+
+class IndexedTemplateMixin(object):
+    """
+    Mixed in before a dtk template class, see indexed_template_class. Every read of contents (by get_contents, the
+    config builder or anything else) hands the current document out; the next set_param then starts from a shallow
+    copy of it, so documents handed out are never modified afterwards whether or not reset() is called between
+    simulations.
+    """
+    path_index_roots = ((),)
+
+    @property
+    def contents(self):
+        self._handed_out = True
+        return self._contents
+
+    @contents.setter
+    def contents(self, value):
+        self._contents = value
+        self._copied = set()  # nothing in a document set from outside is owned by this template
+        self._handed_out = True
+
+    def build_path_index(self, tag=DEFAULT_TAG):
+        # call once the template's fixed parameters are set, the current contents become the pristine document
+        self.path_index = TemplatePathIndex(self._contents, tag=tag, roots=self.path_index_roots)
+        self.pristine_contents = self._contents
+        self.reset()
+
+    def reset(self):
+        if not hasattr(self, 'path_index'):
+            return super(IndexedTemplateMixin, self).reset()
+        self._contents = self.pristine_contents.copy()
+        self._copied = {id(self._contents)}
+        self._handed_out = False
+
+    def _own_root(self):
+        if self._handed_out or id(self._contents) not in self._copied:
+            self._contents = self._contents.copy()
+            self._copied = {id(self._contents)}
+            self._handed_out = False
+
+    def has_param(self, param):
+        if not hasattr(self, 'path_index'):
+            return super(IndexedTemplateMixin, self).has_param(param)
+        return len(self.path_index.expand(param)) > 0
+
+    def set_param(self, param, value, *args, **kwargs):
+        if not hasattr(self, 'path_index'):
+            return super(IndexedTemplateMixin, self).set_param(param, value, *args, **kwargs)
+        paths = self.path_index.expand(param)
+        if not paths:
+            # not in the document: the template class decides (e.g. raises). It may write in place, so it works on a
+            # private deep copy.
+            self._contents = copy.deepcopy(self._contents)
+            self._copied = {id(self._contents)}
+            self._handed_out = False
+            return super(IndexedTemplateMixin, self).set_param(param, value, *args, **kwargs)
+        self._own_root()
+        for path in paths:
+            copy_on_write_set(self._contents, path, value, self._copied)
+        return ['.'.join(str(key) for key in path) for path in paths]
+
+
+_indexed_classes = {}
+
+
+def indexed_template_class(template_cls):
+    """
+    The indexed subclass of a dtk template class, e.g. indexed_template_class(ConfigTemplate).from_file(filename).
+    Templates are created through the class's own constructors; call build_path_index() once they are set up.
+    """
+    if template_cls not in _indexed_classes:
+        _indexed_classes[template_cls] = type('Indexed' + template_cls.__name__,
+                                              (IndexedTemplateMixin, template_cls), {})
+    return _indexed_classes[template_cls]
+
+
+def benchmark(filename, n_simulations=1000, tag=DEFAULT_TAG):
+    # seconds per simulation: (deep copy + tag search, indexed copy-on-write writes)
+    with open(filename) as f:
+        contents = json.load(f)
+    index = TemplatePathIndex(contents, tag=tag)
+    params = list(index.tagged_paths)
+
+    start = time.perf_counter()
+    for i in range(n_simulations):
+        document = copy.deepcopy(contents)
+        tagged_paths = TemplatePathIndex(document, tag=tag).tagged_paths
+        for param in params:
+            for path in tagged_paths[param]:
+                _resolve(document, path[:-1])[path[-1]] = i
+    deep_copy_time = (time.perf_counter() - start) / n_simulations
+
+    start = time.perf_counter()
+    for i in range(n_simulations):
+        document = contents.copy()
+        copied = {id(document)}
+        for param in params:
+            for path in index.expand(param):
+                copy_on_write_set(document, path, i, copied)
+    indexed_time = (time.perf_counter() - start) / n_simulations
+    return len(params), deep_copy_time, indexed_time
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, help='Template json file.')
+    parser.add_argument('-n', dest='n_simulations', type=int, default=1000,
+                        help='Number of simulations to time (Default: 1000).')
+    script_args = parser.parse_args()
+
+    n_params, deep_copy_time, indexed_time = benchmark(script_args.filename, n_simulations=script_args.n_simulations)
+    print('%d tagged parameters: %.3f ms/simulation with a deep copy and tag search, %.3f ms/simulation indexed' %
+          (n_params, deep_copy_time * 1000, indexed_time * 1000))
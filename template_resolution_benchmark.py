@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import pandas as pd
+
+import optim_script
+import run_scenarios
+from sample_store import SampleStore
+from scenario_table import load_scenario_table
+
+# Times run_scenarios.build_and_run_simulations for increasing numbers of samples with simulation creation stubbed:
+# every simulation's parameters are applied to the templates as simtools would apply them, but nothing is written or
+# submitted. Each sample count is run twice: with samples mapped one at a time, each mapping resolving (deep copying)
+# the template set as before the resolved sets were cached, and as run_scenarios.py runs now.
+#
+# python template_resolution_benchmark.py -n 10 100 1000 --table scenarios.csv
+
+
+class StubExperimentManager(object):
+    # stands in for simtools' experiment manager: applies every simulation's ModFns to the config builder
+    def __init__(self, config_builder):
+        self.config_builder = config_builder
+        self.n_simulations = 0
+
+    @classmethod
+    def from_cb(cls, config_builder):
+        return cls(config_builder)
+
+    def create_suite(self, suite_name):
+        return suite_name
+
+    def create_simulations(self, exp_name, exp_builder, suite_id):
+        for mod_fn_list in exp_builder.mod_generator:
+            for mod_fn in mod_fn_list:
+                mod_fn(self.config_builder)
+            self.n_simulations += 1
+
+    run_simulations = create_simulations
+
+
+def tiled_samples(filename, n_samples):
+    # n_samples parameter sets, the rows of filename repeated as needed
+    samples = pd.read_csv(filename)
+    samples = pd.concat([samples] * (n_samples // len(samples) + 1), ignore_index=True).iloc[:n_samples]
+    samples['parameterization_id'] = range(n_samples)
+    return SampleStore.from_dataframe(samples)
+
+
+class ResolvingPerSample(object):
+    # as before the resolved template sets were cached: samples are mapped one at a time through
+    # map_sample_to_model_input, and every mapping resolves the template set with a deep copy
+    def __init__(self, loaded_module):
+        self.loaded_module = loaded_module
+
+    def __enter__(self):
+        module = self.loaded_module
+        self.map_samples = vars(module).pop('map_samples_to_model_input', None)
+        self.resolve = module.resolve_scenario_template_set
+
+        def resolve_with_deep_copy(template_set_name, campaign_template_name):
+            module.clear_resolved_template_cache()
+            return self.resolve(template_set_name=template_set_name, campaign_template_name=campaign_template_name)
+        module.resolve_scenario_template_set = resolve_with_deep_copy
+
+    def __exit__(self, *exc_info):
+        self.loaded_module.resolve_scenario_template_set = self.resolve
+        if self.map_samples is not None:
+            self.loaded_module.map_samples_to_model_input = self.map_samples
+        self.loaded_module.clear_resolved_template_cache()
+
+
+def time_generation(samples, scenario_param_dicts, loaded_module):
+    start = time.perf_counter()
+    run_scenarios.build_and_run_simulations(samples,
+                                            scenario_template_sets=loaded_module.run_calib_args['scenario_template_sets'],
+                                            scenario_param_dicts=scenario_param_dicts,
+                                            suite_name='template_resolution_benchmark',
+                                            loaded_module=loaded_module)
+    return time.perf_counter() - start
+
+
+def benchmark(sample_counts, samples_filename='resampled_parameter_sets_short.csv', scenario_table=None,
+              loaded_module=optim_script):
+    # {n_samples: (seconds with a deep copy per sample, seconds cached)}
+    run_scenarios.ExperimentManagerFactory = StubExperimentManager
+    run_scenarios.get_bundle_size = lambda: 1
+    run_scenarios.use_local_pool = lambda: False
+    run_scenarios.load_templates(loaded_module)
+    available_campaigns = set()
+    for scenario_template_set in loaded_module.run_calib_args['scenario_template_sets'].values():
+        available_campaigns.update(scenario_template_set['campaign'].keys())
+    scenario_param_dicts = load_scenario_table(filename=scenario_table, available_campaigns=available_campaigns)
+
+    times = {}
+    for n_samples in sample_counts:
+        samples = tiled_samples(samples_filename, n_samples)
+        with ResolvingPerSample(loaded_module):
+            deep_copy_time = time_generation(samples, scenario_param_dicts, loaded_module)
+        cached_time = time_generation(samples, scenario_param_dicts, loaded_module)
+        times[n_samples] = (deep_copy_time, cached_time)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='sample_counts', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Numbers of samples to generate the simulations of (Default: 10 100 1000).')
+    parser.add_argument('-s', '--samples', dest='samples_filename', type=str,
+                        default='resampled_parameter_sets_short.csv',
+                        help='csv of parameter sets, repeated as needed (Default: resampled_parameter_sets_short.csv).')
+    parser.add_argument('--table', dest='scenario_table', type=str, default=None,
+                        help='Scenario table, as for run_scenarios.py (Default: none, one scenario per template set).')
+    script_args = parser.parse_args()
+
+    times = benchmark(script_args.sample_counts, samples_filename=script_args.samples_filename,
+                      scenario_table=script_args.scenario_table)
+    for n_samples, (deep_copy_time, cached_time) in sorted(times.items()):
+        print('%d samples: %.2f s with a deep copy per sample, %.2f s cached (%.1fx)' %
+              (n_samples, deep_copy_time, cached_time, deep_copy_time / max(cached_time, 1e-12)))
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the tutorial scripts are top-level modules of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'InputFiles', 'Templates')
+STATIC_DIR = os.path.join(REPO_DIR, 'InputFiles', 'Static')
@@ -0,0 +1,36 @@
+import numpy as np
+
+from aggregate_results import StreamingAccumulator
+
+
+def test_statistics_match_numpy_while_strata_and_simulations_grow():
+    rng = np.random.default_rng(1)
+    accumulator = StreamingAccumulator(metrics=['a', 'b'], reservoir_size=50, seed=0)
+    values = {}
+    for sim in range(40):
+        # strata appear over time, so the arrays are grown while simulations are added
+        keys = [('s', stratum) for stratum in range(1 + sim // 4)]
+        sim_values = rng.random((len(keys), 2))
+        accumulator.add(keys, sim_values)
+        for key, row in zip(keys, sim_values):
+            values.setdefault(key, []).append(row)
+
+    assert len(accumulator.count) < 2 * len(values)  # geometric growth, not one allocation per simulation
+    assert accumulator.depth == 40 and accumulator.reservoir.shape[2] <= 50
+
+    rows = [accumulator.keys[key] for key in values]
+    for key, row in zip(values, rows):
+        expected = np.array(values[key])
+        assert accumulator.count[row] == len(expected)
+        np.testing.assert_allclose(accumulator.mean[row], expected.mean(axis=0))
+        reservoir = accumulator.reservoir[row, :, :accumulator.depth]
+        np.testing.assert_allclose(np.nanmedian(reservoir, axis=1), np.median(expected, axis=0), rtol=1e-6)
+
+
+def test_reservoir_depth_is_capped():
+    accumulator = StreamingAccumulator(metrics=['a'], reservoir_size=8, seed=0)
+    for sim in range(100):
+        accumulator.add([('s', 0)], np.array([[float(sim)]]))
+    assert accumulator.reservoir.shape[2] == 8 and accumulator.depth == 8
+    assert accumulator.count[0] == 100
+    assert not np.isnan(accumulator.reservoir[0, 0, :8]).any()
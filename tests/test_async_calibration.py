@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from async_calibration import RESULTS_COLUMN, AsyncCalibration, linear_fit_prediction, measure_iterations_per_hour
+
+
+class RecordingNextPoint(object):
+    def __init__(self, samples):
+        self.samples = samples
+        self.results = {}
+
+    def get_samples_for_iteration(self, iteration):
+        return self.samples
+
+    def set_results_for_iteration(self, iteration, results):
+        self.results[iteration] = results
+
+
+class NullRunner(object):
+    def submit(self, key, sample):
+        pass
+
+
+def test_stragglers_are_imputed_without_bias():
+    rng = np.random.default_rng(0)
+    samples = pd.DataFrame(rng.uniform(size=(8, 2)), columns=['a', 'b'])
+    surface = 3.0 + 2.0 * samples['a'] - 5.0 * samples['b']  # linear, so the fit recovers it exactly
+    next_point = RecordingNextPoint(samples)
+    calibration = AsyncCalibration(next_point, NullRunner(), n_replicates=2, quorum=0.5)
+    calibration.start_iteration(0)
+    for sample_index in range(5):
+        for replicate in range(2):
+            calibration.record((0, sample_index, replicate), surface[sample_index])
+    calibration.record((0, 5, 0), -100.0)  # one of two replicates
+    assert calibration.quorum_reached(0)
+
+    results = calibration.finish_iteration(0)[RESULTS_COLUMN]
+    assert list(results[:5]) == pytest.approx(list(surface[:5]))
+    assert results[5] == -100.0
+    # no replicate scored: the fitted value, not the iteration's worst score
+    assert list(results[6:]) == pytest.approx(list(surface[6:]))
+
+    calibration.record((0, 7, 0), 1.0)
+    assert calibration.history[-1]['straggler']
+
+
+def test_fewer_samples_than_parameters_are_fitted():
+    # optim_script's calibration: 65 parameters, 20 samples per iteration
+    fit_errors, mean_errors = [], []
+    for seed in range(10):
+        rng = np.random.default_rng(seed)
+        samples = pd.DataFrame(rng.uniform(size=(30, 65)), columns=['p%d' % i for i in range(65)])
+        surface = samples.to_numpy() @ rng.normal(size=65)
+        known, unknown = list(range(20)), list(range(20, 30))
+        predicted = np.array(linear_fit_prediction(samples, known, surface[known], unknown))
+        assert np.all(np.isfinite(predicted)) and np.ptp(predicted) > 0  # not the mean score for every straggler
+        fit_errors.append(np.mean((surface[unknown] - predicted) ** 2))
+        mean_errors.append(np.mean((surface[unknown] - np.mean(surface[known])) ** 2))
+    assert np.mean(fit_errors) < np.mean(mean_errors)
+
+
+def test_quorum_speeds_up_synthetic_calibration():
+    synchronous_rate, _ = measure_iterations_per_hour(1.0, n_iterations=5)
+    asynchronous_rate, _ = measure_iterations_per_hour(0.8, n_iterations=5)
+    assert asynchronous_rate > synchronous_rate
@@ -0,0 +1,84 @@
+import json
+import os
+
+from completion_index import CompletionIndex, filter_completed_rows, template_set_sha256
+from lazy_json import LazyJsonDocument
+
+
+class FakeTemplate(object):
+    def __init__(self, contents):
+        self.contents = contents
+
+
+class FakeLazyTemplate(object):
+    def __init__(self, filename):
+        self.lazy_document = LazyJsonDocument(filename)
+
+
+def make_rows(n_rows):
+    return [{'Base_Infectivity': 0.1 * i, 'Run_Number': 7, 'TAGS': {'parameterization_id': i, 'Run_Number': 7}}
+            for i in range(n_rows)]
+
+
+def run_incremental(index, template_set, rows):
+    return list(filter_completed_rows(iter(rows), index, template_set, template_set_name='Baseline',
+                                      scenario_name='Baseline-ART', download_filenames=['output/Report.csv']))
+
+
+def download(output_path, rows):
+    for row in rows:
+        filename = os.path.join(output_path, 'Baseline-ART', 'Report_TPI%04d_REP0007.csv' %
+                                row['TAGS']['parameterization_id'])
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        open(filename, 'w').close()
+
+
+def test_completion_index_round_trip(tmp_path):
+    index = CompletionIndex(str(tmp_path))
+    index.mark_submitted('abc', scenario_name='S', parameterization_id=0, run_number=1, files=['S/a.csv'])
+    assert index.update_completed() == 0 and not index.is_completed('abc')
+    os.makedirs(str(tmp_path / 'S'))
+    open(str(tmp_path / 'S' / 'a.csv'), 'w').close()
+    assert index.update_completed() == 1
+
+    reloaded = CompletionIndex(str(tmp_path))
+    assert reloaded.is_completed('abc') and not reloaded.is_completed('other')
+    os.remove(str(tmp_path / 'S' / 'a.csv'))
+    assert not reloaded.is_completed('abc')  # results that were removed are run again
+
+
+def test_filter_completed_rows_reruns_when_any_template_changes(tmp_path):
+    overlay_filename = str(tmp_path / 'overlay.json')
+    with open(overlay_filename, 'w') as f:
+        json.dump({'Nodes': [{'Risk__KP_Risk': '<-- MARKER', 'Risk': 1}]}, f)
+    template_set = {'config': [FakeTemplate({'parameters': {'Simulation_Duration': 100}})],
+                    'campaign': [FakeTemplate({'Events': []})],
+                    'demographics': [FakeLazyTemplate(overlay_filename)]}
+    output_path = str(tmp_path / 'output')
+    rows = make_rows(3)
+
+    index = CompletionIndex(output_path)
+    assert run_incremental(index, template_set, rows) == rows
+    download(output_path, rows[:2])
+    index.update_completed()
+    assert run_incremental(CompletionIndex(output_path), template_set, rows) == rows[2:]
+
+    # an edited config (or any other template) makes every combination new
+    sha256 = template_set_sha256(template_set)
+    template_set['config'] = [FakeTemplate({'parameters': {'Simulation_Duration': 200}})]
+    assert template_set_sha256(template_set) != sha256
+    assert run_incremental(CompletionIndex(output_path), template_set, rows) == rows
+
+    # and so does an edited lazily loaded overlay file
+    sha256 = template_set_sha256(template_set)
+    with open(overlay_filename, 'w') as f:
+        json.dump({'Nodes': [{'Risk__KP_Risk': '<-- MARKER', 'Risk': 2}]}, f)
+    template_set['demographics'] = [FakeLazyTemplate(overlay_filename)]
+    assert template_set_sha256(template_set) != sha256
+
+
+def test_indexed_templates_are_hashed_from_their_pristine_contents():
+    template = FakeTemplate({'Base_Infectivity': 0.5})  # a simulation's parameters
+    template.pristine_contents = {'Base_Infectivity': 0.1}
+    assert template_set_sha256({'config': [template]}) == \
+        template_set_sha256({'config': [FakeTemplate({'Base_Infectivity': 0.1})]})
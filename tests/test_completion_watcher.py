@@ -0,0 +1,64 @@
+from completion_watcher import CompletionWatcher
+
+
+class FakeStatus(object):
+    # like simtools' SimulationState enum members
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSimulation(object):
+    def __init__(self, sim_id, states):
+        self.id = sim_id
+        self.states = list(states)  # status after each refresh, the last one stays
+        self.status = FakeStatus(self.states.pop(0))
+
+    def refresh(self):
+        if self.states:
+            self.status = FakeStatus(self.states.pop(0))
+
+
+class FakeExperimentManager(object):
+    def __init__(self, simulations):
+        self.experiment = type('Experiment', (), {})()
+        self.experiment.simulations = simulations
+        self.n_refreshes = 0
+
+    def refresh_experiment(self):
+        self.n_refreshes += 1
+        for simulation in self.experiment.simulations:
+            simulation.refresh()
+
+    def finished(self):
+        return all(CompletionWatcher.state_name(s.status) in CompletionWatcher.FINAL_STATES
+                   for s in self.experiment.simulations)
+
+
+def test_streams_batches_with_backoff_and_counts_failures():
+    running = ['Running'] * 5
+    managers = [
+        FakeExperimentManager([FakeSimulation('a', ['Running', 'Succeeded']),
+                               FakeSimulation('b', running + ['Failed'])]),
+        FakeExperimentManager([FakeSimulation('c', ['Running', 'Running', 'Succeeded']),
+                               FakeSimulation('d', ['Canceled'])])
+    ]
+    sleeps = []
+    watcher = CompletionWatcher(managers, min_interval=1, max_interval=3, backoff_factor=2, sleep=sleeps.append)
+
+    batches = [[simulation.id for simulation in batch] for batch in watcher.watch()]
+    # 'a' is yielded as soon as it finishes, without waiting for the slow 'b' and 'c'
+    assert batches == [['a'], ['c']]
+    assert watcher.n_failed == 2  # 'b' Failed, 'd' Canceled
+    # doubles while nothing finishes (capped at max_interval), back to min_interval after a batch
+    assert sleeps == [1, 1, 1, 2, 3]
+    # the second manager is finished after two refreshes and is not refreshed any more
+    assert managers[0].n_refreshes == len(sleeps)
+    assert managers[1].n_refreshes == 2
+
+
+def test_plain_string_statuses_and_everything_finished_up_front():
+    manager = FakeExperimentManager([FakeSimulation('a', ['Succeeded'])])
+    for simulation in manager.experiment.simulations:
+        simulation.status = 'Succeeded'  # slurm_bundles status files give strings
+    watcher = CompletionWatcher([manager], sleep=lambda seconds: None)
+    assert [[s.id for s in batch] for batch in watcher.watch()] == [['a']]
@@ -0,0 +1,31 @@
+import json
+import os
+
+from input_dedup import ASSET_DIRNAME, verify_manifest, write_deduplicated, write_manifest
+
+
+def test_identical_inputs_are_stored_once_and_linked_relatively(tmp_path):
+    sim_dirs = [str(tmp_path / 'experiment' / name) for name in ['sim_a', 'sim_b']]
+    for i, sim_dir in enumerate(sim_dirs):
+        os.makedirs(sim_dir)
+        write_deduplicated(sim_dir, 'campaign.json', json.dumps({'Events': []}))
+        write_deduplicated(sim_dir, 'config.json', json.dumps({'parameters': {'Run_Number': i}}))
+
+    assets = os.listdir(tmp_path / 'experiment' / ASSET_DIRNAME)
+    assert len(assets) == 3  # one campaign, two configs
+    for sim_dir in sim_dirs:
+        link = os.readlink(os.path.join(sim_dir, 'campaign.json'))
+        assert not os.path.isabs(link) and link.startswith(os.path.join(os.pardir, ASSET_DIRNAME))
+        with open(os.path.join(sim_dir, 'campaign.json')) as f:
+            assert json.load(f) == {'Events': []}
+        assert os.stat(os.path.join(sim_dir, 'campaign.json')).st_mode & 0o222 == 0  # assets are read-only
+
+    manifest_filename = write_manifest(sim_dirs, manifest_name='test')
+    assert verify_manifest(manifest_filename) == []
+    # replacing one simulation's input only changes that simulation, and is reported
+    os.remove(os.path.join(sim_dirs[0], 'campaign.json'))
+    with open(os.path.join(sim_dirs[0], 'campaign.json'), 'w') as f:
+        f.write('{}')
+    assert verify_manifest(manifest_filename) == [(sim_dirs[0], 'campaign.json', 'content does not match manifest')]
+    with open(os.path.join(sim_dirs[1], 'campaign.json')) as f:
+        assert json.load(f) == {'Events': []}
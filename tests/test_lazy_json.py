@@ -0,0 +1,114 @@
+import copy
+import json
+import os
+
+import pytest
+
+from conftest import STATIC_DIR, TEMPLATE_DIR
+from lazy_json import LazyJsonDocument, close_lazy_templates, lazy_template
+from template_index import TemplatePathIndex
+
+OVERLAY_FILES = [os.path.join(TEMPLATE_DIR, name) for name in
+                 ['PFA_Overlay.json', 'Accessibility_and_Risk_IP_Overlay.json', 'Risk_Assortivity_Overlay.json']]
+
+
+class JsonTemplate(object):
+    # the parts of dtk's TaggedTemplate interface a lazy template replaces, plus an attribute set in __init__
+    def __init__(self, filename, contents):
+        self.filename = filename
+        self.contents = contents
+        self.known_params = []
+
+    def get_contents(self):
+        return self.contents
+
+
+def tagged_params(filename):
+    # the tagged parameters whose marked value exists, with their paths
+    with open(filename) as f:
+        contents = json.load(f)
+    return contents, {param: paths for param, paths in TemplatePathIndex(contents).tagged_paths.items()
+                      if TemplatePathIndex(contents).expand(param)}
+
+
+def write_simulation_input(sim_dir, name, contents):
+    # as DTKConfigBuilder.dump_files writes a demographics overlay added with add_demog_overlay(name, contents)
+    os.makedirs(sim_dir, exist_ok=True)
+    with open(os.path.join(sim_dir, '%s.json' % name), 'w') as f:
+        f.write(json.dumps(contents, sort_keys=True, indent=4))
+
+
+@pytest.mark.parametrize('filename', OVERLAY_FILES, ids=os.path.basename)
+def test_unknown_parameters_are_not_found(filename):
+    document = LazyJsonDocument(filename)
+    for param in ['Some_Garbage', 'Metadata', 'Nodes.0.NodeID', 'Some__KP_Garbage']:
+        assert not document.has_param(param)
+        assert document.set_param(param, 1) == 0
+    assert document.current == {}
+    assert document.document() == json.load(open(filename))
+
+
+@pytest.mark.parametrize('filename', OVERLAY_FILES, ids=os.path.basename)
+def test_written_simulation_input_matches_eager_template(filename, tmp_path):
+    contents, params = tagged_params(filename)
+    assert params
+    template = lazy_template(JsonTemplate, filename)
+    assert template.known_params == []  # set by the template class's __init__
+    for simulation in range(2):
+        template.reset()
+        expected = copy.deepcopy(contents)
+        for i, (param, paths) in enumerate(sorted(params.items())):
+            template.set_param(param, simulation * 100 + i)
+            for path in paths:
+                node = expected
+                for key in path[:-1]:
+                    node = node[key]
+                node[path[-1]] = simulation * 100 + i
+        sim_dir = str(tmp_path / ('sim_%d' % simulation))
+        write_simulation_input(sim_dir, 'overlay', template.get_contents())
+        with open(os.path.join(sim_dir, 'overlay.json')) as f:
+            written = json.load(f)
+        assert isinstance(written, dict)  # not a double-encoded json string
+        assert written == expected
+    with pytest.raises(KeyError):
+        template.set_param('Some_Garbage', 1)
+
+
+def test_overlay_written_by_the_config_builder(tmp_path):
+    pytest.importorskip('dtk')
+    from dtk.utils.builders.TaggedTemplate import DemographicsTemplate
+    from dtk.utils.core.DTKConfigBuilder import DTKConfigBuilder
+
+    filename = OVERLAY_FILES[0]
+    _, params = tagged_params(filename)
+    param = sorted(params)[0]
+    eager = DemographicsTemplate.from_file(filename)
+    lazy = lazy_template(DemographicsTemplate, filename)
+    config_builder = DTKConfigBuilder()
+    for name, template in [('eager', eager), ('lazy', lazy)]:
+        template.set_param(param, 0.5)
+        config_builder.add_demog_overlay(name, template.get_contents())
+    config_builder.dump_files(str(tmp_path))
+    with open(str(tmp_path / 'eager.json')) as eager_file, open(str(tmp_path / 'lazy.json')) as lazy_file:
+        assert json.load(lazy_file) == json.load(eager_file)
+
+
+def test_demographics_without_tags_is_returned_as_is():
+    filename = os.path.join(STATIC_DIR, 'Demographics.json')
+    document = LazyJsonDocument(filename)
+    assert document.spans == []
+    with open(filename) as f:
+        assert document.document() == json.load(f)
+
+
+def test_copies_share_one_parse_and_close_releases_it():
+    document = LazyJsonDocument(OVERLAY_FILES[0])
+    clone = copy.deepcopy(document)
+    assert clone.document() is document.document()  # parsed once for the document and all its copies
+    template = lazy_template(JsonTemplate, OVERLAY_FILES[0])
+    close_lazy_templates({'Baseline': {'config': [JsonTemplate('config.json', {})],
+                                       'campaign': {'campaign.json': JsonTemplate('campaign.json', {})},
+                                       'demographics': [template]}})
+    assert template.lazy_document.data.closed
+    document.close()
+    assert document.data.closed and clone.data.closed and document._whole['document'] is None
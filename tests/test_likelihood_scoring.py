@@ -0,0 +1,102 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from likelihood_scoring import LikelihoodScorer
+from stub_eradication import write_report
+
+NODE_MAP = {'1': 'Homa_Bay', '2': 'Kisii'}
+SCALE_FACTOR = 0.2
+# as in the Analyzers sheet of the Nyanza ingest form
+ANALYZERS = [
+    {'channel': 'Prevalence', 'distribution': 'Beta', 'provinciality': 'Non-provincial', 'age_bins': 'All matching',
+     'weight': 0.23},
+    {'channel': 'Prevalence', 'distribution': 'Beta', 'provinciality': 'Provincial', 'age_bins': 'All matching',
+     'weight': 0.23},
+    {'channel': 'Population', 'distribution': 'Gaussian', 'provinciality': 'Provincial', 'age_bins': 'All matching',
+     'weight': 0.06},
+    {'channel': 'OnART', 'distribution': 'Gaussian', 'provinciality': 'Provincial', 'age_bins': 'All matching',
+     'weight': 0.23}
+]
+
+
+def reference():
+    rows = []
+    for province, weight in [('All', None), ('Homa_Bay', 2.0), ('Kisii', None)]:
+        rows.append({'Year': 2003, 'Province': province, 'Gender': 'Male', 'AgeBin': '[15:50)', 'Prevalence': 0.15,
+                     'Prevalence--weight': weight, 'Prevalence--effective_count': 40})
+        rows.append({'Year': 2004, 'Province': province, 'Gender': 'Both', 'AgeBin': '[15:25)', 'Prevalence': 0.25,
+                     'Prevalence--effective_count': 20})
+    for province in NODE_MAP.values():
+        for age_bin, population in [('[0:5)', 20000), ('[5:10)', 15000)]:
+            rows.append({'Year': 2003, 'Province': province, 'Gender': 'Female', 'AgeBin': age_bin,
+                         'Population': population, 'Population--two_sigma': 0.2 * population})
+        rows.append({'Year': 2004.5, 'Province': province, 'Gender': 'Male', 'AgeBin': '[15:100)', 'OnART': 30000,
+                     'OnART--two_sigma': 6000, 'OnART--weight': 0.5})
+    rows.append({'Year': 2004.5, 'Province': 'All', 'Gender': 'Both', 'AgeBin': '[15:100)', 'OnART': 90000,
+                 'OnART--two_sigma': 18000})
+    return pd.DataFrame(rows).set_index(['Year', 'Province', 'Gender', 'AgeBin'])
+
+
+def expected_log_likelihoods(filename):
+    # straightforward per-simulation computation, independent of the vectorized scorer
+    report = pd.read_csv(filename)
+    report['Province'] = report['NodeId'].map({int(k): v for k, v in NODE_MAP.items()})
+    report['Gender'] = report['Gender'].map({0: 'Male', 1: 'Female'})
+    report['YearFloor'] = np.floor(report['Year'])
+    scores = {}
+    for analyzer in ANALYZERS:
+        channel, provincial = analyzer['channel'], analyzer['provinciality'] == 'Provincial'
+        total = 0.0
+        for (year, province, gender, age_bin), row in reference().iterrows():
+            if pd.isna(row[channel]) or (province != 'All') != provincial:
+                continue
+            low, high = [float(x) for x in age_bin[1:-1].split(':')]
+            stratum = report[(report['YearFloor'] == np.floor(year)) & (report['Age'] >= low) & (report['Age'] < high)]
+            if province != 'All':
+                stratum = stratum[stratum['Province'] == province]
+            if gender != 'Both':
+                stratum = stratum[stratum['Gender'] == gender]
+            n_steps = stratum['Year'].nunique()
+            weight = row.get(channel + '--weight')
+            weight = 1.0 if pd.isna(weight) else weight
+            if channel == 'Prevalence':
+                infected = stratum['Infected'].sum() / n_steps
+                population = stratum['Population'].sum() / n_steps
+                n = row['Prevalence--effective_count']
+                log_likelihood = stats.betabinom.logpmf(round(row['Prevalence'] * n), n, infected + 1,
+                                                        population - infected + 1)
+            else:
+                column = 'Population' if channel == 'Population' else 'On_ART'
+                simulated = stratum[column].sum() / n_steps / SCALE_FACTOR
+                log_likelihood = stats.norm.logpdf(row[channel], loc=simulated, scale=row[channel + '--two_sigma'] / 2)
+            total += weight * log_likelihood
+        scores['%s_%s' % (channel, 'provincial' if provincial else 'nonprovincial')] = total
+    scores['total'] = sum(analyzer['weight'] * scores[name] for analyzer, name in zip(ANALYZERS, list(scores)))
+    return scores
+
+
+def test_scores_match_per_simulation_likelihoods(tmp_path):
+    filenames = []
+    for run_number in range(3):
+        filename = str(tmp_path / ('report_%d.csv' % run_number))
+        write_report(filename, base_year=2002, n_years=4, node_ids=[1, 2], rng=random.Random(run_number))
+        filenames.append(filename)
+    scorer = LikelihoodScorer(reference(), ANALYZERS, NODE_MAP, scale_factor=SCALE_FACTOR)
+    # two batches, so that the strata of the first report are reused
+    table = scorer.score_files([{'run': i} for i in range(3)], filenames, batch_size=2)
+    assert list(table.columns) == ['run', 'Prevalence_nonprovincial', 'Prevalence_provincial', 'Population_provincial',
+                                   'OnART_provincial', 'total']
+    for i, filename in enumerate(filenames):
+        for column, value in expected_log_likelihoods(filename).items():
+            assert table.loc[i, column] == pytest.approx(value, rel=1e-9), column
+
+
+def test_invalid_analyzers_raise():
+    with pytest.raises(ValueError):
+        LikelihoodScorer(reference(), [{'channel': 'OnART', 'distribution': 'Beta'}], NODE_MAP)
+    with pytest.raises(ValueError):
+        LikelihoodScorer(reference(), [{'channel': 'Typo', 'distribution': 'Gaussian'}], NODE_MAP)
@@ -0,0 +1,86 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import slurm_bundles
+from conftest import REPO_DIR
+from local_pool import LocalPool, run_on_local_pool
+from slurm_bundles import (STATE_FAILED, STATE_QUEUED, STATE_RUNNING, STATE_SUCCEEDED, absolute_paths, current_owner,
+                           read_status, stop_running_simulations, write_status)
+from test_slurm_bundles import FakeExperimentManager, make_sim_dirs
+
+STUB_COMMAND = '%s %s --config config.json' % (sys.executable, os.path.join(REPO_DIR, 'stub_eradication.py'))
+
+
+@pytest.fixture(autouse=True)
+def fast_stub(monkeypatch):
+    monkeypatch.setenv('STUB_ERADICATION_SECONDS', '0')
+    yield
+    slurm_bundles._stopping.clear()  # stop_running_simulations stops the pools of the whole process
+
+
+def run_pool(sim_dirs, command=STUB_COMMAND, **kwargs):
+    pool = LocalPool(command, max_workers=2, **kwargs)
+    pool.submit(sim_dirs)
+    n_failed = pool.wait()
+    return n_failed, [read_status(sim_dir) for sim_dir in sim_dirs]
+
+
+def test_stub_simulations_with_failures_and_retries(tmp_path, monkeypatch):
+    sim_dirs = make_sim_dirs(tmp_path, 3)
+    assert run_pool(sim_dirs) == (0, [STATE_SUCCEEDED] * 3)
+    assert os.path.exists(os.path.join(sim_dirs[0], 'output', 'ReportHIVByAgeAndGender.csv'))
+
+    monkeypatch.setenv('STUB_ERADICATION_FAIL_RATE', '1')
+    assert run_pool(sim_dirs, retries=1) == (3, [STATE_FAILED] * 3)
+    monkeypatch.delenv('STUB_ERADICATION_FAIL_RATE')
+
+    # fails on the first attempt only
+    command = 'if [ -e attempted ]; then %s; else touch attempted; exit 1; fi' % STUB_COMMAND
+    assert run_pool(sim_dirs, command=command) == (3, [STATE_FAILED] * 3)
+    assert run_pool(sim_dirs, command=command, retries=1) == (0, [STATE_SUCCEEDED] * 3)
+
+
+def test_timeout_kills_the_simulation(tmp_path, monkeypatch):
+    monkeypatch.setenv('STUB_ERADICATION_SECONDS', '30')
+    sim_dirs = make_sim_dirs(tmp_path, 1)
+    start = time.time()
+    assert run_pool(sim_dirs, timeout=0.5, retries=1) == (1, [STATE_FAILED])
+    assert time.time() - start < 10
+    with open(os.path.join(sim_dirs[0], 'StdErr.txt')) as f:
+        assert 'timed out' in f.read()
+
+
+def test_stopping_requeues_and_resume_skips_live_owners(tmp_path, monkeypatch):
+    monkeypatch.setenv('STUB_ERADICATION_SECONDS', '30')
+    sim_dirs = make_sim_dirs(tmp_path, 4)
+    pool = LocalPool(STUB_COMMAND, max_workers=2)
+    pool.submit(sim_dirs[:2])
+    while [read_status(sim_dir) for sim_dir in sim_dirs[:2]] != [STATE_RUNNING] * 2:
+        time.sleep(0.05)
+    stop_running_simulations()
+    assert pool.wait() == 0
+    assert [read_status(sim_dir) for sim_dir in sim_dirs[:2]] == [STATE_QUEUED] * 2
+    slurm_bundles._stopping.clear()
+
+    # sim 2 is run by a live process (this one), sim 3 by a process that has exited
+    write_status(sim_dirs[2], STATE_RUNNING, owner=current_owner())
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    write_status(sim_dirs[3], STATE_RUNNING, owner='%s %d' % (current_owner().rsplit(' ', 1)[0], exited.pid))
+    write_status(sim_dirs[0], STATE_SUCCEEDED)
+    monkeypatch.setenv('STUB_ERADICATION_SECONDS', '0')
+    pool, _ = run_on_local_pool([FakeExperimentManager(sim_dirs)], STUB_COMMAND, max_workers=2, rerun_finished=False)
+    pool.wait()
+    assert [read_status(sim_dir) for sim_dir in sim_dirs] == [STATE_SUCCEEDED, STATE_SUCCEEDED, STATE_RUNNING,
+                                                              STATE_SUCCEEDED]
+
+
+def test_relative_paths_are_made_absolute(monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    assert absolute_paths('python stub_eradication.py') == 'python %s' % os.path.join(REPO_DIR, 'stub_eradication.py')
+    assert absolute_paths('./InputFiles/Static') == os.path.join(REPO_DIR, 'InputFiles', 'Static')
+    assert absolute_paths('/abs/missing') == '/abs/missing'
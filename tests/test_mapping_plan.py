@@ -0,0 +1,145 @@
+import copy
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from conftest import REPO_DIR
+from mapping_plan import (NON_PARAMETER_COLUMNS, NYANZA_PROVINCES, MappingPlan, benchmark, columns_as_params,
+                          compile_mapping_plan, table_records)
+
+PLAN = MappingPlan([
+    {'kind': 'copy', 'inputs': ['BaseInfectivity'], 'outputs': ['Base_Infectivity']},
+    {'kind': 'ordered_pair', 'inputs': ['Min', 'Max'], 'outputs': ['Ramp_Min', 'Ramp_Max']},
+    {'kind': 'copy_unless_nan', 'inputs': ['Ramp Rate'], 'shared': True, 'outputs': ['A.Ramp_Rate']},
+    {'kind': 'copy_unless_nan', 'inputs': ['Ramp Rate'], 'shared': True, 'outputs': ['B.Ramp_Rate']}
+])
+
+
+def single_tables(samples):
+    tables = []
+    for record in samples.to_dict(orient='records'):
+        table = {}
+        assert PLAN.apply(record, table) == []
+        tables.append(table)
+    return tables
+
+
+def test_batch_rows_leave_out_nan_inputs_like_single_samples():
+    samples = pd.DataFrame({'BaseInfectivity': [0.1, 0.2, 0.3], 'Min': [1.0, 5.0, 2.0], 'Max': [4.0, 3.0, 2.5],
+                            'Ramp Rate': [0.5, np.nan, 0.7]})
+    table = {}
+    assert PLAN.apply_batch(samples, table) == []
+    rows = table_records(table, len(samples))
+
+    assert rows == single_tables(samples)
+    assert 'A.Ramp_Rate' not in rows[1] and 'B.Ramp_Rate' not in rows[1]
+    assert rows[0]['A.Ramp_Rate'] == 0.5 and rows[1]['Ramp_Min'] == 3.0
+    benchmark(PLAN, samples, n_repeats=1)  # raises if single-sample and batch mapping differ
+
+
+def test_all_nan_input_is_left_out_of_every_row():
+    samples = pd.DataFrame({'BaseInfectivity': [0.1, 0.2], 'Min': [1.0, 2.0], 'Max': [2.0, 3.0],
+                            'Ramp Rate': [np.nan, np.nan]})
+    table = {}
+    PLAN.apply_batch(samples, table)
+    assert 'A.Ramp_Rate' not in table
+    assert table_records(table, len(samples)) == single_tables(samples)
+
+
+def baseline_mapping(sample_dict, params):
+    # map_sample_to_model_input of the baseline optim_script.py, before the mapping plan, without the base table
+    table = {}
+    sample = copy.deepcopy(sample_dict)
+
+    if 'BaseInfectivity' in sample:
+        value = sample.pop('BaseInfectivity')
+        table['Base_Infectivity'] = value
+
+    if ('PreARTLinkMin' in sample) and ('PreARTLinkMax' in sample):
+        min_value = sample.pop('PreARTLinkMin')
+        max_value = sample.pop('PreARTLinkMax')
+        if max_value > min_value:
+            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Min'] = min_value
+            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Max'] = max_value
+        else:
+            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Min'] = max_value
+            table['Actual_IndividualIntervention_Config__KP_PreART_Link.Ramp_Max'] = min_value
+
+    if ('MaleToFemaleYoung' in sample) and ('MaleToFemaleOld' in sample):
+        young = sample.pop('MaleToFemaleYoung')
+        old = sample.pop('MaleToFemaleOld')
+        table['Male_To_Female_Relative_Infectivity_Multipliers'] = [young, young, old]
+
+    risk_reduction_fraction = sample.pop('Risk Reduction Fraction') if 'Risk Reduction Fraction' in sample else float(
+        'NaN')
+    risk_ramp_rate = sample.pop('Risk Ramp Rate') if 'Risk Ramp Rate' in sample else float('NaN')
+    risk_ramp_midyear = sample.pop('Risk Ramp MidYear') if 'Risk Ramp MidYear' in sample else float('NaN')
+
+    for province in ['Homa_Bay', 'Kisii', 'Kisumu', 'Migori', 'Nyamira', 'Siaya']:
+        key = '%sLOWRisk' % province
+        if key in sample:
+            value = sample.pop(key)
+            param = 'Initial_Distribution__KP_Risk_%s' % province
+            table[param] = [value, 1 - value, 0]
+
+        if not math.isnan(risk_reduction_fraction):
+            param = 'Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.Ramp_Max' % province
+            table[param] = risk_reduction_fraction
+
+        if not math.isnan(risk_ramp_rate):
+            param = 'Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.Ramp_Rate' % province
+            table[param] = risk_ramp_rate
+
+        if not math.isnan(risk_ramp_midyear):
+            param = 'Actual_IndividualIntervention_Config__KP_Medium_Risk_%s.Ramp_MidYear' % province
+            table[param] = risk_ramp_midyear
+
+    if 'RiskAssortivity' in sample:
+        v = sample.pop('RiskAssortivity')
+        table['Weighting_Matrix_RowMale_ColumnFemale__KP_RiskAssortivity'] = [
+            [v, 1 - v, 0],
+            [1 - v, v, v],
+            [0, v, 1 - v]]
+
+    for p in params:
+        if 'MapTo' in p:
+            try:
+                value = sample.pop(p['Name'])
+            except KeyError:
+                continue  # no mapping needed, key not present in sample
+
+            if isinstance(p['MapTo'], list):
+                for mapto in p['MapTo']:
+                    table[mapto] = value
+            else:
+                table[p['MapTo']] = value
+
+    assert len(sample) == 0  # All params used
+    return table
+
+
+def test_calibration_plan_matches_baseline_mapping():
+    samples = pd.read_csv(os.path.join(REPO_DIR, 'resampled_parameter_sets_short.csv'))
+    samples = samples.drop(columns=NON_PARAMETER_COLUMNS)
+    params = columns_as_params(samples.columns)
+    params[0]['MapTo'] = ['%s.%s' % (params[0]['Name'], i) for i in range(2)]  # a parameter mapped to several
+    # the campaign risk parameters, set in some rows and NaN (left out) in others
+    samples['Risk Reduction Fraction'] = [0.5 if i % 2 else np.nan for i in range(len(samples))]
+    samples['Risk Ramp Rate'] = [np.nan if i % 3 else 0.3 for i in range(len(samples))]
+    samples['Risk Ramp MidYear'] = np.nan
+    plan = compile_mapping_plan(params, NYANZA_PROVINCES)
+
+    table = {}
+    assert plan.apply_batch(samples, table) == []
+    rows = table_records(table, len(samples))
+    expected = [baseline_mapping(record, params) for record in samples.to_dict(orient='records')]
+    assert rows == expected
+    for record, expected_table in zip(samples.to_dict(orient='records'), expected):
+        table = {}
+        assert plan.apply(record, table) == []
+        assert table == expected_table
+    assert 'Actual_IndividualIntervention_Config__KP_Medium_Risk_Kisii.Ramp_Max' not in rows[0]
+    assert rows[1]['Actual_IndividualIntervention_Config__KP_Medium_Risk_Kisii.Ramp_Max'] == 0.5
+    assert not any('Ramp_MidYear' in name for row in rows for name in row)
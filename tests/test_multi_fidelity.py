@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from multi_fidelity import FIDELITY_COLUMN, RESULTS_COLUMN, MultiFidelityNextPoint
+
+
+class FakeNextPoint(object):
+    # records what it is given, with a get_state/set_state like calibtool's NextPointAlgorithm
+    def __init__(self, n_samples=4):
+        self.n_samples = n_samples
+        self.iterations = []
+        self.results = {}
+
+    def get_samples_for_iteration(self, iteration):
+        return pd.DataFrame({'a': np.arange(self.n_samples) + 10.0 * iteration, 'b': 1.0})
+
+    def set_results_for_iteration(self, iteration, results):
+        self.results[iteration] = results[RESULTS_COLUMN].tolist()
+
+    def update_iteration(self, iteration):
+        self.iterations.append(iteration)
+
+    def get_state(self):
+        return {'results': {str(i): r for i, r in self.results.items()}}
+
+    def set_state(self, state, iteration):
+        self.iterations.append(iteration)
+        self.results = {int(i): r for i, r in state['results'].items()}
+
+    def end_condition(self):
+        return False
+
+
+def results(values):
+    return pd.DataFrame({RESULTS_COLUMN: values})
+
+
+def test_replicates_per_fidelity_and_resume_between_stages():
+    wrapper = MultiFidelityNextPoint(FakeNextPoint(), low_fidelity_replicates=3, full_fidelity_replicates=2,
+                                     promotion_margin=1.5, min_promoted=1)
+    wrapper.update_iteration(3)
+    assert wrapper.next_point.iterations == [1]
+
+    screening = wrapper.get_samples_for_iteration(2)
+    assert len(screening) == 4 * 3  # one simulation per sample, CalibManager adds no replicates
+    assert set(screening[FIDELITY_COLUMN]) == {0}
+    assert list(screening['a'][:4]) == [10.0, 10.0, 10.0, 11.0]
+    # candidate means: -5, -1, -2, -10
+    wrapper.set_results_for_iteration(2, results([-5, -5, -5, -2, 0, -1, -2, -2, -2, -10, -10, -10]))
+
+    # the state is stored as json by CalibManager; a new process resumes at the full-scale stage
+    state = json.loads(json.dumps(wrapper.get_state()))
+    resumed = MultiFidelityNextPoint(FakeNextPoint(), low_fidelity_replicates=3, full_fidelity_replicates=2,
+                                     promotion_margin=1.5, min_promoted=1)
+    resumed.set_state(state, 3)
+    assert resumed.next_point.iterations == [1]
+    assert not resumed.end_condition()
+
+    full_scale = resumed.get_samples_for_iteration(3)
+    assert list(full_scale['a']) == [11.0, 11.0, 12.0, 12.0]
+    assert set(full_scale[FIDELITY_COLUMN]) == {1}
+    resumed.set_results_for_iteration(3, results([-0.5, -1.5, -3, -3]))
+    assert resumed.next_point.results[1] == [-5.0, -1.0, -3.0, -10.0]
@@ -0,0 +1,52 @@
+import random
+
+import pandas as pd
+import pytest
+
+from output_reduction import ReductionSpec, find_reduced_basenames
+from stub_eradication import write_report
+
+NYANZA_CHANNELS = ['Prevalence', 'Population', 'OnART']
+NODE_MAP = {'1': 'Homa_Bay', '2': 'Kisii'}
+
+
+@pytest.fixture
+def report_filename(tmp_path):
+    filename = str(tmp_path / 'output' / 'ReportHIVByAgeAndGender.csv')
+    write_report(filename, base_year=2000, n_years=2, node_ids=[1, 2], rng=random.Random(0))
+    return filename
+
+
+def test_ingest_form_channels_reduce_stub_report(report_filename):
+    spec = ReductionSpec(NYANZA_CHANNELS, NODE_MAP)
+    assert spec.columns == ['Infected', 'Population', 'On_ART']
+    report = pd.read_csv(report_filename)
+    reduced = spec.reduce_frame(report)
+    assert sorted(reduced['Province'].unique()) == ['Homa_Bay', 'Kisii']
+    in_bins = report[(report['Age'] >= 15) & (report['Age'] < 50)]
+    assert reduced['On_ART'].sum() == in_bins['On_ART'].sum()
+
+
+def test_unknown_channels_and_group_by_keys_raise():
+    with pytest.raises(ValueError):
+        ReductionSpec(['Prevalence', 'Typo'], NODE_MAP)
+    with pytest.raises(ValueError):
+        ReductionSpec(NYANZA_CHANNELS, NODE_MAP, group_by=['Year', 'County'])
+
+
+def test_reduced_filename_depends_on_spec(report_filename, tmp_path):
+    default = ReductionSpec(NYANZA_CHANNELS, NODE_MAP)
+    assert ReductionSpec(NYANZA_CHANNELS, NODE_MAP).key == default.key
+    others = [ReductionSpec(NYANZA_CHANNELS, NODE_MAP, age_bins=[15, 50]),
+              ReductionSpec(NYANZA_CHANNELS, NODE_MAP, group_by=['Year', 'Province']),
+              ReductionSpec(['Prevalence'], NODE_MAP)]
+    assert len({default.key} | {spec.key for spec in others}) == 4
+
+    for spec in [default, others[1]]:
+        destination = str(tmp_path / 'out' / 'Baseline' /
+                          (spec.reduced_basename + '_TPI0000_REP0001.csv'))
+        spec.reduce_file(report_filename, destination)
+    assert find_reduced_basenames(str(tmp_path / 'out')) == sorted([default.reduced_basename,
+                                                                    others[1].reduced_basename])
+    reduced = pd.read_csv(str(tmp_path / 'out' / 'Baseline' / (others[1].reduced_basename + '_TPI0000_REP0001.csv')))
+    assert list(reduced.columns) == ['Year', 'Province', 'Infected', 'Population', 'On_ART']
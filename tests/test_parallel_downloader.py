@@ -0,0 +1,88 @@
+import os
+import shutil
+
+import pytest
+
+import parallel_downloader
+from parallel_downloader import ParallelDownloader
+
+REPORT = os.path.join('output', 'ReportHIVByAgeAndGender.csv')
+
+
+class FakeExperiment(object):
+    exp_name = 'Baseline-ART'
+
+
+class FakeSimulation(object):
+    def __init__(self, sim_dir, parameterization_id):
+        self.sim_dir = sim_dir
+        self.tags = {'parameterization_id': parameterization_id, 'Run_Number': 1}
+        self.experiment = FakeExperiment()
+
+    def get_path(self):
+        return self.sim_dir
+
+
+def make_simulations(root, n_simulations):
+    simulations = []
+    for i in range(n_simulations):
+        sim_dir = os.path.join(str(root), 'sim_%d' % i)
+        os.makedirs(os.path.join(sim_dir, 'output'))
+        with open(os.path.join(sim_dir, REPORT), 'w') as f:
+            f.write('Year,Population\n2020,%d\n' % (1000 + i))
+        simulations.append(FakeSimulation(sim_dir, i))
+    return simulations
+
+
+def download(output_path, simulations):
+    downloader = ParallelDownloader(output_path, [REPORT], n_workers=2)
+    downloader.submit(simulations)
+    downloader.finish()
+    return downloader
+
+
+def test_rerun_skips_present_files_without_hashing(tmp_path, monkeypatch):
+    simulations = make_simulations(tmp_path / 'sims', 3)
+    output_path = str(tmp_path / 'output')
+    assert download(output_path, simulations).n_copied == 3
+    destination = os.path.join(output_path, 'Baseline-ART', 'ReportHIVByAgeAndGender_TPI0001_REP0001.csv')
+    with open(destination) as f:
+        assert f.read() == 'Year,Population\n2020,1001\n'
+
+    hashed = []
+    monkeypatch.setattr(parallel_downloader, 'file_md5', lambda filename: hashed.append(filename) or filename)
+    rerun = download(output_path, simulations)
+    assert (rerun.n_copied, rerun.n_skipped) == (0, 3)
+    assert hashed == []  # same size and modification time
+
+
+def test_changed_source_is_copied_again(tmp_path):
+    simulations = make_simulations(tmp_path / 'sims', 2)
+    output_path = str(tmp_path / 'output')
+    download(output_path, simulations)
+    source = os.path.join(simulations[0].get_path(), REPORT)
+    with open(source, 'w') as f:
+        f.write('Year,Population\n2020,2000\n')  # same size, new modification time and contents
+    os.utime(source, ns=(0, os.stat(source).st_mtime_ns + 10 ** 9))
+    rerun = download(output_path, simulations)
+    assert (rerun.n_copied, rerun.n_skipped) == (1, 1)
+    with open(os.path.join(output_path, 'Baseline-ART', 'ReportHIVByAgeAndGender_TPI0000_REP0001.csv')) as f:
+        assert f.read() == 'Year,Population\n2020,2000\n'
+
+
+def test_failed_copy_leaves_no_partial_file(tmp_path, monkeypatch):
+    simulations = make_simulations(tmp_path / 'sims', 1)
+    output_path = str(tmp_path / 'output')
+
+    def failing_copy(source, destination):
+        with open(destination, 'w') as f:
+            f.write('Year,Pop')
+        raise OSError('Connection lost')
+
+    monkeypatch.setattr(shutil, 'copyfile', failing_copy)
+    with pytest.raises(OSError):
+        download(output_path, simulations)
+    assert os.listdir(os.path.join(output_path, 'Baseline-ART')) == []
+
+    monkeypatch.undo()
+    assert download(output_path, simulations).n_copied == 1
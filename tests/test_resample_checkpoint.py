@@ -0,0 +1,59 @@
+import os
+
+from resample_checkpoint import checkpointed_resampler
+
+
+class Point(object):
+    # the part of calibtool's Point a checkpoint is keyed on
+    def __init__(self, values):
+        self.values = values
+
+    def to_value_dict(self):
+        return dict(self.values)
+
+
+class FakePerturbationResampler(object):
+    def __init__(self, M, N, n):
+        self.M = M
+        self.calib_manager = None
+        self.n_runs = 0
+
+    def set_calibration_manager(self, calib_manager):
+        self.calib_manager = calib_manager
+
+    def resample_and_run(self, calibrated_points, resample_step, selection_values, initial_calibration_points):
+        self.n_runs += 1
+        points = [Point({'Base_Infectivity': point.to_value_dict()['Base_Infectivity'] + i / self.M})
+                  for point in calibrated_points for i in range(3)]
+        return points, selection_values
+
+
+def run_step(checkpoint_dir, calibrated_points, M=1800):
+    resampler = checkpointed_resampler(FakePerturbationResampler, checkpoint_dir, M=M, N=10, n=1)
+    resampler.set_calibration_manager('calib_manager')
+    points, selection_values = resampler.resample_and_run(calibrated_points=calibrated_points, resample_step=0,
+                                                          selection_values={'selected': 1},
+                                                          initial_calibration_points=calibrated_points)
+    return resampler, points, selection_values
+
+
+def test_restart_loads_the_finished_step(tmp_path):
+    checkpoint_dir = str(tmp_path / 'resample_checkpoints')
+    calibrated_points = [Point({'Base_Infectivity': 0.5})]
+    first, first_points, _ = run_step(checkpoint_dir, calibrated_points)
+    assert first.n_runs == 1 and first.calib_manager == 'calib_manager'
+    assert len(os.listdir(checkpoint_dir)) == 1
+
+    restarted, points, selection_values = run_step(checkpoint_dir, calibrated_points)
+    assert restarted.n_runs == 0  # not evaluated again
+    assert [p.to_value_dict() for p in points] == [p.to_value_dict() for p in first_points]
+    assert selection_values == {'selected': 1}
+
+
+def test_other_point_or_settings_run_again(tmp_path):
+    checkpoint_dir = str(tmp_path / 'resample_checkpoints')
+    run_step(checkpoint_dir, [Point({'Base_Infectivity': 0.5})])
+    other_point, _, _ = run_step(checkpoint_dir, [Point({'Base_Infectivity': 0.6})])
+    other_settings, _, _ = run_step(checkpoint_dir, [Point({'Base_Infectivity': 0.5})], M=900)
+    assert other_point.n_runs == 1 and other_settings.n_runs == 1
+    assert len(os.listdir(checkpoint_dir)) == 3
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from completion_index import fingerprint_combination
+from sample_store import SampleStore, roulette_resample
+
+
+def write_samples(tmp_path):
+    filename = str(tmp_path / 'resampled_parameter_sets.csv')
+    pd.DataFrame({'parameterization_id': [0, 1], 'Base_Infectivity': [0.5, 0.25], 'SeedYrHigh': [1982, 1985],
+                  'run_number': [7, 8], 'likelihood': [-1.5, -2.5]}).to_csv(filename, index=False)
+    return filename
+
+
+def test_integer_parameters_keep_their_dtype(tmp_path):
+    filename = write_samples(tmp_path)
+    csv_row = pd.read_csv(filename).drop(columns=['parameterization_id', 'run_number', 'likelihood'])
+    csv_fingerprint = fingerprint_combination('ts', 'sha', csv_row.to_dict(orient='records')[0])
+
+    store = SampleStore.from_csv(filename)
+    store.save(str(tmp_path / 'store'))
+    for loaded in [store, SampleStore.load(str(tmp_path / 'store'), mmap=True)]:
+        chunk, run_numbers, parameterization_ids = next(loaded.iter_chunks(10))
+        assert chunk['SeedYrHigh'].dtype == np.int64 and chunk['Base_Infectivity'].dtype == np.float64
+        param_dict, run_number, parameterization_id = next(loaded.iter_records())
+        assert param_dict == {'Base_Infectivity': 0.5, 'SeedYrHigh': 1982} and type(param_dict['SeedYrHigh']) is int
+        assert fingerprint_combination('ts', 'sha', chunk.to_dict(orient='records')[0]) == csv_fingerprint
+
+    store.to_csv(str(tmp_path / 'written.csv'))
+    with open(filename) as original, open(str(tmp_path / 'written.csv')) as written:
+        assert written.read() == original.read()
+
+
+def test_roulette_resample_is_reproducible_with_a_seed():
+    log_likelihoods = np.random.default_rng(3).normal(-50, 5, size=200)
+    first = roulette_resample(log_likelihoods, 30, np.random.default_rng(42))
+    assert list(first) == list(roulette_resample(log_likelihoods, 30, np.random.default_rng(42)))
+    assert list(first) != list(roulette_resample(log_likelihoods, 30, np.random.default_rng(43)))
+    assert len(set(first)) == 30  # without replacement
+    assert list(first[:10]) == list(np.argsort(-log_likelihoods)[:10])  # ceil(30 / 3) most likely first
+
+
+def test_roulette_draws_follow_the_likelihoods_without_underflow():
+    # log-likelihoods around -1e5: exp() of every one of them is 0.0
+    weights = np.array([0.1, 0.2, 0.3, 0.4])
+    log_likelihoods = np.concatenate([[-9e4], -1e5 + np.log(weights)])
+    rng = np.random.default_rng(0)
+    n_draws = 4000
+    counts = np.zeros(len(log_likelihoods))
+    for _ in range(n_draws):
+        selected = roulette_resample(log_likelihoods, 2, rng)
+        assert selected[0] == 0  # the most likely set
+        counts[selected[1]] += 1
+    assert counts[0] == 0
+    assert counts[1:] / n_draws == pytest.approx(weights, abs=0.03)
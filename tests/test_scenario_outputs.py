@@ -0,0 +1,50 @@
+import os
+import random
+
+import pytest
+
+from scenario_outputs import (REP_TAG, SCENARIO_COLUMN, TPI_TAG, benchmark, convert_reports_to_parquet, load_report_files,
+                              load_result_store)
+from stub_eradication import write_report
+
+
+def write_reports(output_path):
+    for scenario in ['Baseline', 'NoART']:
+        for parameterization_id in [0, 1]:
+            filename = os.path.join(output_path, scenario, 'ReportHIVByAgeAndGender_TPI%04d_REP%04d.csv' %
+                                    (parameterization_id, 7))
+            write_report(filename, base_year=2002, n_years=2, node_ids=[1, 2], rng=random.Random(parameterization_id))
+
+
+def test_load_report_files_adds_the_report_keys(tmp_path):
+    write_reports(str(tmp_path))
+    loaded = load_report_files(str(tmp_path), columns=['Year', 'Infected', SCENARIO_COLUMN, TPI_TAG, REP_TAG])
+    assert list(loaded.columns) == ['Year', 'Infected', SCENARIO_COLUMN, TPI_TAG, REP_TAG]
+    assert len(loaded) == 4 * 4 * 2 * 2 * 20  # reports x half-years x nodes x genders x ages
+    assert sorted(loaded[SCENARIO_COLUMN].unique()) == ['Baseline', 'NoART'] and set(loaded[REP_TAG]) == {7}
+
+
+def test_benchmark_converts_and_loads_both_formats(tmp_path):
+    pytest.importorskip('pyarrow')
+    output_path = str(tmp_path / 'output')
+    write_reports(output_path)
+    csv_result, parquet_result = benchmark(output_path, str(tmp_path / 'store.parquet'), columns=['Year', 'Infected'],
+                                           n_repeats=1)
+    assert all(value > 0 for value in csv_result + parquet_result)
+
+
+def test_reconverting_a_shorter_report_leaves_no_stale_chunks(tmp_path):
+    pytest.importorskip('pyarrow')
+    output_path = str(tmp_path / 'output')
+    dataset_path = str(tmp_path / 'store.parquet')
+    write_reports(output_path)
+    convert_reports_to_parquet(output_path, dataset_path, chunksize=100)  # 320 rows, 4 chunks per report
+
+    filename = os.path.join(output_path, 'Baseline', 'ReportHIVByAgeAndGender_TPI0000_REP0007.csv')
+    write_report(filename, base_year=2002, n_years=1, node_ids=[1], rng=random.Random(3))  # 80 rows, 1 chunk
+    convert_reports_to_parquet(output_path, dataset_path, chunksize=100)
+    stored = load_result_store(dataset_path, columns=['Year', 'Infected', SCENARIO_COLUMN, TPI_TAG, REP_TAG])
+    reports = load_report_files(output_path, columns=['Year', 'Infected', SCENARIO_COLUMN, TPI_TAG, REP_TAG])
+    assert len(stored) == len(reports) == 3 * 320 + 80
+    baseline = stored[(stored[SCENARIO_COLUMN] == 'Baseline') & (stored[TPI_TAG] == 0)]
+    assert len(baseline) == 80
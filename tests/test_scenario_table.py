@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+
+from scenario_table import (MissingCampaignSpecificationException, ScenarioTableParseException,
+                            UnknownCampaignException, load_scenario_table, parse_literal_columns, read_scenario_table)
+
+
+def write_table(tmp_path, text):
+    filename = str(tmp_path / 'scenarios.csv')
+    with open(filename, 'w') as f:
+        f.write(text)
+    return filename
+
+
+def test_parse_literal_columns_parses_list_cells_only():
+    table = pd.DataFrame({'Campaign': ['a.json', 'b.json'], 'Matrix': ['[[1, 0], [0, 1]]', "[0.5, 'x']"],
+                          'Mixed': ['[1,2,3]', 'plain'], 'Number': [1.5, 2.5]})
+    parsed = parse_literal_columns(table, filename='scenarios.csv')
+    assert parsed['Matrix'].tolist() == [[[1, 0], [0, 1]], [0.5, 'x']]
+    assert parsed['Mixed'].tolist() == [[1, 2, 3], 'plain']
+    assert parsed['Campaign'].tolist() == ['a.json', 'b.json'] and parsed['Number'].tolist() == [1.5, 2.5]
+
+
+def test_parse_literal_columns_executes_nothing_and_names_the_column():
+    table = pd.DataFrame({'Bad': ["[__import__('os').getcwd()]"]})
+    with pytest.raises(ScenarioTableParseException, match='Bad'):
+        parse_literal_columns(table, filename='scenarios.csv')
+
+
+def test_read_scenario_table_parses_csv_text_columns(tmp_path):
+    # pandas >= 3 reads text as the str dtype, which has to be parsed as well as object columns
+    filename = write_table(tmp_path, 'Scenario,Campaign,Multipliers,Base_Infectivity\n'
+                                     'ART,art.json,"[1,2,3]",0.5\n'
+                                     ',base.json,"[4,5,6]",0.25\n')
+    table = read_scenario_table(filename)
+    assert table['Multipliers'].tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert table['Base_Infectivity'].tolist() == [0.5, 0.25]
+
+
+def test_load_scenario_table_checks_campaigns(tmp_path):
+    filename = write_table(tmp_path, 'Scenario,Campaign,Multipliers\nART,art.json,"[1,2]"\n,,"[3,4]"\n')
+    rows = load_scenario_table(filename, available_campaigns=['art.json'])
+    assert rows == [{'Scenario': 'ART', 'Campaign': 'art.json', 'Multipliers': [1, 2]},
+                    {'Scenario': None, 'Campaign': None, 'Multipliers': [3, 4]}]
+    with pytest.raises(UnknownCampaignException, match='art.json'):
+        load_scenario_table(filename, available_campaigns=['base.json'])
+
+    no_campaign = write_table(tmp_path, 'Scenario\nART\n')
+    with pytest.raises(MissingCampaignSpecificationException):
+        load_scenario_table(no_campaign)
+    assert load_scenario_table(None) == [{'Scenario': None, 'Campaign': None}]
+
+
+def test_read_scenario_table_native_list_columns(tmp_path):
+    pytest.importorskip('pyarrow')
+    filename = str(tmp_path / 'scenarios.parquet')
+    pd.DataFrame({'Campaign': ['a.json'], 'Multipliers': [[1.0, 2.0]]}).to_parquet(filename)
+    assert read_scenario_table(filename)['Multipliers'].tolist() == [[1.0, 2.0]]
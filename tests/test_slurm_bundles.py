@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import time
+
+from conftest import REPO_DIR
+from slurm_bundles import (STATE_FAILED, STATE_QUEUED, STATE_RUNNING, STATE_SUCCEEDED, STATE_UNKNOWN,
+                           BundledExperimentManager, bundle_dir_for_suite, submit_bundles, suite_was_bundled,
+                           write_status)
+
+
+class FakeSimulation(object):
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(path)
+
+    def get_path(self):
+        return self.path
+
+
+class FakeExperimentManager(object):
+    def __init__(self, sim_dirs):
+        self.experiment = type('Experiment', (), {})()
+        self.experiment.simulations = [FakeSimulation(sim_dir) for sim_dir in sim_dirs]
+
+
+def make_sim_dirs(root, n_sims, broken=()):
+    sim_dirs = []
+    for i in range(n_sims):
+        sim_dir = os.path.join(str(root), 'experiment', 'sim_%d' % i)
+        os.makedirs(sim_dir)
+        if i not in broken:  # the stub fails without a config
+            with open(os.path.join(sim_dir, 'config.json'), 'w') as f:
+                json.dump({'parameters': {'Base_Year': 2000, 'Simulation_Duration': 365, 'Run_Number': i}}, f)
+        sim_dirs.append(sim_dir)
+    return sim_dirs
+
+
+def test_bundles_run_through_fake_sbatch(tmp_path, monkeypatch):
+    monkeypatch.setenv('STUB_ERADICATION_SECONDS', '0')
+    sim_dirs = make_sim_dirs(tmp_path, 5, broken=[3])
+    managers = [FakeExperimentManager(sim_dirs[:2]), FakeExperimentManager(sim_dirs[2:])]
+    bundle_dir = bundle_dir_for_suite(str(tmp_path), 'suite1')
+    command = '%s %s --config config.json' % (sys.executable, os.path.join(REPO_DIR, 'stub_eradication.py'))
+    bundled = submit_bundles(managers, bundle_size=2, bundle_dir=bundle_dir, command=command,
+                             sbatch_command='%s %s' % (sys.executable, os.path.join(REPO_DIR, 'fake_sbatch.py')))
+    assert suite_was_bundled(str(tmp_path), 'suite1')
+    assert not suite_was_bundled(str(tmp_path), 'suite2')
+    with open(os.path.join(bundle_dir, 'bundles.json')) as f:
+        assert [len(bundle) for bundle in json.load(f)['bundles']] == [2, 2, 1]
+
+    deadline = time.time() + 60
+    while not all(em.finished() for em in bundled) and time.time() < deadline:
+        time.sleep(0.2)
+        for em in bundled:
+            em.refresh_experiment()
+    states = [simulation.status for em in bundled for simulation in em.experiment.simulations]
+    assert states == [STATE_SUCCEEDED] * 3 + [STATE_FAILED, STATE_SUCCEEDED]
+    assert os.path.exists(os.path.join(sim_dirs[4], 'output', 'ReportHIVByAgeAndGender.csv'))
+    assert os.path.exists(os.path.join(bundle_dir, 'bundle_1_2.out'))
+
+
+def test_missing_and_stale_statuses(tmp_path):
+    sim_dirs = make_sim_dirs(tmp_path, 3)
+    write_status(sim_dirs[1], STATE_RUNNING)
+    write_status(sim_dirs[2], STATE_QUEUED)
+    manager = BundledExperimentManager(FakeExperimentManager(sim_dirs))
+    assert [s.status for s in manager.experiment.simulations] == [STATE_UNKNOWN, STATE_RUNNING, STATE_QUEUED]
+    assert not manager.finished()
+
+    manager = BundledExperimentManager(FakeExperimentManager(sim_dirs), status_timeout=60)
+    assert not manager.finished()
+    an_hour_ago = time.time() - 3600
+    for sim_dir in sim_dirs[1:]:
+        os.utime(os.path.join(sim_dir, 'bundle_status.txt'), (an_hour_ago, an_hour_ago))
+    manager.experiment.simulations[0].missing_since = an_hour_ago
+    manager.refresh_experiment()
+    # an array waiting in the Slurm queue for longer than the timeout is not failed
+    assert [s.status for s in manager.experiment.simulations] == [STATE_FAILED, STATE_FAILED, STATE_QUEUED]
@@ -0,0 +1,58 @@
+import copy
+import json
+import threading
+import time
+
+from suite_profiler import SuiteProfiler
+
+
+def enabled_profiler(cprofile_phases=()):
+    profiler = SuiteProfiler()
+    profiler.enable(cprofile_phases=cprofile_phases)
+    return profiler
+
+
+def test_disabled_profiler_records_nothing(tmp_path):
+    profiler = SuiteProfiler()
+    with profiler.phase('mapping'), profiler.counting_deep_copies():
+        copy.deepcopy({'a': [1]})
+    profiler.count('simulations_generated')
+    assert profiler.timed('mapping', len) is len
+    profiler.write_report(str(tmp_path / 'profile.json'))
+    assert profiler.phases == {} and profiler.counters == {}
+    assert not (tmp_path / 'profile.json').exists()
+
+
+def test_phases_and_counters_are_reported(tmp_path):
+    profiler = enabled_profiler(cprofile_phases=['mapping'])
+    for _ in range(2):
+        with profiler.phase('mapping'):
+            sum(range(10000))
+    profiler.timed('polling_wait', time.sleep)(0.02)
+    profiler.count('simulations_generated', 3)
+    profiler.count('simulations_generated')
+
+    filename = str(tmp_path / 'profile.json')
+    profiler.write_report(filename)
+    with open(filename) as f:
+        report = json.load(f)
+    assert report['phases']['mapping']['calls'] == 2
+    polling_wait = report['phases']['polling_wait']
+    assert polling_wait['calls'] == 1 and polling_wait['wall_seconds'] >= 0.02
+    assert polling_wait['cpu_fraction'] < 0.5  # sleeping, not computing
+    assert report['counters'] == {'simulations_generated': 4}
+    assert 'cumulative' in report['cprofile']['mapping']
+    assert (tmp_path / 'profile_mapping.prof').exists()
+
+
+def test_only_outermost_deep_copies_of_this_thread_are_counted():
+    profiler = enabled_profiler()
+    nested = {'templates': [{'a': [1, 2]}, {'b': {'c': 3}}]}
+    with profiler.counting_deep_copies():
+        copy.deepcopy(nested)  # the nested containers are copied through copy.deepcopy too
+        copy.deepcopy(nested)
+        thread = threading.Thread(target=copy.deepcopy, args=(nested,))
+        thread.start()
+        thread.join()
+    copy.deepcopy(nested)  # after the context, copy.deepcopy is the original again
+    assert profiler.counters == {'deep_copies': 2}
@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from surrogate import RESULTS_COLUMN, SurrogateScreenedNextPoint
+
+
+class FakeNextPoint(object):
+    def __init__(self, n_candidates=12):
+        self.n_candidates = n_candidates
+        self.results = {}
+
+    def get_samples_for_iteration(self, iteration):
+        rng = np.random.default_rng(iteration)
+        return pd.DataFrame(rng.uniform(size=(self.n_candidates, 2)), columns=['a', 'b'])
+
+    def set_results_for_iteration(self, iteration, results):
+        self.results[iteration] = results[RESULTS_COLUMN].tolist()
+
+    def get_state(self):
+        return {'results': {str(i): r for i, r in self.results.items()}}
+
+    def set_state(self, state, iteration):
+        self.results = {int(i): r for i, r in state['results'].items()}
+
+
+def likelihood(samples):
+    return 1.0 + 2.0 * samples['a'] - 3.0 * samples['b']
+
+
+def screened(tmp_path, min_training_points):
+    return SurrogateScreenedNextPoint(FakeNextPoint(), param_names=['a', 'b'], n_keep=4, lower=[0, 0], upper=[1, 1],
+                                      log_filename=str(tmp_path / 'predictions.csv'),
+                                      min_training_points=min_training_points, seed=0)
+
+
+def test_runs_only_n_keep_before_training_and_resumes(tmp_path):
+    next_point = screened(tmp_path, min_training_points=8)
+    samples = next_point.get_samples_for_iteration(0)
+    assert len(samples) == 4  # not all 12 candidates, although there is nothing to screen with yet
+
+    # resumed in a new process from the json iteration state
+    resumed = screened(tmp_path, min_training_points=8)
+    resumed.set_state(json.loads(json.dumps(next_point.get_state())), 0)
+    pd.testing.assert_frame_equal(resumed.get_samples_for_iteration(0), samples)
+    resumed.set_results_for_iteration(0, pd.DataFrame({RESULTS_COLUMN: likelihood(samples)}))
+    # the candidates that were not run get the linear fit of the ones that were (exact on a linear surface)
+    candidates = FakeNextPoint().get_samples_for_iteration(0)
+    assert resumed.next_point.results[0] == pytest.approx(list(likelihood(candidates)))
+    assert len(resumed.training_y) == 4
+
+
+def test_screens_once_trained(tmp_path):
+    next_point = screened(tmp_path, min_training_points=4)
+    for iteration in range(2):
+        samples = next_point.get_samples_for_iteration(iteration)
+        assert len(samples) == 4
+        next_point.set_results_for_iteration(iteration, pd.DataFrame({RESULTS_COLUMN: likelihood(samples)}))
+    _, _, mean, _ = next_point.candidates[1]
+    assert not np.isnan(mean).any()
+    log = pd.read_csv(str(tmp_path / 'predictions.csv'))
+    assert len(log) == 24 and log['simulated'].sum() == 8
+
+
+class FakeOptimTool(FakeNextPoint):
+    # OptimTool's layout: center_repeats copies of the center first, then the hypersphere samples, all kept in its
+    # data table until their results are set
+    def __init__(self, n_candidates=12, center_repeats=3):
+        FakeNextPoint.__init__(self, n_candidates)
+        self.center_repeats = center_repeats
+        self.data = pd.DataFrame(columns=['Iteration', 'a', 'b', 'Results'])
+
+    def get_samples_for_iteration(self, iteration):
+        samples = FakeNextPoint.get_samples_for_iteration(self, iteration)
+        samples.iloc[:self.center_repeats] = [0.05, 0.95]  # a poor center, ranked last by the surrogate
+        self.data = pd.concat([self.data, samples.assign(Iteration=iteration, Results=np.nan)], ignore_index=True)
+        return samples
+
+    def set_results_for_iteration(self, iteration, results):
+        rows = self.data['Iteration'] == iteration
+        assert rows.sum() == len(results)  # as OptimTool, one result per sample of the iteration
+        self.data.loc[rows, 'Results'] = results[RESULTS_COLUMN].values
+        FakeNextPoint.set_results_for_iteration(self, iteration, results)
+
+
+def test_center_repeats_are_kept_and_optimtool_gets_simulated_rows_only(tmp_path):
+    optimtool = FakeOptimTool()
+    next_point = SurrogateScreenedNextPoint(optimtool, param_names=['a', 'b'], n_keep=6, lower=[0, 0], upper=[1, 1],
+                                            log_filename=str(tmp_path / 'predictions.csv'), min_training_points=4,
+                                            seed=0)
+    for iteration in range(2):
+        samples = next_point.get_samples_for_iteration(iteration)
+        assert len(samples) == 6
+        assert (samples[['a', 'b']].values == [0.05, 0.95]).all(axis=1).sum() == 3  # every center repeat
+        next_point.set_results_for_iteration(iteration, pd.DataFrame({RESULTS_COLUMN: likelihood(samples)}))
+
+        simulated = optimtool.data[optimtool.data['Iteration'] == iteration]
+        assert len(simulated) == 6
+        assert simulated['Results'].tolist() == pytest.approx(list(likelihood(samples)))  # no predicted results
+    _, _, mean, _ = next_point.candidates[1]
+    assert not np.isnan(mean).any()  # the second iteration was screened
@@ -0,0 +1,115 @@
+import copy
+import json
+import os
+
+import pytest
+
+from conftest import STATIC_DIR, TEMPLATE_DIR
+from template_index import TemplatePathIndex, indexed_template_class
+
+TEMPLATE_FILES = [
+    os.path.join(TEMPLATE_DIR, 'config.json'),
+    os.path.join(TEMPLATE_DIR, 'campaign_Nyanza_baseline_202301.json'),
+    os.path.join(STATIC_DIR, 'Demographics.json'),
+    os.path.join(TEMPLATE_DIR, 'PFA_Overlay.json'),
+    os.path.join(TEMPLATE_DIR, 'Accessibility_and_Risk_IP_Overlay.json'),
+    os.path.join(TEMPLATE_DIR, 'Risk_Assortivity_Overlay.json')
+]
+ROOTS = {'config.json': (('parameters',), ())}
+
+
+class JsonTemplate(object):
+    # the parts of dtk's TaggedTemplate interface the mixin builds on; unknown parameters raise like dtk does
+    def __init__(self, filename, contents):
+        self.filename = filename
+        self.contents = contents
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename) as f:
+            return cls(filename, json.load(f))
+
+    def reset(self):
+        pass
+
+    def has_param(self, param):
+        return False
+
+    def set_param(self, param, value):
+        raise KeyError('Parameter %s not found in %s' % (param, self.filename))
+
+    def get_contents(self):
+        return self.contents
+
+
+def load_indexed(filename):
+    template = indexed_template_class(JsonTemplate).from_file(filename)
+    template.path_index_roots = ROOTS.get(os.path.basename(filename), ((),))
+    template.build_path_index()
+    return template
+
+
+@pytest.mark.parametrize('filename', TEMPLATE_FILES, ids=os.path.basename)
+def test_unknown_parameters_are_not_found(filename):
+    template = load_indexed(filename)
+    for param in ['Some_Garbage', 'parameters.Some_Garbage', 'Base_Infectivity.Some_Garbage']:
+        assert not template.has_param(param)
+        with pytest.raises(KeyError):
+            template.set_param(param, 1)
+    if os.path.basename(filename) != 'config.json':
+        for param in ['Base_Infectivity', 'Run_Number', 'x_Base_Population']:
+            assert not template.has_param(param)
+
+
+def test_config_parameters_are_found_under_parameters():
+    template = load_indexed(os.path.join(TEMPLATE_DIR, 'config.json'))
+    assert template.has_param('Base_Infectivity')
+    assert template.set_param('Base_Infectivity', 0.5) == ['parameters.Base_Infectivity']
+    assert template.get_contents()['parameters']['Base_Infectivity'] == 0.5
+    assert 'Base_Infectivity' not in template.get_contents()
+
+
+@pytest.mark.parametrize('filename', [f for f in TEMPLATE_FILES if 'Template' in f and 'config' not in f],
+                         ids=os.path.basename)
+def test_tagged_parameters_match_a_full_search(filename):
+    with open(filename) as f:
+        contents = json.load(f)
+    template = load_indexed(filename)
+    expected = copy.deepcopy(contents)
+    n_set = 0
+    for param, paths in TemplatePathIndex(contents).tagged_paths.items():
+        # a marker whose parameter is not next to it (e.g. Choices__KP_PreART_Loss) marks nothing
+        existing = [path for path in paths if path[-1] in _parent(expected, path)]
+        if not existing:
+            assert not template.has_param(param)
+            continue
+        template.set_param(param, param)
+        for path in existing:
+            _parent(expected, path)[path[-1]] = param
+        n_set += 1
+    assert n_set > 0
+    assert template.get_contents() == expected
+
+
+def _parent(document, path):
+    for key in path[:-1]:
+        document = document[key]
+    return document
+
+
+def test_documents_handed_out_are_never_modified_without_reset():
+    filename = os.path.join(TEMPLATE_DIR, 'PFA_Overlay.json')
+    template = load_indexed(filename)
+    param = sorted(TemplatePathIndex(template.get_contents()).tagged_paths)[0]
+    documents = []
+    for value in range(3):  # no reset() between simulations
+        template.set_param(param, value)
+        documents.append(template.get_contents())
+    snapshots = [json.dumps(document, sort_keys=True) for document in documents]
+    template.set_param(param, 99)
+    template.reset()
+    template.set_param(param, 100)
+    assert [json.dumps(document, sort_keys=True) for document in documents] == snapshots
+    assert len(set(snapshots)) == 3
+    with open(filename) as f:
+        assert template.pristine_contents == json.load(f)